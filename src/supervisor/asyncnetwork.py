@@ -0,0 +1,301 @@
+'''
+asyncio network engine of the Worker
+A single event loop thread serves the listeners, the input connections, the sends and the acks
+of the outputs instead of one thread per connection.
+The job loop and the output dispatch keep their own threads.
+
+@author: WIN32GG
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import socket
+from threading import Lock, Thread
+import traceback
+
+import network
+from utils.custom_logging import _DEBUG_LEVEL
+from utils.custom_logging import debug
+
+
+ENGINE_THREADS = "threads" #a thread per connection
+ENGINE_ASYNCIO = "asyncio"
+ENGINES = [ENGINE_THREADS, ENGINE_ASYNCIO]
+
+class AckWriter:
+    '''
+    Write end of an input connection, used from the job thread (acks) and by the shared memory releases
+    The writes are sent in order by the event loop
+    '''
+
+    def __init__(self, engine, sock):
+        self.engine = engine
+        self.sock = sock
+        self.pending = bytearray()
+        self.draining = False
+        self.closed = False
+        self.lock = Lock()
+
+    def write(self, b):
+        with self.lock:
+            if(self.closed):
+                raise OSError("Connection closed")
+            self.pending += b
+            if(self.draining):
+                return
+            self.draining = True
+
+        self.engine.call(self._drain())
+
+    def flush(self):
+        pass #sent by the event loop
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    async def _drain(self):
+        while(True):
+            with self.lock:
+                if(len(self.pending) == 0 or self.closed):
+                    self.draining = False
+                    return
+                b = bytes(self.pending)
+                self.pending.clear()
+
+            try:
+                await self.engine.loop.sock_sendall(self.sock, b)
+            except OSError:
+                self.close() #the input task handles the loss
+
+
+class AsyncNetwork:
+    '''
+    Runs the network of a Worker in an asyncio event loop
+    The sockets given to it are non blocking and must only be shut down (see shutdown) from the other threads
+    '''
+
+    DRAIN_TIMEOUT = 10 #seconds to send the pending packets when stopping
+    ACK_READ_SIZE = 256
+    DECODE_THREADS = 4
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.loop = asyncio.new_event_loop()
+        self.sendLocks = {} #sock: asyncio.Lock, the packets of a link are sent in order
+        self.decoder = ThreadPoolExecutor(self.DECODE_THREADS) #decode and integrity check, off the event loop
+        self.thread = Thread(target = self._loopTarget, daemon = True)
+        self.thread.start()
+
+    def _loopTarget(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def call(self, coro):
+        """
+        Schedules the coroutine in the event loop from any thread, returns its concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def shutdown(self, sock):
+        """
+        Ends the connection, the task using the socket closes it
+        """
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def flush(self):
+        """
+        Waits for the pending packets to be sent
+        """
+        try:
+            self.call(self._drain()).result(self.DRAIN_TIMEOUT)
+        except:
+            debug("Could not send the pending packets", 0, True)
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.decoder.shutdown(wait = False)
+
+    async def _drain(self):
+        for lock in list(self.sendLocks.values()):
+            async with lock:
+                pass
+
+    ## Inputs
+
+    def listen(self, server):
+        server.setblocking(False)
+        self.call(self._acceptTask(server))
+
+    async def _acceptTask(self, server):
+        w = self.worker
+        try:
+            while(not w.workerShutdown.value):
+                client, addr = await self.loop.sock_accept(server)
+                debug("Input from: "+str(addr or server.getsockname()), 1)
+                client.setblocking(False)
+                self.loop.create_task(self._inputTask(client))
+        except:
+            if(not w.workerShutdown.value and w.jobRunning.value):
+                traceback.print_exc()
+        finally:
+            server.close()
+
+    async def _inputTask(self, sock):
+        w = self.worker
+        chan = AckWriter(self, sock)
+        pool, codecs, shared = w._openInput(sock, chan)
+        try:
+            while(not w.workerShutdown.value):
+                packets = await self.readPackets(sock, w.inputIntegrity, pool, codecs, shared)
+                if(len(packets) > 1):
+                    w.batchedInputs[chan] = len(packets)
+
+                for p in packets:
+                    w._packetReceived(p, chan)
+                    try:
+                        w.inputQueue.put_nowait(p)
+                    except queue.Full: #hold for next packet, without blocking the other connections
+                        await self.loop.run_in_executor(None, w.inputQueue.put, p)
+
+        except:
+            if(_DEBUG_LEVEL == 3):
+                traceback.print_exc()
+            debug("Incoming Connection was lost", 0, True)
+        finally:
+            chan.close()
+            sock.close()
+            w._closeInput(sock, chan, shared)
+
+    async def _recvInto(self, sock, view):
+        r = 0
+        while(r < len(view)):
+            n = await self.loop.sock_recv_into(sock, view[r:])
+            if(not n):
+                raise EOFError("Connection closed")
+            r += n
+
+    async def _recv(self, sock, size):
+        buf = bytearray(size)
+        await self._recvInto(sock, memoryview(buf))
+        return buf
+
+    async def readPackets(self, sock, integrity = None, pool = None, codecs = None, shared = None):
+        """
+        Same as network.readPackets, the payloads are received directly in the buffers of the pool
+        """
+        prefix = await self._recv(sock, 8)
+        count = 1
+        if(network.PacketBatch.isBatch(prefix)):
+            count = network.PacketBatch.readCount(prefix)
+            prefix = None
+
+        packets = []
+        for _ in range(count):
+            if(prefix is None):
+                prefix = await self._recv(sock, 8)
+
+            p = network.Packet()
+            p.data = network.parseHeader(prefix, await self._recv(sock, network.headerLength(prefix)))
+            prefix = None
+            for q in p._bodyParts(shared):
+                n = q.binLength()
+                if(n <= 0):
+                    continue
+
+                buf = bytearray(n) if pool == None else pool.get(n)
+                b = memoryview(buf)[:n]
+                try:
+                    await self._recvInto(sock, b)
+                except:
+                    if(pool != None):
+                        pool.release(buf)
+                    raise
+                q._setBinObject(b, pool, buf)
+
+            #the next packet of the connection is read once this one is decoded (in order for the stateful codecs)
+            await self.loop.run_in_executor(self.decoder, network.readImagePacket, p, integrity, codecs)
+            packets.append(p)
+
+        return packets
+
+    ## Outputs
+
+    def addOutput(self, sock):
+        sock.setblocking(False)
+        self.call(self._ackTask(sock))
+
+    def send(self, sock, buffers, packets):
+        """
+        Sends the buffers after the ones already queued for sock, the packets are released once sent
+        """
+        self.call(self._sendTask(sock, buffers, packets))
+
+    def _sendLock(self, sock):
+        if(not sock in self.sendLocks):
+            self.sendLocks[sock] = asyncio.Lock()
+        return self.sendLocks[sock]
+
+    async def _sendTask(self, sock, buffers, packets):
+        try:
+            async with self._sendLock(sock):
+                for b in buffers:
+                    if(len(b) > 0):
+                        await self.loop.sock_sendall(sock, b)
+        except:
+            self.worker._outputLost(sock)
+        finally:
+            for p in packets:
+                p.release()
+
+    async def _ackTask(self, sock):
+        """
+        Receives the acks and the shared memory releases of an output, see Worker._childWorkerAckTarget
+        """
+        w = self.worker
+        buf = bytearray(self.ACK_READ_SIZE)
+        pending = b''
+        debug("Started ChildWorkerNetworkACK", 3)
+        try:
+            while(True): #until the output is closed, see Worker._childWorkerAckTarget
+                n = await self.loop.sock_recv_into(sock, buf)
+                if(not n and w.workerShutdown.value):
+                    return #closed by stop
+                if(not n):
+                    raise EOFError("Connection closed")
+
+                data = pending + buf[:n]
+                i = 0
+                while(i < len(data)):
+                    b = data[i:i + 1]
+                    if(b in (network.SharedMemoryReader.RELEASE, network.CREDITS)):
+                        if(i + 3 > len(data)):
+                            break #value in the next read
+                        value = int.from_bytes(data[i + 1:i + 3], 'big')
+                        if(b == network.CREDITS):
+                            w._ackReceived(sock, value, True)
+                        else:
+                            w.sharedRings[sock].releaseSlot(value)
+                        i += 3
+                        continue
+
+                    if(b != network.ACK): #magic value
+                        raise ValueError("Wrong ack value")
+                    w._ackReceived(sock)
+                    i += 1
+                pending = bytes(data[i:])
+
+        except:
+            if(not w.workerShutdown.value):
+                if(_DEBUG_LEVEL == 3):
+                    traceback.print_exc()
+                debug("Output network callback error", 0, True)
+            w._ackLost(sock)
+        finally:
+            async with self._sendLock(sock): #the queued sends fail on the shut down socket
+                sock.close()
+            self.sendLocks.pop(sock, None)
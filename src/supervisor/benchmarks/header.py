@@ -0,0 +1,67 @@
+'''
+Benchmark of the Packet header formats (json vs binary)
+Serialization, parsing time and size for typical multistreamer and boxer packets
+
+Run from src/supervisor: python3 -m benchmarks.header [iterations]
+'''
+
+import io
+import json
+import sys
+import timeit
+
+from utils import custom_logging
+import network
+import numpy as np
+
+
+def multistreamerPacket():
+    p = network.Packet()
+    p["from"] = "tidzam-videocamera1_2018-02-08.mp4"
+    p["frame_count"] = "1234"
+    p["img"] = np.zeros((600, 800, 3), dtype = "uint8")
+    p.encode(network.CODEC_RAW)
+    return p
+
+def boxerPacket():
+    p = multistreamerPacket()
+    p["detection"] = [
+            ("bird", 0.9312, (412.5, 220.25, 64.0, 48.5)),
+            ("duck", 0.5124, (102.0, 310.75, 120.5, 80.0)),
+            ("deer", 0.4471, (650.25, 400.0, 140.0, 210.5))
+        ]
+    return p
+
+def benchHeader(p, headerFormat, iterations):
+    p.data[p.BINARY_DATA_LENGTH_TAG] = len(p.binObj)
+    header = p._headerBytes(headerFormat)
+    
+    def parse():
+        chan = io.BytesIO(header)
+        prefix = chan.read(8)
+        if(network.BinaryHeader.isBinary(prefix)):
+            return network.BinaryHeader.unpack(prefix, chan)
+        return json.loads(chan.read(int.from_bytes(prefix, 'big')).decode(encoding = 'utf-8'))
+    
+    if(parse() != json.loads(json.dumps(p.data))):
+        raise AssertionError("Header "+headerFormat+" does not round trip")
+    
+    return {
+            "size": len(header),
+            "serialize_us": timeit.timeit(lambda: p._headerBytes(headerFormat), number = iterations) / iterations * 1e6,
+            "parse_us": timeit.timeit(parse, number = iterations) / iterations * 1e6
+        }
+
+def run(iterations = 20000):
+    results = {}
+    for name, p in [("multistreamer", multistreamerPacket()), ("boxer", boxerPacket())]:
+        results[name] = {}
+        for headerFormat in network.HEADER_FORMATS:
+            results[name][headerFormat] = benchHeader(p, headerFormat, iterations)
+    
+    return results
+
+if __name__ == "__main__":
+    custom_logging._DEBUG_LEVEL = 0
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print(json.dumps(run(iterations), indent = 2))
@@ -0,0 +1,263 @@
+'''
+Micro benchmark of network.Packet, step by step, over a dtype / shape / codec matrix
+Send path: createImagePacket (codec encode), integrity signature, header, join of the buffers (what the former
+send did, for reference) and write, then Packet.send as a whole
+Read path: header parsing, payload read, integrity check, decode (readImagePacket), then Packet.read as a whole
+The whole steps are measured on an in memory BytesIO and on a socketpair (the other end served by a thread)
+
+The frames are a gradient with some noise, closer to a camera frame than pure noise for the compressing codecs
+The stateful codecs (delta) are measured on a keyframe and on a delta frame: the next frame of a fixed camera,
+an object moving over part of the image
+
+Run from src/supervisor: python3 -m benchmarks.packet [--shapes ...] [--dtypes ...] [--codecs ...] (--help)
+'''
+
+import argparse
+import io
+import itertools
+import json
+import socket
+import sys
+import time
+from threading import Thread
+
+from utils import custom_logging
+import network
+import numpy as np
+
+
+SHAPES = {"160x120": (120, 160, 3), "800x600": (600, 800, 3), "800x600gray": (600, 800), "1080p": (1080, 1920, 3)}
+DTYPES = ["uint8", "uint16", "float32"]
+CODECS = ["raw", "npz", "zlib:1", "png", "jpeg:80"] #lzma and delta on demand
+INTEGRITY = "sha1"
+MIN_TIME = 0.2 #seconds measured per step
+MIN_RUNS = 3
+
+def frame(shape, dtype):
+    h, w = shape[:2]
+    gradient = np.add.outer(np.arange(h) * 255 / max(1, h - 1), np.arange(w) * 255 / max(1, w - 1)) / 2
+    if(len(shape) == 3):
+        gradient = np.repeat(gradient[:, :, None], shape[2], axis = 2)
+    img = gradient + np.random.randint(0, 8, size = shape)
+    if(np.issubdtype(np.dtype(dtype), np.integer)):
+        img = img * (np.iinfo(dtype).max // 255)
+    return img.astype(dtype)
+
+def nextFrame(img):
+    """
+    img with a noisy object over a sixteenth of it (a quarter of the height and of the width)
+    """
+    h, w = img.shape[:2]
+    out = img.copy()
+    region = out[h // 4:h // 4 + max(1, h // 4), w // 4:w // 4 + max(1, w // 4)]
+    region[...] = frame(region.shape, img.dtype)[::-1, ::-1] #another gradient, other noise
+    return out
+
+def measure(step, setup = None):
+    """
+    Mean milliseconds of step(), setup() runs untimed before each call and its result is given to step
+    """
+    runs = 0
+    total = 0
+    while(runs < MIN_RUNS or total < MIN_TIME):
+        arg = setup() if setup else None
+        st = time.perf_counter()
+        step(arg) if setup else step()
+        total += time.perf_counter() - st
+        runs += 1
+    return round(total / runs * 1000, 4)
+
+class SocketChannels:
+    '''
+    A socketpair whose far end is drained (for the sends) or fed (for the reads) by a thread
+    '''
+
+    def __init__(self):
+        self.a, self.b = socket.socketpair()
+
+    def drain(self):
+        def target():
+            buf = bytearray(1 << 20)
+            try:
+                while(self.b.recv_into(buf) > 0):
+                    pass
+            except OSError:
+                pass
+        Thread(target = target, daemon = True).start()
+        return self.a
+
+    def fed(self, message):
+        """
+        Returns a binary file object from which the message can be read again and again
+        """
+        def target():
+            try:
+                while(True):
+                    self.b.sendall(message)
+            except OSError:
+                pass
+        Thread(target = target, daemon = True).start()
+        return self.a.makefile("rb")
+
+    def close(self):
+        for s in (self.a, self.b):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+
+def sendSteps(img, codecSpec, reference = None):
+    """
+    Returns the encoded packet and the time of each step of the send path
+    A stateful codec is reset before each encode: img is a keyframe, or a delta against reference (encoded untimed)
+    """
+    codec = network.getCodec(codecSpec)
+    integrity = network.IntegrityCheck(INTEGRITY)
+
+    def packet():
+        p = network.Packet()
+        p["from"] = "bench"
+        return p
+
+    def newPacket():
+        codec.reset()
+        if(reference is not None):
+            network.createImagePacket(packet(), reference, codec)
+        return packet()
+
+    steps = {"createImagePacket": measure(lambda p: network.createImagePacket(p, img, codec), newPacket)}
+
+    p = network.createImagePacket(newPacket(), img, codec)
+    def unsigned():
+        p.data.pop("checksum", None)
+        p.data.pop("integrity", None)
+        return p
+    steps["integrity"] = measure(lambda p: integrity.sign(p), unsigned)
+    integrity.sign(p)
+
+    buffers = p.buffers()
+    steps["header"] = measure(lambda: p._headerBytes(network.HEADER_JSON))
+    steps["concat"] = measure(lambda: b''.join(buffers))
+    steps["write"] = measure(lambda chan: network.writeBuffers(chan, buffers), io.BytesIO)
+    return p, steps
+
+def readSteps(p, message, codecs, rewind):
+    """
+    Time of each step of the read path of the serialized packet message, codecs are the decoders of the link
+    rewind() is called before each read (puts the stateful decoders back to the reference of p)
+    """
+    integrity = network.IntegrityCheck(INTEGRITY)
+    prefix = message[:8]
+    headerEnd = 8 + network.headerLength(prefix)
+    header = message[8:headerEnd]
+
+    steps = {"header": measure(lambda: network.parseHeader(prefix, header))}
+
+    def atPayload():
+        chan = io.BytesIO(message)
+        chan.seek(headerEnd)
+        q = network.Packet()
+        q.data = network.parseHeader(prefix, header)
+        return (q, chan)
+    steps["payload"] = measure(lambda a: a[0]._readBinObject(a[1]), atPayload)
+
+    def readPacket():
+        rewind()
+        q, chan = atPayload()
+        q._readBinObject(chan)
+        return q
+    def unsigned():
+        q = readPacket()
+        q.data.pop("checksum", None) #verified by the checksum of the packet otherwise
+        return q
+    steps["integrity"] = measure(lambda q: integrity.verify(q), readPacket)
+    steps["decode"] = measure(lambda q: network.readImagePacket(q, integrity, codecs), unsigned)
+    steps["readImagePacket"] = measure(lambda q: network.readImagePacket(q, integrity, codecs), readPacket)
+    return steps
+
+def wholeSteps(p, message, codecs, rewind):
+    """
+    Packet.send and Packet.read as a whole, on BytesIO and on a socketpair
+    """
+    integrity = network.IntegrityCheck(INTEGRITY)
+    results = {}
+
+    results["send_bytesio"] = measure(lambda chan: p.send(chan), io.BytesIO)
+    channels = SocketChannels()
+    sock = channels.drain()
+    results["send_socket"] = measure(lambda: p.send(sock))
+    channels.close()
+
+    def rewound(chan):
+        rewind()
+        return chan
+    results["read_bytesio"] = measure(lambda chan: network.Packet().read(chan, integrity, codecs = codecs),
+                                      lambda: rewound(io.BytesIO(message)))
+    channels = SocketChannels()
+    chan = channels.fed(message)
+    results["read_socket"] = measure(lambda chan: network.Packet().read(chan, integrity, codecs = codecs), lambda: rewound(chan))
+    channels.close()
+    return results
+
+def frameResult(img, p, send, codecs = None, rewind = lambda: None):
+    message = b''.join(p.buffers())
+    return {
+            "payload_bytes": len(p.binObj),
+            "header_bytes": len(message) - len(p.binObj),
+            "ratio": round(img.nbytes / max(1, len(p.binObj)), 3),
+            "send_ms": send,
+            "read_ms": readSteps(p, message, codecs or {}, rewind),
+            "whole_ms": wholeSteps(p, message, codecs or {}, rewind)
+        }
+
+def benchmark(shapeName, dtype, codecSpec):
+    img = frame(SHAPES[shapeName], dtype)
+    result = {"shape": shapeName, "dtype": dtype, "codec": codecSpec, "image_bytes": img.nbytes}
+    try:
+        p, send = sendSteps(img, codecSpec)
+    except Exception as e: #eg png and jpeg only handle uint8 images
+        result["unsupported"] = repr(e)
+        return result
+
+    if(not network.getCodec(codecSpec).stateful):
+        result.update(frameResult(img, p, send))
+        return result
+
+    result["keyframe"] = frameResult(img, p, send)
+
+    #delta of the next frame, decoded against the keyframe of img
+    following = nextFrame(img)
+    p, send = sendSteps(following, codecSpec, img)
+    codecs = {}
+    key = network.Packet()
+    key["from"] = p["from"]
+    network.readImagePacket(network.createImagePacket(key, img, codecSpec), network.IntegrityCheck("none"), codecs)
+    decoder = codecs[codecSpec]
+    def rewind():
+        for state in decoder.streams.values():
+            state[0] = p["refseq"]
+
+    result["changed_pixels"] = round(float(np.mean(np.any((following != img).reshape(img.shape[:2] + (-1,)), axis = 2))), 4)
+    result["delta"] = frameResult(following, p, send, codecs, rewind)
+    return result
+
+def run(shapes, dtypes, codecs):
+    results = []
+    for shapeName, dtype, codecSpec in itertools.product(shapes, dtypes, codecs):
+        print(shapeName+" "+dtype+" "+codecSpec, file = sys.stderr)
+        results.append(benchmark(shapeName, dtype, codecSpec))
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Packet micro benchmark")
+    parser.add_argument("--shapes", nargs = "+", default = list(SHAPES.keys()), choices = list(SHAPES.keys()))
+    parser.add_argument("--dtypes", nargs = "+", default = DTYPES)
+    parser.add_argument("--codecs", nargs = "+", default = CODECS, help = "codec specs, eg raw npz zlib:1 lzma png jpeg:80 delta")
+    parser.add_argument("--min-time", type = float, default = MIN_TIME, help = "seconds measured per step")
+    args = parser.parse_args()
+
+    MIN_TIME = args.min_time
+    custom_logging._DEBUG_LEVEL = 0
+    network._DEBUG_LEVEL = 0 #its own copy, prints on each integrity check otherwise
+    print(json.dumps(run(args.shapes, args.dtypes, args.codecs), indent = 2))
@@ -0,0 +1,317 @@
+'''
+End to end benchmark of a local pipeline of real worker processes:
+generatenpjob -> identityjob x fan-out -> nulljob (sink)
+
+Each scenario of the sweep (frame size, outputmethod of the generator, fan-out width, output queue size)
+starts its workers, sends the frames and reports the frames/s and MB/s received by the sink, the p50/p99
+latency from the generator to the sink and the CPU of each process, as JSON.
+Every frame is traced: the percentiles are computed from the latency of each frame received (each copy with duplicate),
+read from the traces exported by the sink. The transport of each link (shared memory, unix socket or tcp) is reported as well,
+--compare flags the scenarios whose links changed.
+The results hold the commit they were measured on, give a previous result file to --compare to spot the regressions
+
+Run from src/supervisor: python3 -m benchmarks.pipeline [--frames 100] [--rate fps] [--out results.json] [--compare old.json]
+(--help for the sweep options)
+'''
+
+import argparse
+import itertools
+import json
+import os
+from queue import Queue, Empty
+import subprocess as sp
+import sys
+import tempfile
+import time
+from threading import Thread
+
+from utils import config
+import network
+import worker
+
+
+FRAME_SIZES = {"800x600": (600, 800, 3), "1080p": (1080, 1920, 3)}
+METHODS = ["duplicate", "distribute"]
+FANOUTS = [1, 2]
+QUEUE_SIZES = [2, 8]
+
+BASE_PORT = 27000
+POLL_INTERVAL = 0.05 #seconds between two stats of the sink
+IDLE_TIMEOUT = 15 #seconds without a frame received before giving up a scenario
+STATS_TIMEOUT = 5
+STOP_TIMEOUT = 5
+REGRESSION = 0.1 #relative loss reported by --compare
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class BenchWorker(object):
+    '''
+    A worker.py process driven through its stdin, as the supervisor does
+    '''
+
+    def __init__(self, cfg):
+        self.name = cfg["workername"]
+        self.port = cfg["port"]
+        env = dict(os.environ, PYTHONUNBUFFERED="1")
+        self.proc = sp.Popen([config.PYTHON_CMD, "worker.py"], stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.STDOUT,
+                             universal_newlines=True, env=env)
+        self.stats = Queue()
+        self.cpu = 0
+        Thread(target=self._outputTarget, daemon=True).start()
+        self.send(cfg)
+
+    def _outputTarget(self):
+        for line in self.proc.stdout:
+            i = line.find(worker.STATS_TAG)
+            if(i >= 0):
+                self.stats.put(json.loads(line[i+len(worker.STATS_TAG):]))
+
+    def send(self, obj):
+        self.proc.stdin.write(json.dumps(obj)+"\n")
+        self.proc.stdin.flush()
+
+    def getStats(self):
+        """
+        Returns the stats of the worker, None if it exited
+        """
+        if(self.proc.poll() != None):
+            return None
+        try:
+            self.send({"workername": self.name, "action": "stats"})
+            return self.stats.get(timeout=STATS_TIMEOUT)
+        except (OSError, Empty):
+            return None
+
+    def sampleCpu(self):
+        """
+        Reads the CPU seconds of the process, the last value is kept once it exited
+        """
+        try:
+            with open("/proc/"+str(self.proc.pid)+"/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            self.cpu = (int(fields[11]) + int(fields[12])) / CLOCK_TICKS #utime, stime
+        except (OSError, IndexError, ValueError):
+            pass
+        return self.cpu
+
+    def waitListening(self, timeout = 15):
+        path = network.localSocketPath(self.port)
+        limit = time.time() + timeout
+        while(time.time() < limit and self.proc.poll() == None):
+            if(os.path.exists(path)):
+                return True
+            time.sleep(.1)
+        return False
+
+    def stop(self):
+        try:
+            self.send({"workername": self.name, "action": "stop"})
+            self.proc.wait(STOP_TIMEOUT)
+        except:
+            self.proc.kill()
+            self.proc.wait()
+
+
+def tracePath(port):
+    return os.path.join(tempfile.gettempdir(), "tidmarsh_bench_traces_"+str(port)+".json")
+
+def traceLatencies(path):
+    """
+    Returns the generator to sink latency (ms) of each trace exported by the sink
+    The copies of a frame (duplicate) share its trace id, they are told apart by their path
+    """
+    try:
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+    except (OSError, ValueError, KeyError):
+        return []
+
+    spans = {} #(trace id, path): [first start, last end] of its events (µs)
+    for e in events:
+        if(e["ph"] != "X"):
+            continue
+        span = spans.setdefault((e["args"]["trace"], e["args"].get("path")), [e["ts"], e["ts"] + e["dur"]])
+        span[0] = min(span[0], e["ts"])
+        span[1] = max(span[1], e["ts"] + e["dur"])
+    return [(end - start) / 1000 for start, end in spans.values()]
+
+def percentile(values, q):
+    """
+    Exact percentile of values, interpolated between the two closest ranks, None without values
+    """
+    if(len(values) == 0):
+        return None
+    values = sorted(values)
+    pos = q * (len(values) - 1)
+    i = int(pos)
+    if(i + 1 == len(values)):
+        return round(values[i], 3)
+    return round(values[i] + (values[i + 1] - values[i]) * (pos - i), 3)
+
+def workerConfigs(shape, method, fanout, queueSize, frames, codec, rate, port):
+    sink = {"workername": "sink", "port": port, "jobname": "nulljob", "debuglevel": 0, "traceexport": tracePath(port)}
+    mids = [{"workername": "identity"+str(i), "port": port + 1 + i, "jobname": "identityjob", "debuglevel": 0,
+             "output": ["127.0.0.1:"+str(port)]} for i in range(fanout)]
+    gen = {"workername": "gen", "port": port + 1 + fanout, "jobname": "generatenpjob", "debuglevel": 0,
+           "jobdata": {"frames": frames, "shape": list(shape), "random": False, "rate": rate},
+           "outputmethod": method, "outputqueue": str(queueSize)+":block", "tracing": 1,
+           "output": ["127.0.0.1:"+str(m["port"]) for m in mids]}
+    if(codec != None):
+        for cfg in mids + [gen]:
+            cfg["outputcodec"] = codec
+    return [sink] + mids + [gen] #started in this order, the outputs first
+
+def runScenario(sizeName, method, fanout, queueSize, frames, codec, rate, port):
+    shape = FRAME_SIZES[sizeName]
+    expected = frames * (fanout if method == "duplicate" else 1)
+    workers = []
+    try:
+        for cfg in workerConfigs(shape, method, fanout, queueSize, frames, codec, rate, port):
+            if(cfg["workername"] == "gen"):
+                start = time.time()
+            w = BenchWorker(cfg)
+            workers.append(w)
+            if(w.name != "gen" and not w.waitListening()): #the generator is plugged to them
+                raise RuntimeError("Worker "+w.name+" did not start")
+        sink = workers[0]
+
+        #frames received by the sink over time
+        first = last = None
+        count = 0
+        lastChange = time.time()
+        stats = None
+        transports = {} #worker: {output: transport}, once its outputs are plugged
+        while(count < expected and time.time() - lastChange < IDLE_TIMEOUT):
+            time.sleep(POLL_INTERVAL)
+            for w in workers:
+                w.sampleCpu()
+            for w in workers[1:]:
+                if(not w.name in transports):
+                    s = w.getStats()
+                    if(s != None and s.get("transports")):
+                        transports[w.name] = s["transports"]
+            s = sink.getStats()
+            if(s == None):
+                break
+            stats = s
+            n = s["metrics"]["meters"].get("packets_in", {}).get("count", 0)
+            now = time.time()
+            if(n > count):
+                if(first == None):
+                    first = (now, n)
+                last = (now, n)
+                count = n
+                lastChange = now
+        elapsed = time.time() - start
+    finally:
+        for w in reversed(workers):
+            w.stop()
+
+    received = stats["metrics"]["meters"].get("packets_in", {}) if stats else {}
+    latencies = traceLatencies(tracePath(port)) #written by the sink when it stops
+    if(os.path.exists(tracePath(port))):
+        os.remove(tracePath(port))
+    span = None if first == None or last[0] <= first[0] else last[0] - first[0]
+    perFrame = received.get("bytes", 0) / count if count > 0 else 0
+    fps = None if span == None else (last[1] - first[1]) / span
+    return {
+            "frame_size": sizeName,
+            "outputmethod": method,
+            "fanout": fanout,
+            "queue_size": queueSize,
+            "codec": codec or "default",
+            "rate": rate,
+            "frames_expected": expected,
+            "frames_received": count,
+            "fps": None if fps == None else round(fps, 2),
+            "MB_s": None if fps == None else round(fps * perFrame / 1e6, 2),
+            "latency_p50_ms": percentile(latencies, 0.5),
+            "latency_p99_ms": percentile(latencies, 0.99),
+            "latency_frames": len(latencies),
+            "transports": transports,
+            "cpu_percent": {w.name: round(w.cpu / elapsed * 100, 1) for w in workers},
+            "drops": (stats or {}).get("drops", {}).get("total")
+        }
+
+def scenarioKey(r):
+    return (r["frame_size"], r["outputmethod"], r["fanout"], r["queue_size"], r["codec"], r["rate"])
+
+def compare(results, previous):
+    """
+    Returns the change of fps and p99 latency of each scenario also in previous, flags the regressions
+    and the scenarios measured over other transports
+    """
+    old = {scenarioKey(r): r for r in previous["results"]}
+    changes = []
+    for r in results:
+        o = old.get(scenarioKey(r))
+        if(o == None):
+            continue
+        change = {"scenario": "/".join(str(k) for k in scenarioKey(r))}
+        regression = False
+        for metric, higherIsBetter in [("fps", True), ("latency_p99_ms", False)]:
+            if(not r.get(metric) or not o.get(metric)):
+                continue
+            delta = (r[metric] - o[metric]) / o[metric]
+            change[metric] = round(delta * 100, 1)
+            regression = regression or (-delta if higherIsBetter else delta) > REGRESSION
+        change["regression"] = regression
+        if(r.get("transports") != o.get("transports")):
+            change["transports_changed"] = {"before": o.get("transports"), "now": r.get("transports")} #not the same links
+        changes.append(change)
+    return changes
+
+def gitCommit():
+    try:
+        return sp.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=sp.DEVNULL, universal_newlines=True).strip()
+    except:
+        return None
+
+def run(args):
+    scenarios = list(itertools.product(args.sizes, args.methods, args.fanouts, args.queues))
+    results = []
+    for i, (sizeName, method, fanout, queueSize) in enumerate(scenarios):
+        if(method == "distribute" and fanout == 1 and "duplicate" in args.methods):
+            continue #same pipeline as duplicate
+        port = args.port + i * 10
+        print("["+str(i+1)+"/"+str(len(scenarios))+"] "+sizeName+" "+method+" fan-out "+str(fanout)+" queue "+str(queueSize),
+              file=sys.stderr)
+        results.append(runScenario(sizeName, method, fanout, queueSize, args.frames, args.codec, args.rate, port))
+
+    report = {
+            "commit": gitCommit(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "cpus": os.cpu_count(),
+            "frames": args.frames,
+            "results": results
+        }
+    if(args.compare):
+        with open(args.compare) as f:
+            previous = json.load(f)
+        report["compared_to"] = previous.get("commit")
+        report["changes"] = compare(results, previous)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End to end pipeline benchmark")
+    parser.add_argument("--frames", type=int, default=100, help="frames sent by the generator per scenario")
+    parser.add_argument("--sizes", nargs="+", default=list(FRAME_SIZES.keys()), choices=list(FRAME_SIZES.keys()))
+    parser.add_argument("--methods", nargs="+", default=METHODS, choices=METHODS)
+    parser.add_argument("--fanouts", nargs="+", type=int, default=FANOUTS)
+    parser.add_argument("--queues", nargs="+", type=int, default=QUEUE_SIZES, help="output queue sizes of the generator")
+    parser.add_argument("--codec", default=None, help="outputcodec of the workers (default: the worker default)")
+    parser.add_argument("--rate", type=float, default=0, help="frames per second of the generator, 0 for as fast as possible:"
+                        +" the throughput, the latencies then include the queues")
+    parser.add_argument("--port", type=int, default=BASE_PORT, help="first port used by the workers")
+    parser.add_argument("--out", default=None, help="also write the results to this file")
+    parser.add_argument("--compare", default=None, help="previous result file")
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if(args.out):
+        with open(args.out, "w") as f:
+            f.write(text)
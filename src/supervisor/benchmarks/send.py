@@ -0,0 +1,92 @@
+'''
+Benchmark of Packet.send: time and peak memory allocated per send
+"concat" is the former send, joining the header and the payload in one bytes object before writing it,
+"buffers" is Packet.send, the header and the payload views are written separately (sendmsg on a socket)
+
+Run from src/supervisor: python3 -m benchmarks.send [sends]
+'''
+
+import json
+import os
+import socket
+import sys
+import time
+import tracemalloc
+from threading import Thread
+
+from utils import custom_logging
+import network
+import numpy as np
+
+
+FRAME_SIZES = {"800x600": (600, 800, 3), "1080p": (1080, 1920, 3)}
+
+def concatSend(p, binChan):
+    b = b'' #message buffer
+    for buf in p.buffers():
+        b += buf
+    binChan.write(b)
+    binChan.flush()
+
+def packetSend(p, binChan):
+    p.send(binChan)
+
+def drainTarget(sock):
+    buf = bytearray(1 << 20)
+    while(sock.recv_into(buf) > 0):
+        pass
+
+def openChannels():
+    """
+    Returns {name: (binary file object for concat, channel for Packet.send)} and what to close afterwards
+    """
+    devnull = open(os.devnull, "wb")
+    a, b = socket.socketpair()
+    Thread(target = drainTarget, args = (b,), daemon = True).start()
+    channels = {
+            "file": (devnull, devnull),
+            "socket": (a.makefile("wb"), a)
+        }
+    return channels, [devnull, a, b]
+
+def measure(send, p, binChan, sends):
+    st = time.time()
+    for _ in range(sends):
+        send(p, binChan)
+    elapsed = time.time() - st
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    send(p, binChan)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+            "ms": round(elapsed / sends * 1000, 3),
+            "peak_MB": round(peak / 1e6, 3)
+        }
+
+def run(sends = 50):
+    channels, closing = openChannels()
+    results = {}
+    for sizeName, shape in FRAME_SIZES.items():
+        p = network.Packet()
+        p["from"] = "bench"
+        p["img"] = np.random.randint(0, 255, size = shape, dtype = "uint8")
+        p.encode(network.CODEC_RAW, network.IntegrityCheck("none"))
+
+        results[sizeName] = {"frame_MB": round(p.img.nbytes / 1e6, 3)}
+        for chanName, (fileChan, sendChan) in channels.items():
+            results[sizeName][chanName] = {
+                    "concat": measure(concatSend, p, fileChan, sends),
+                    "buffers": measure(packetSend, p, sendChan, sends)
+                }
+
+    for c in closing:
+        c.close()
+    return results
+
+if __name__ == "__main__":
+    custom_logging._DEBUG_LEVEL = 0
+    sends = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(json.dumps(run(sends), indent = 2))
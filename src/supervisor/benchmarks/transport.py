@@ -0,0 +1,100 @@
+'''
+Benchmark of the links between two workers of the same host: loopback tcp vs unix socket
+Raw frames are sent with the worker protocol (one ack per packet) or streamed (no ack)
+
+Run from src/supervisor: python3 -m benchmarks.transport [frames]
+'''
+
+import json
+import os
+import socket
+import sys
+import tempfile
+import time
+from threading import Thread
+
+from utils import custom_logging
+import network
+import numpy as np
+
+
+FRAME_SIZES = {"800x600": (600, 800, 3), "1080p": (1080, 1920, 3)}
+
+def tcpPair():
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(server.getsockname())
+    conn = server.accept()[0]
+    server.close()
+    return client, conn
+
+def unixPair():
+    path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+    conn = server.accept()[0]
+    server.close()
+    os.unlink(path)
+    os.rmdir(os.path.dirname(path))
+    return client, conn
+
+def receiverTarget(sock, frames, ack):
+    binChan = sock.makefile("wrb")
+    pool = network.BufferPool()
+    integrity = network.IntegrityCheck("none")
+    for _ in range(frames):
+        for p in network.readPackets(binChan, integrity, pool):
+            p.release()
+        if(ack):
+            binChan.write(b'a')
+            binChan.flush()
+
+def benchLink(pairFactory, shape, frames, ack):
+    client, conn = pairFactory()
+    img = np.random.randint(0, 255, size = shape, dtype = "uint8")
+    p = network.Packet()
+    p["from"] = "bench"
+    p["img"] = img
+    p.encode(network.CODEC_RAW, network.IntegrityCheck("none"))
+
+    receiver = Thread(target = receiverTarget, args = (conn, frames, ack), daemon = True)
+    receiver.start()
+    ackChan = client.makefile("rb")
+
+    st = time.time()
+    for _ in range(frames):
+        p.send(client)
+        if(ack and ackChan.read(1) != b'a'):
+            raise ValueError("Wrong ack value")
+    receiver.join()
+    elapsed = time.time() - st
+
+    client.close()
+    conn.close()
+    return {
+            "fps": frames / elapsed,
+            "MB/s": frames * img.nbytes / elapsed / 1e6
+        }
+
+def run(frames = 200):
+    links = [("tcp", tcpPair)]
+    if(hasattr(socket, "AF_UNIX")):
+        links.append(("unix", unixPair))
+
+    results = {}
+    for sizeName, shape in FRAME_SIZES.items():
+        results[sizeName] = {}
+        for mode, ack in [("ack", True), ("stream", False)]:
+            results[sizeName][mode] = {name: benchLink(pairFactory, shape, frames, ack) for name, pairFactory in links}
+
+    return results
+
+if __name__ == "__main__":
+    custom_logging._DEBUG_LEVEL = 0
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    print(json.dumps(run(frames), indent = 2))
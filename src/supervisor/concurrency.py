@@ -0,0 +1,221 @@
+'''
+Job replicas of a Worker: "concurrency" runs N instances of the job off the same input queue,
+in threads (for the jobs releasing the GIL, eg darknet ctypes calls) or in processes, each driven by its own job thread
+The Reorderer gives their outputs back in the order the inputs were taken ("reorder")
+
+@author: WIN32GG
+'''
+
+from collections import deque
+import importlib
+import multiprocessing
+from threading import Condition, Lock
+import traceback
+
+import numpy as np
+
+from network import Packet
+from utils.custom_logging import debug
+
+
+MODE_THREADS = "threads"
+MODE_PROCESSES = "processes"
+MODES = [MODE_THREADS, MODE_PROCESSES]
+MODE_DEFAULT = MODE_THREADS
+
+PROCESS_STOP_TIMEOUT = 5 #seconds
+
+def parseConcurrency(spec):
+    """
+    Returns (replicas, mode) of a "N[:threads|processes]" concurrency spec
+    """
+    a = str(spec).split(":", 1)
+    count = int(a[0])
+    mode = a[1] if len(a) == 2 else MODE_DEFAULT
+    if(count < 1 or not mode in MODES):
+        raise ValueError("Invalid concurrency: "+str(spec))
+    return count, mode
+
+
+def _packetState(p):
+    """
+    What a Packet is made of, without its buffers and connection (sent to and from the job processes)
+    """
+    attachments = {}
+    for name in p.attachments:
+        value = p.getAttachment(name)
+        attachments[name] = value if isinstance(value, np.ndarray) else bytes(value)
+    return {"data": dict(p.data), "img": p.img, "binObj": None if p.binObj is None or p.img is not None else bytes(p.binObj),
+            "attachments": attachments}
+
+def _fromState(state):
+    p = Packet()
+    p.data = state["data"]
+    p.img = state["img"]
+    p.binObj = state["binObj"]
+    for name, value in state["attachments"].items():
+        p.attach(name, value)
+    return p
+
+def _pack(value):
+    if(isinstance(value, Packet)):
+        return ("packet", _packetState(value))
+    if(isinstance(value, list)):
+        return ("list", [_pack(v) for v in value])
+    return ("value", value)
+
+def _unpack(packed):
+    kind, value = packed
+    if(kind == "packet"):
+        return _fromState(value)
+    if(kind == "list"):
+        return [_unpack(v) for v in value]
+    return value
+
+
+def _jobProcessTarget(jobName, conn):
+    """
+    Runs the job calls sent by the JobProcess until the connection is closed
+    """
+    mod = importlib.import_module("jobs."+jobName)
+    jobCl = getattr(mod, jobName.split(".")[-1].capitalize())
+    job = jobCl()
+    job.shouldStop = False
+
+    while(True):
+        try:
+            method, arg = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            result = getattr(job, method)(*[_unpack(a) for a in arg])
+            conn.send((True, _pack(result), job.shouldStop))
+        except Exception:
+            conn.send((False, traceback.format_exc(), job.shouldStop))
+
+        if(method == "destroy"):
+            return
+
+
+class JobProcess(object):
+    '''
+    A replica of the job running in its own process, called like a Job by its job thread
+    The packets go through a pipe: their values, images and attachments are copied both ways
+    '''
+
+    def __init__(self, jobName, job):
+        ctx = multiprocessing.get_context("spawn") #the worker threads and sockets are not inherited
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target = _jobProcessTarget, args = (jobName, child), daemon = True)
+        self.process.start()
+        child.close()
+        self.job = job #local instance, answers requireData and allowDrop
+        self.shouldStop = False
+        self.lock = Lock()
+        debug("Job process started (pid "+str(self.process.pid)+")", 1)
+
+    def setup(self, data):
+        self._call("setup", data)
+
+    def loop(self, data):
+        return self._call("loop", data)
+
+    def loop_batch(self, packets):
+        return self._call("loop_batch", packets)
+
+    def destroy(self):
+        try:
+            self._call("destroy")
+        finally:
+            self.conn.close()
+            self.process.join(PROCESS_STOP_TIMEOUT)
+            if(self.process.is_alive()):
+                self.process.terminate()
+
+    def requireData(self):
+        return self.job.requireData()
+
+    def allowDrop(self):
+        return self.job.allowDrop()
+
+    def _call(self, method, *args):
+        with self.lock:
+            self.conn.send((method, [_pack(a) for a in args]))
+            ok, result, shouldStop = self.conn.recv()
+        self.shouldStop = self.shouldStop or shouldStop
+        if(not ok):
+            raise RuntimeError("Job process failed on "+method+":\n"+result)
+        return _unpack(result)
+
+
+class Reorderer(object):
+    '''
+    Numbers the inputs as the replicas take them and emits their outputs in this order
+    At most window sequences are in progress, bounding the outputs held for a slow replica
+    The outputs are emitted out of the lock (emit can block on a full output queue) by one replica at a time
+    '''
+
+    def __init__(self, window):
+        self.window = window
+        self.taken = 0
+        self.next = 0 #next sequence to be ready
+        self.emitted = 0
+        self.held = {} #sequence: emit function
+        self.ready = deque() #emit functions of the sequences up to next, in order
+        self.emitting = False #a replica is emitting the ready sequences
+        self.maxHeld = 0
+        self.takeLock = Lock() #keeps the sequences in the order of the input queue
+        self.cond = Condition()
+
+    def take(self, takeInputs):
+        """
+        Returns (sequence, takeInputs())
+        """
+        with self.takeLock: #only its holder takes a sequence: the window still has room once the inputs are taken
+            with self.cond:
+                self.cond.wait_for(lambda: self.taken - self.emitted < self.window)
+            inputs = takeInputs()
+            with self.cond:
+                seq = self.taken
+                self.taken += 1
+        return seq, inputs
+
+    def done(self, seq, emit):
+        """
+        emit() outputs the sequence, called once all the previous ones are
+        The ready sequences are emitted by this replica unless another one is already emitting
+        """
+        with self.cond:
+            self.held[seq] = emit
+            self.maxHeld = max(self.maxHeld, len(self.held))
+            while(self.next in self.held):
+                self.ready.append(self.held.pop(self.next))
+                self.next += 1
+            if(self.emitting):
+                return
+            self.emitting = True
+
+        emit = None
+        try:
+            while(True):
+                with self.cond:
+                    if(emit != None):
+                        self.emitted += 1
+                        self.cond.notify_all()
+                    if(len(self.ready) == 0):
+                        self.emitting = False #in the same lock as the check: a sequence ready from now on is emitted by its replica
+                        return
+                    emit = self.ready.popleft()
+                emit()
+        except:
+            with self.cond:
+                self.emitted += 1
+                self.emitting = False #the next done call emits the remaining ones
+                self.cond.notify_all()
+            raise
+
+    def stats(self):
+        with self.cond:
+            return {"in_progress": self.taken - self.emitted, "held": len(self.held), "ready": len(self.ready), "max_held": self.maxHeld,
+                    "window": self.window}
@@ -0,0 +1,225 @@
+'''
+Choice of the output receiving a packet in the distribute and hash output methods
+
+A policy is given the outputs having credits (in plug order) and their OutputLoad,
+specs are "name[:param]" (see getPolicy)
+The hash output method keeps the packets of a key on one output with a HashRing
+
+@author: WIN32GG
+'''
+
+from bisect import bisect
+from collections import deque
+import hashlib
+import math
+from threading import Lock
+import time
+
+
+class OutputLoad(object):
+    '''
+    Dispatch count, packets in flight and ack round trip (EWMA) of an output
+    '''
+
+    ALPHA = 0.2
+
+    def __init__(self, alpha = ALPHA):
+        self.alpha = alpha
+        self.dispatched = 0
+        self.sendTimes = deque() #of the packets not acked yet
+        self.rtt = None #seconds
+        self.lastAck = None
+        self.lock = Lock() #sent and dropped by the dispatcher, acked by the ack thread
+
+    def sent(self):
+        with self.lock:
+            self.dispatched += 1
+            self.sendTimes.append(time.time())
+
+    def acked(self, n = 1):
+        now = time.time()
+        with self.lock:
+            for _ in range(min(n, len(self.sendTimes))):
+                sample = now - self.sendTimes.popleft()
+                self.rtt = sample if self.rtt is None else self.alpha * sample + (1 - self.alpha) * self.rtt
+            self.lastAck = now
+
+    def latency(self, decay):
+        """
+        Round trip estimate, fading away (time constant decay) while the output gets no ack:
+        an output left aside after a slow ack is tried again
+        """
+        if(self.rtt is None):
+            return 0
+        return self.rtt * math.exp(-(time.time() - self.lastAck) / decay)
+
+    def dropped(self, n = 1):
+        """
+        Queued packets dropped before being sent (the most recent ones)
+        """
+        with self.lock:
+            for _ in range(min(n, len(self.sendTimes))):
+                self.sendTimes.pop()
+
+    def outstanding(self):
+        return len(self.sendTimes)
+
+    def stats(self):
+        return {
+                "dispatched": self.dispatched,
+                "outstanding": self.outstanding(),
+                "rtt_ms": None if self.rtt is None else round(self.rtt * 1000, 3)
+            }
+
+
+class DistributionPolicy(object):
+    name = None
+
+    def __init__(self, param = None):
+        if(param is not None):
+            raise ValueError("Policy "+self.name+" has no parameter")
+
+    def choose(self, outputs, loads):
+        """
+        Returns the output (one of outputs, not empty) receiving the next packet
+        """
+        raise NotImplementedError()
+
+    def _lowest(self, outputs, loads, cost):
+        """
+        Output of lowest cost, the ties are broken in turn (from the output after the last chosen)
+        """
+        order = list(loads.keys()) #plug order
+        last = getattr(self, "last", None)
+        start = order.index(last) + 1 if last in order else 0
+        best = None
+        for sock in order[start:] + order[:start]:
+            if(sock in outputs and (best == None or cost(sock) < cost(best))):
+                best = sock
+
+        self.last = best if best != None else outputs[0]
+        return self.last
+
+    def spec(self):
+        return self.name
+
+
+class FirstPolicy(DistributionPolicy):
+    '''
+    First available output, the former behaviour: the first outputs get most of the packets
+    '''
+    name = "first"
+
+    def choose(self, outputs, loads):
+        return outputs[0]
+
+
+class RoundRobinPolicy(DistributionPolicy):
+    '''
+    Next available output after the last one chosen
+    '''
+    name = "roundrobin"
+
+    def choose(self, outputs, loads):
+        return self._lowest(outputs, loads, lambda sock: 0)
+
+
+class LeastOutstandingPolicy(DistributionPolicy):
+    '''
+    Output with the fewest packets waiting for their ack
+    '''
+    name = "leastoutstanding"
+
+    def choose(self, outputs, loads):
+        return self._lowest(outputs, loads, lambda sock: loads[sock].outstanding())
+
+
+class LatencyPolicy(DistributionPolicy):
+    '''
+    Output with the lowest expected completion time: (outstanding + 1) * ack round trip (EWMA)
+    The outputs without a round trip yet are tried first. The parameter is the EWMA weight of a new sample
+    '''
+    name = "latency"
+    DECAY = 1.0 #seconds, see OutputLoad.latency
+
+    def __init__(self, param = None):
+        self.alpha = OutputLoad.ALPHA if param is None else float(param)
+        if(not 0 < self.alpha <= 1):
+            raise ValueError("The EWMA weight must be in ]0, 1]")
+
+    def choose(self, outputs, loads):
+        def cost(sock):
+            load = loads[sock]
+            load.alpha = self.alpha
+            return (load.outstanding() + 1) * load.latency(self.DECAY)
+        return self._lowest(outputs, loads, cost)
+
+    def spec(self):
+        return self.name+":"+str(self.alpha)
+
+
+POLICIES = {}
+
+def registerPolicy(policyClass):
+    POLICIES[policyClass.name] = policyClass
+    return policyClass
+
+for _p in [FirstPolicy, RoundRobinPolicy, LeastOutstandingPolicy, LatencyPolicy]:
+    registerPolicy(_p)
+
+POLICY_DEFAULT = RoundRobinPolicy.name
+
+def getPolicy(spec):
+    '''
+    Returns the DistributionPolicy of a "name[:param]" spec
+    '''
+    if(isinstance(spec, DistributionPolicy)):
+        return spec
+
+    name, _, param = str(spec).partition(":")
+    if(not name in POLICIES):
+        raise ValueError("Unknown distribution policy: "+name+" (known: "+", ".join(POLICIES.keys())+")")
+
+    return POLICIES[name](param if param != "" else None)
+
+
+class HashRing(object):
+    '''
+    Consistent hashing of the packet keys over the outputs
+    Each output owns VNODES points of the ring (placed by its name), a key goes to the owner of the next point:
+    adding or removing an output only moves the keys of the points it gains or loses
+    '''
+
+    VNODES = 64
+
+    def __init__(self, vnodes = VNODES):
+        self.vnodes = vnodes
+        self.points = [] #sorted hashes
+        self.owners = {} #hash: output
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode()).digest()[:8], 'big')
+
+    def add(self, output, name):
+        for i in range(self.vnodes):
+            h = self.hash(name+"#"+str(i))
+            if(not h in self.owners):
+                self.points.insert(bisect(self.points, h), h)
+            self.owners[h] = output
+
+    def remove(self, output):
+        self.points = [h for h in self.points if self.owners[h] is not output]
+        self.owners = {h: o for h, o in self.owners.items() if o is not output}
+
+    def lookup(self, key):
+        """
+        Returns the output of the key, None if the ring is empty
+        """
+        if(len(self.points) == 0):
+            return None
+        i = bisect(self.points, self.hash(key)) % len(self.points)
+        return self.owners[self.points[i]]
+
+    def __len__(self):
+        return len(set(self.owners.values()))
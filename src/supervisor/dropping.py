@@ -0,0 +1,176 @@
+'''
+Frames dropped by a Worker whose job allows it (Job.allowDrop) and is too slow
+The policies are applied to the input queue before each packet is taken, specs are "name[:param]" (see getPolicy)
+The packets are stamped with their capture time at the source, kept by the jobs outputs
+
+@author: WIN32GG
+'''
+
+from threading import Lock
+import time
+
+
+CAPTURE_TIME_TAG = "captured" #seconds since the epoch
+
+def streamOf(p):
+    stream = p["from"]
+    return "unknown" if stream is None else str(stream)
+
+
+class DropPolicy(object):
+    '''
+    Chooses the queued packets to drop, the name of the policy is the reason counted for them
+    '''
+    name = None
+
+    def __init__(self, param = None):
+        if(param is not None):
+            raise ValueError("Policy "+self.name+" has no parameter")
+
+    def select(self, lanes, maxsize):
+        """
+        Removes the packets to drop from the Lanes of the queue (bounded by maxsize) and returns them
+        """
+        raise NotImplementedError()
+
+    def spec(self):
+        return self.name
+
+
+class FlushPolicy(DropPolicy):
+    '''
+    All the queued packets once the queue is full, the former behaviour (bursty gaps)
+    '''
+    name = "flush"
+
+    def select(self, lanes, maxsize):
+        dropped = []
+        if(len(lanes) >= maxsize):
+            while(len(lanes) > 0):
+                dropped.append(lanes.popLowest())
+        return dropped
+
+
+class DropOldestPolicy(DropPolicy):
+    '''
+    The oldest packet of the lightest lane while the queue is full
+    '''
+    name = "dropoldest"
+
+    def select(self, lanes, maxsize):
+        dropped = []
+        while(len(lanes) >= maxsize):
+            dropped.append(lanes.popLowest())
+        return dropped
+
+
+class LatestPolicy(DropPolicy):
+    '''
+    Only the latest packet of each stream (its "from" value) is kept, the older ones are superseded
+    '''
+    name = "latest"
+
+    def select(self, lanes, maxsize):
+        dropped = []
+        for q in lanes.queues.values():
+            seen = set()
+            kept = []
+            for p in reversed(q):
+                stream = streamOf(p)
+                if(stream in seen):
+                    dropped.append(p)
+                else:
+                    seen.add(stream)
+                    kept.append(p)
+
+            if(len(dropped) > 0):
+                q.clear()
+                q.extend(reversed(kept))
+        return dropped
+
+
+class DeadlinePolicy(DropPolicy):
+    '''
+    The packets captured more than param milliseconds ago (default DEFAULT_DEADLINE)
+    '''
+    name = "deadline"
+    DEFAULT_DEADLINE = 1000
+
+    def __init__(self, param = None):
+        self.deadline = (self.DEFAULT_DEADLINE if param is None else float(param)) / 1000
+        if(self.deadline <= 0):
+            raise ValueError("The deadline must be positive")
+
+    def select(self, lanes, maxsize):
+        limit = time.time() - self.deadline
+        dropped = []
+        for q in lanes.queues.values():
+            late = [p for p in q if p[CAPTURE_TIME_TAG] is not None and p[CAPTURE_TIME_TAG] < limit]
+            for p in late:
+                q.remove(p)
+            dropped += late
+        return dropped
+
+    def spec(self):
+        return self.name+":"+str(int(self.deadline * 1000))
+
+
+class DropStats(object):
+    '''
+    Count of the dropped frames per reason and per stream
+    '''
+
+    def __init__(self):
+        self.counts = {} #reason: {stream: count}
+        self.lock = Lock()
+
+    def add(self, p, reason):
+        stream = streamOf(p)
+        with self.lock:
+            byStream = self.counts.setdefault(reason, {})
+            byStream[stream] = byStream.get(stream, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            byStream = {}
+            for reason, counts in self.counts.items():
+                for stream, n in counts.items():
+                    byStream.setdefault(stream, {})[reason] = n
+            return {
+                    "total": sum(sum(c.values()) for c in self.counts.values()),
+                    "by_reason": {reason: sum(c.values()) for reason, c in self.counts.items()},
+                    "by_stream": byStream
+                }
+
+
+POLICIES = {}
+
+def registerPolicy(policyClass):
+    POLICIES[policyClass.name] = policyClass
+    return policyClass
+
+for _p in [FlushPolicy, DropOldestPolicy, LatestPolicy, DeadlinePolicy]:
+    registerPolicy(_p)
+
+POLICY_DEFAULT = DropOldestPolicy.name
+
+def getPolicy(spec):
+    '''
+    Returns the DropPolicy of a "name[:param]" spec
+    '''
+    if(isinstance(spec, DropPolicy)):
+        return spec
+
+    name, _, param = str(spec).partition(":")
+    if(not name in POLICIES):
+        raise ValueError("Unknown drop policy: "+name+" (known: "+", ".join(POLICIES.keys())+")")
+
+    return POLICIES[name](param if param != "" else None)
+
+def getPolicies(specs):
+    '''
+    Returns the DropPolicy list of a spec or a list of specs, applied in turn (eg ["latest", "deadline:500"])
+    '''
+    if(not isinstance(specs, list)):
+        specs = [specs]
+    return [getPolicy(spec) for spec in specs]
@@ -8,8 +8,22 @@ class Detector:
 		self.meta = dn.load_meta(meta)
 
 	def run(self, image_array):
-		image = self._array_to_image(image_array)
-		results = dn.detect(self.net, self.meta, image)
+		return self.run_batch([image_array])[0]
+
+	def run_batch(self, image_arrays):
+		"""
+		Detections of each image, the images of the same shape are converted at once
+		and the detection buffers are made once for the batch
+		"""
+		results = [None] * len(image_arrays)
+		by_shape = {}
+		for i, image_array in enumerate(image_arrays):
+			by_shape.setdefault(image_array.shape, []).append(i)
+
+		for shape, indexes in by_shape.items():
+			images, planes = dn.image_planes([image_arrays[i] for i in indexes])
+			for i, r in zip(indexes, dn.detect_batch(self.net, self.meta, images)):
+				results[i] = r
 		return results
 
 	def draw_boxes(self, results, image_array):
@@ -41,16 +55,6 @@ class Detector:
 				pass
 		return image_array
 
-	def _array_to_image(self, image_array):
-		image_array = image_array.transpose(2,0,1)
-		c = image_array.shape[0]
-		h = image_array.shape[1]
-		w = image_array.shape[2]
-		image_array = (image_array/255.0).flatten()
-		data = dn.c_array(dn.c_float, image_array)
-		image = dn.IMAGE(w,h,c,data)
-		return image
-
 if __name__ == '__main__':
 	from scipy.misc import imread, imsave
 	from time import time
@@ -23,10 +23,15 @@ class Boxerjob(Job):
 		
 		
 	def loop(self, data):
-		image = data.img
+		return self._annotate(data, self.detector.run(data.img))
 
-		results = self.detector.run(image)
-		image = self.detector.draw_boxes(results, image)
+	def loop_batch(self, packets):
+		# one call for the frames of several cameras (jobbatch of the worker)
+		results = self.detector.run_batch([p.img for p in packets])
+		return [self._annotate(p, r) for p, r in zip(packets, results)]
+
+	def _annotate(self, data, results):
+		image = self.detector.draw_boxes(results, data.img)
 		
 		data['img'] = image # COMMENT OUT TO UNDO BOXES DRAWING
 		data['detection'] = encode_results(results)
@@ -129,12 +129,11 @@ class Stopwatch:
         
         return t
 
-def detect(net, meta, image, thresh=.2, hier_thresh=.5, nms=.45):
+def make_buffers(net):
+    """
+    Boxes and probabilities filled by a detection, can be reused by the next ones (see detect_batch)
+    """
     sw = Stopwatch()
-    debug("Darknet running on image...", 2)
-    
-    debug("DARKNET TIMINGS", 3)
-
     boxes = make_boxes(net)
     debug("MAKE_BOXES "+str(sw.get_time()), 3)
 
@@ -143,6 +142,45 @@ def detect(net, meta, image, thresh=.2, hier_thresh=.5, nms=.45):
 
     num =   num_boxes(net)
     debug("NUM_BOXES "+str(sw.get_time()), 3)
+    return boxes, probs, num
+
+def free_buffers(buffers):
+    boxes, probs, num = buffers
+    free_ptrs(cast(probs, POINTER(c_void_p)), num)
+
+def image_planes(image_arrays):
+    """
+    Darknet images of the (h, w, c) uint8 arrays of the same shape, converted at once
+    Returns the images and the float planes holding their data (to keep until the detection is done)
+    """
+    planes = np.ascontiguousarray(np.stack(image_arrays).transpose(0, 3, 1, 2), dtype=np.float32)
+    planes /= 255.0
+    n, c, h, w = planes.shape
+    return [IMAGE(w, h, c, planes[k].ctypes.data_as(POINTER(c_float))) for k in range(n)], planes
+
+def detect(net, meta, image, thresh=.2, hier_thresh=.5, nms=.45):
+    buffers = make_buffers(net)
+    try:
+        return detect_with(net, meta, image, buffers, thresh, hier_thresh, nms)
+    finally:
+        free_buffers(buffers)
+
+def detect_batch(net, meta, images, thresh=.2, hier_thresh=.5, nms=.45):
+    """
+    Detections of several images, the buffers are made once for all of them
+    """
+    buffers = make_buffers(net)
+    try:
+        return [detect_with(net, meta, image, buffers, thresh, hier_thresh, nms) for image in images]
+    finally:
+        free_buffers(buffers)
+
+def detect_with(net, meta, image, buffers, thresh=.2, hier_thresh=.5, nms=.45):
+    sw = Stopwatch()
+    debug("Darknet running on image...", 2)
+    
+    debug("DARKNET TIMINGS", 3)
+    boxes, probs, num = buffers
 
     network_detect(net, image, thresh, hier_thresh, nms, boxes, probs)
     debug("DETECTION "+str(sw.get_time()), 3)
@@ -155,6 +193,4 @@ def detect(net, meta, image, thresh=.2, hier_thresh=.5, nms=.45):
                 res.append((meta.names[i], probs[j][i], (boxes[j].x, boxes[j].y, boxes[j].w, boxes[j].h)))
     debug("LABELISATION "+str(sw.get_time()), 3)
     res = sorted(res, key=lambda x: -x[1])
-
-    free_ptrs(cast(probs, POINTER(c_void_p)), num)
     return res
@@ -3,22 +3,46 @@
 @author: WIN32GG
 '''
 
+import time
+
 from worker import Job
 import numpy as np
 
 class Generatenpjob(Job):
+    '''
+    Outputs random frames then stops
+    jobdata (optional): {"frames": count, "shape": [h, w, c], "random": false to send the same frame each time,
+                         "rate": frames per second (default as fast as possible)}
+    '''
+    
+    FRAMES = 200
+    SHAPE = (1920, 1080, 3)
     
     def setup(self, data):
         self.a = 0
+        options = data if isinstance(data, dict) else {}
+        self.frames = int(options.get("frames", self.FRAMES))
+        self.shape = tuple(options.get("shape", self.SHAPE))
+        self.period = 1 / float(options["rate"]) if options.get("rate") else 0
+        self.next = time.time()
+        self.frame = None
+        if(not options.get("random", True)): #the generation is not measured
+            self.frame = np.random.randint(0, 255, size = self.shape, dtype="uint8")
     
     def loop(self, data):
         self.a += 1
         
-        if(self.a > 200):
+        if(self.a > self.frames):
             self.shouldStop = True
             return None
         
-        return np.random.randint(0, 255, size = (1920, 1080, 3), dtype="uint8")
+        if(self.period > 0):
+            self.next += self.period
+            time.sleep(max(0, self.next - time.time()))
+        
+        if(self.frame is not None):
+            return self.frame
+        return np.random.randint(0, 255, size = self.shape, dtype="uint8")
     
     def requireData(self):
         return False
\ No newline at end of file
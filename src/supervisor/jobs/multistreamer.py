@@ -7,6 +7,7 @@ from utils.config_checker import checkConfigSanity
 from utils.custom_logging import debug, _DEBUG_LEVEL
 from utils.streamer import *
 from worker import Job
+from lanes import LANE_LIVE, LANE_ARCHIVE, PRIORITY_TAG
 
 
 #import utils.custom_logging.#profiler as #prof
@@ -25,7 +26,7 @@ def checkMultiStreamerConfigSanity(cfgTxt):
     return checkConfigSanity(cfgTxt, [], ["stream", "options", "folders"])
     
 def checkStreamerConfigSanity(cfgTxt):
-    return checkConfigSanity(cfgTxt, ["name"], ["url", "path", "resolution", "recursive", "realtime"])
+    return checkConfigSanity(cfgTxt, ["name"], ["url", "path", "resolution", "recursive", "realtime", "priority"])
 
 def getWithDefault(obj, propName, default = None):
     try:
@@ -81,7 +82,7 @@ class Multistreamer(Job):
     
         if('stream'in self.cfg):
             for streamerInfo in self.cfg['stream']:
-                self.startStreamer(streamerInfo)
+                self.startStreamer(streamerInfo, LANE_LIVE)
             
         if('folders' in self.cfg):
             #prof.enter("FOLDER_EXPLORATION")
@@ -129,11 +130,11 @@ class Multistreamer(Job):
             return None
 
         try:
-            self.startStreamer(streamerInfo)
+            self.startStreamer(streamerInfo, LANE_ARCHIVE)
         except:
             traceback.print_exc()
 
-    def startStreamer(self, streamerInfo):
+    def startStreamer(self, streamerInfo, priority = LANE_LIVE):
         if(not checkStreamerConfigSanity(json.dumps(streamerInfo))):
             raise ValueError("Error in configuration")
 
@@ -142,6 +143,7 @@ class Multistreamer(Job):
         name       = getWithDefault(streamerInfo, "name", "streamer"+str(self.streamerCount))
         location   = getWithDefault(streamerInfo, "url")
         realtime   = getWithDefault(streamerInfo, "realtime", self.options[self.REALTIME_TAG])
+        priority   = getWithDefault(streamerInfo, "priority", priority) #lane of its frames, see lanes.py
 
         if(location == None):
             location = getWithDefault(streamerInfo, "path")
@@ -158,6 +160,7 @@ class Multistreamer(Job):
                 traceback.print_exc()
             return
 
+        streamer.priority = priority
         self.streamers.append(streamer)
         self.streamerCount += 1
 
@@ -189,5 +192,6 @@ class Multistreamer(Job):
         return {
                 "from" : str(streamer.name),
                 "frame_count": str(streamer.img_count),
+                PRIORITY_TAG: streamer.priority,
                 "img": img2
             }
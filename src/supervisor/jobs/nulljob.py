@@ -0,0 +1,20 @@
+'''
+
+@author: WIN32GG
+'''
+
+from worker import Job
+
+class Nulljob(Job):
+    '''
+    Consumes its input and outputs nothing, the end of a benchmark pipeline
+    '''
+    
+    def loop(self, data):
+        return None
+    
+    def requireData(self):
+        return True
+    
+    def allowDrop(self):
+        return False
\ No newline at end of file
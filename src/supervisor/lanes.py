@@ -0,0 +1,140 @@
+'''
+Priority lanes of the packets
+The "priority" value of a packet names its lane (eg "live" for the cameras, "archive" for the recorded videos),
+the queues of the Worker serve the lanes by weighted round robin, the heaviest lanes first:
+a packet of a higher lane waits for at most a few packets of the lower ones
+
+@author: WIN32GG
+'''
+
+from collections import deque
+import queue
+
+
+PRIORITY_TAG = "priority"
+
+LANE_LIVE = "live"
+LANE_DEFAULT = "default" #packets without priority
+LANE_ARCHIVE = "archive"
+WEIGHTS_DEFAULT = {LANE_LIVE: 8, LANE_DEFAULT: 4, LANE_ARCHIVE: 1}
+
+def checkWeights(weights):
+    '''
+    Returns the {lane: weight} dict, the weights are integers of at least 1
+    '''
+    if(not isinstance(weights, dict) or len(weights) == 0):
+        raise ValueError("Lane weights must be a dict of lane: weight")
+
+    checked = {}
+    for lane, w in weights.items():
+        if(int(w) < 1):
+            raise ValueError("Weight of lane "+str(lane)+" must be at least 1")
+        checked[str(lane)] = int(w)
+    return checked
+
+
+class Lanes:
+    '''
+    FIFO per lane, popped by weighted round robin
+    Each round serves up to weight items of each lane, from the heaviest lane to the lightest
+    '''
+
+    def __init__(self, weights = None):
+        self.queues = {}
+        self.setWeights(WEIGHTS_DEFAULT if weights == None else weights)
+
+    def setWeights(self, weights):
+        """
+        Changes the lanes, the items of a removed lane go to the lightest one
+        """
+        weights = checkWeights(weights)
+        order = sorted(weights.keys(), key = lambda lane: -weights[lane]) #stable: ties keep the given order
+        queues = {lane: self.queues.get(lane, deque()) for lane in order}
+        for lane, q in self.queues.items():
+            if(not lane in queues):
+                queues[order[-1]].extend(q)
+
+        self.weights = weights
+        self.order = order
+        self.queues = queues
+        self.turn = 0 #lane being served
+        self.served = 0 #items of this lane served in the round
+
+    def laneOf(self, p):
+        """
+        Lane of a packet: its priority, the default lane (or the lightest) if it is not a lane
+        """
+        lane = p[PRIORITY_TAG]
+        if(lane in self.queues):
+            return lane
+        return LANE_DEFAULT if LANE_DEFAULT in self.queues else self.order[-1]
+
+    def append(self, item, lane):
+        self.queues[lane].append(item)
+
+    def popleft(self):
+        for _ in range(len(self.order) + 1):
+            lane = self.order[self.turn]
+            if(self.served < self.weights[lane] and len(self.queues[lane]) > 0):
+                self.served += 1
+                return self.queues[lane].popleft()
+
+            self.turn = (self.turn + 1) % len(self.order) #next lane, or next round
+            self.served = 0
+
+        raise IndexError("pop from empty lanes")
+
+    def popLowest(self):
+        """
+        Oldest item of the lightest non empty lane, to make room
+        """
+        for lane in reversed(self.order):
+            if(len(self.queues[lane]) > 0):
+                return self.queues[lane].popleft()
+        raise IndexError("pop from empty lanes")
+
+    def __len__(self):
+        return sum(len(q) for q in self.queues.values())
+
+    def stats(self):
+        return {lane: len(self.queues[lane]) for lane in self.order}
+
+
+class LaneQueue(queue.Queue):
+    '''
+    queue.Queue of packets served by lanes (see Lanes), maxsize bounds all the lanes together
+    '''
+
+    def __init__(self, maxsize = 0, weights = None):
+        self.initialWeights = weights
+        queue.Queue.__init__(self, maxsize)
+
+    def _init(self, maxsize):
+        self.lanes = Lanes(self.initialWeights)
+
+    def _qsize(self):
+        return len(self.lanes)
+
+    def _put(self, p):
+        self.lanes.append(p, self.lanes.laneOf(p))
+
+    def _get(self):
+        return self.lanes.popleft()
+
+    def setWeights(self, weights):
+        with self.mutex:
+            self.lanes.setWeights(weights)
+
+    def drop(self, select):
+        """
+        Removes the items chosen by select(lanes) (see dropping.py), returns them
+        """
+        with self.mutex:
+            dropped = select(self.lanes)
+            if(len(dropped) > 0):
+                self.not_full.notify_all()
+            return dropped
+
+    def stats(self):
+        with self.mutex:
+            return self.lanes.stats()
@@ -17,7 +17,9 @@ from time import sleep
 import traceback
 
 import network
-from utils import config_checker
+import monitor
+from utils import config, config_checker
+from utils import custom_logging
 from utils.custom_logging import _DEBUG_LEVEL
 from utils.custom_logging import debug
 from worker import SupervisedProcessStream
@@ -26,9 +28,10 @@ from worker import SupervisedProcessStream
 
 class RemoteSupervisor:
     
-    def __init__(self, name, addr):
+    def __init__(self, name, addr, localSocket = False):
         self.addr = addr
         self.name = name
+        self.localSocket = localSocket #workers of this unit plugged through their unix socket
         
     def _test(self, testConnect = True):
         #prof.enter("SUPERVISOR_TEST")
@@ -110,6 +113,29 @@ class RemoteSupervisor:
         debug("OK")
         
         return answ
+    
+    def query(self, obj, timeout = None):
+        """
+        Sends obj and returns the answer, None if the supervisor is unreachable
+        """
+        sock = self._connect()
+        if(sock == None):
+            return None
+        
+        try:
+            sock.settimeout(timeout)
+            chan = sock.makefile("rwb")
+            network.sendString(chan, json.dumps(obj))
+            return network.readString(chan)
+        except:
+            if(_DEBUG_LEVEL >= 3):
+                traceback.print_exc()
+            return None
+        finally:
+            try:
+                self._close(sock)
+            except:
+                pass
 
 def loadSupervisors(cfg):
     debug("Master config sanity check...")
@@ -119,10 +145,10 @@ def loadSupervisors(cfg):
     objCfg = json.loads(cfg)  
     
     debug("Loading Supervisors...")
-    return loadUnits(objCfg['units'])        
+    return loadUnits(objCfg['units'], int(objCfg.get('supervisorport', config.SUPERVISOR_PORT)))
         
  
-def loadUnits(units, port = 55555):
+def loadUnits(units, defaultPort = config.SUPERVISOR_PORT):
     #prof.enter("UNITS_LOAD")
     rsup = {}
     
@@ -135,10 +161,9 @@ def loadUnits(units, port = 55555):
         adr = u['address'].split(":")
 
         a = adr[0]
-        if(len(adr) == 2):
-            port = int(adr[1])
+        port = int(adr[1]) if len(adr) == 2 else defaultPort
         
-        rs = RemoteSupervisor(name, (a, port)) 
+        rs = RemoteSupervisor(name, (a, port), u.get('localsocket', False)) 
         rs._test()
         rsup[name] = rs
         debug("Supervisor "+name+": OK", 2)
@@ -166,7 +191,10 @@ def loadWorkerDistributionSequence(workers, rsup):
                 out = output[i]
                 buildWorkerSequence(seq, workerDict, out)
                 
-                trueOut = workerSuper[out].addr[0]+":"+str(workerDict[out]['port'])
+                if(workerSuper[out] is workerSuper[currentWorker] and workerSuper[out].localSocket):
+                    trueOut = network.LOCAL_SOCKET_PREFIX+str(workerDict[out]['port']) #resolved by the worker, its temp directory may differ
+                else:
+                    trueOut = workerSuper[out].addr[0]+":"+str(workerDict[out]['port'])
                 debug("Resolved "+out+" to "+trueOut)
                 output[i] = trueOut
                 
@@ -232,6 +260,18 @@ def pushConfig(objCfg, rSup):
         sleep(.5)
 
 
+def monitorCluster(objCfg, rSup):
+    """
+    Polls the workers stats every refreshinterval seconds and shows them until interrupted
+    """
+    custom_logging._DEBUG_LEVEL = 0 #the table is the output
+    interval = float(objCfg.get('refreshinterval', monitor.DEFAULT_REFRESH_INTERVAL))
+    try:
+        monitor.ClusterMonitor(rSup, interval).run()
+    except KeyboardInterrupt:
+        pass
+
+
 def read(fil):
     fd = open(fil, "r")
     d = ""
@@ -268,11 +308,15 @@ if __name__ == '__main__':
         rSup = loadSupervisors(cfg)
         objCfg = json.loads(cfg)
         
-        if("action" in objCfg.keys()):
+        if(objCfg.get("action") == "monitor"):
+            monitorCluster(objCfg, rSup)
+        elif("action" in objCfg.keys()):
             answ = pushAction(objCfg, rSup)
             print(answ)
         else:
             pushConfig(objCfg, rSup)
+            if(len(sys.argv) > 2 and sys.argv[2] == "monitor"):
+                monitorCluster(objCfg, rSup)
         
         
     except Exception as e:
@@ -0,0 +1,104 @@
+'''
+Metrics registry of the Worker: meters (packets and bytes, with their rate per second),
+latency histograms and gauges (read when the snapshot is taken)
+The snapshot is part of the worker stats, see the stats action
+
+@author: WIN32GG
+'''
+
+from collections import deque
+from threading import Lock
+import time
+
+from tracing import LatencyHistogram
+
+
+class Meter(object):
+    '''
+    Count and bytes of the marked events, the rates are over the last WINDOW seconds
+    '''
+
+    WINDOW = 5
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.samples = deque([(time.time(), 0, 0)]) #(time, count, bytes), about one per second
+        self.lock = Lock()
+
+    def mark(self, n = 1, nbytes = 0):
+        now = time.time()
+        with self.lock:
+            self.count += n
+            self.bytes += nbytes
+            if(now - self.samples[-1][0] >= 1):
+                self.samples.append((now, self.count, self.bytes))
+                while(len(self.samples) > self.WINDOW + 1):
+                    self.samples.popleft()
+
+    def stats(self):
+        now = time.time()
+        with self.lock:
+            t, count, nbytes = self.samples[0]
+            elapsed = max(now - t, 1e-6)
+            return {
+                    "count": self.count,
+                    "bytes": self.bytes,
+                    "per_s": round((self.count - count) / elapsed, 3),
+                    "bytes_per_s": round((self.bytes - nbytes) / elapsed, 3)
+                }
+
+
+class MetricsRegistry(object):
+    '''
+    Named meters, histograms (of seconds) and gauges, created on first use
+    '''
+
+    def __init__(self):
+        self.meters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = Lock()
+
+    def meter(self, name):
+        with self.lock:
+            if(not name in self.meters):
+                self.meters[name] = Meter()
+            return self.meters[name]
+
+    def histogram(self, name):
+        with self.lock:
+            if(not name in self.histograms):
+                self.histograms[name] = LatencyHistogram()
+            return self.histograms[name]
+
+    def time(self, name, seconds):
+        h = self.histogram(name)
+        with self.lock:
+            h.add(seconds)
+
+    def gauge(self, name, read):
+        """
+        read() gives the value of the gauge
+        """
+        with self.lock:
+            self.gauges[name] = read
+
+    def snapshot(self):
+        with self.lock:
+            meters = list(self.meters.items())
+            histograms = {name: h.stats() for name, h in self.histograms.items()}
+            gauges = list(self.gauges.items())
+
+        values = {}
+        for name, read in gauges:
+            try:
+                values[name] = read()
+            except:
+                values[name] = None
+
+        return {
+                "meters": {name: m.stats() for name, m in meters},
+                "histograms": histograms,
+                "gauges": values
+            }
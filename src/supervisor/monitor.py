@@ -0,0 +1,203 @@
+'''
+Monitor mode of the master: polls the stats of all the workers through their supervisors
+and shows them as a table refreshed in place (like top), along with the bottleneck of the pipeline
+
+@author: WIN32GG
+'''
+
+import json
+import sys
+import time
+
+
+DEFAULT_REFRESH_INTERVAL = 2 #seconds
+QUERY_TIMEOUT = 15 #seconds for a supervisor to gather the stats of its workers
+STAGES_SHOWN = 8
+
+CLEAR = "\033[2J\033[H"
+
+
+def _get(d, *keys):
+    for k in keys:
+        if(not isinstance(d, dict) or not k in d):
+            return None
+        d = d[k]
+    return d
+
+def _fmt(value, digits = 1):
+    if(value is None):
+        return "-"
+    if(isinstance(value, float)):
+        return str(round(value, digits))
+    return str(value)
+
+
+class WorkerView(object):
+    '''
+    The figures of a worker shown by the monitor, from its stats and the ones of the previous poll
+    '''
+
+    def __init__(self, unit, name, stats, previous = None, now = None):
+        self.unit = unit
+        self.name = name
+        self.stats = stats
+        self.time = time.time() if now is None else now
+
+        meters = _get(stats, "metrics", "meters") or {}
+        self.fpsIn = _get(meters, "packets_in", "per_s")
+        self.fpsOut = _get(meters, "packets_out", "per_s")
+        byteRate = _get(meters, "packets_in", "bytes_per_s")
+        if(byteRate is None): #source worker
+            byteRate = sum(m["bytes_per_s"] for n, m in meters.items() if n.startswith("link_out/")) if meters else None
+        self.mbps = None if byteRate is None else byteRate / 1e6
+
+        gauges = _get(stats, "metrics", "gauges") or {}
+        self.inputQueue = gauges.get("input_queue")
+        self.outputQueue = gauges.get("output_queue")
+        self.queueSize = gauges.get("queue_size")
+        senders = gauges.get("sender_queues") or {}
+        self.senderQueues = sum(senders.values()) if senders else 0
+
+        loop = _get(stats, "metrics", "histograms", "loop") or {}
+        self.loopP50 = loop.get("p50_ms")
+        self.loopP99 = loop.get("p99_ms")
+        self.ackP99 = _get(stats, "metrics", "histograms", "ack_wait", "p99_ms")
+        self.drops = _get(stats, "drops", "total")
+
+        #share of the time spent in the job loop since the previous poll
+        self.loopTotal = (loop.get("count") or 0) * (loop.get("mean_ms") or 0)
+        self.busy = None
+        if(previous is not None and self.time > previous.time):
+            self.busy = max(0, self.loopTotal - previous.loopTotal) / 1000 / (self.time - previous.time)
+
+    def stages(self):
+        return _get(self.stats, "tracing", "stages") or {}
+
+    def pressure(self):
+        """
+        Returns (score, cause), score from 0 to 1: the job loop busy time, or how full its queues are
+        A full input queue means the worker can not keep up, a full output queue that its outputs can not
+        """
+        candidates = [(self.busy or 0, "job loop busy "+_fmt(None if self.busy is None else self.busy * 100, 0)+"%")]
+        if(self.queueSize):
+            candidates.append(((self.inputQueue or 0) / self.queueSize, "input queue "+_fmt(self.inputQueue)+"/"+str(self.queueSize)))
+            candidates.append(((self.outputQueue or 0) / self.queueSize, "output queue "+_fmt(self.outputQueue)+"/"+str(self.queueSize)
+                               +", sending or outputs too slow"))
+        return max(candidates, key = lambda c: c[0])
+
+
+class ClusterMonitor(object):
+    '''
+    Polls the RemoteSupervisors every interval seconds and renders the table
+    '''
+
+    COLUMNS = [("UNIT", 10), ("WORKER", 14), ("IN/s", 7), ("OUT/s", 7), ("MB/s", 7), ("INQ", 5), ("OUTQ", 5),
+               ("SENDQ", 6), ("LOOP p50", 9), ("LOOP p99", 9), ("ACK p99", 8), ("BUSY%", 6), ("DROPS", 6)]
+
+    def __init__(self, rSup, interval = DEFAULT_REFRESH_INTERVAL, out = None):
+        self.rSup = rSup
+        self.interval = interval
+        self.out = out or sys.__stdout__
+        self.views = {} #worker name: WorkerView
+        self.unreachable = []
+
+    def poll(self):
+        views = {}
+        self.unreachable = []
+        for unit, sup in self.rSup.items():
+            answ = sup.query({"action": "stats"}, QUERY_TIMEOUT)
+            try:
+                workers = json.loads(answ)
+            except:
+                self.unreachable.append(unit)
+                continue
+
+            now = time.time()
+            for name, stats in workers.items():
+                views[name] = WorkerView(unit, name, stats, self.views.get(name), now)
+        self.views = views
+        return views
+
+    def bottleneck(self):
+        """
+        Returns (worker view, cause, stage name, stage stats): the worker under the most pressure and the slowest traced stage,
+        None if unknown
+        """
+        worst, cause = None, None
+        for v in self.views.values():
+            score, c = v.pressure()
+            if(score > 0 and (worst is None or score > worst[0])):
+                worst, cause = (score, v), c
+
+        stage, stageStats = self._slowestStage()
+        return None if worst is None else worst[1], cause, stage, stageStats
+
+    def _stages(self):
+        """
+        {stage: stats} of all the traced stages, the worker having the most traces of a stage gives its figures
+        """
+        stages = {}
+        for v in self.views.values():
+            for stage, s in v.stages().items():
+                if(not stage in stages or s["count"] > stages[stage]["count"]):
+                    stages[stage] = s
+        return stages
+
+    def _slowestStage(self):
+        slowest = (None, None)
+        for stage, s in self._stages().items():
+            if(stage == "total" or s.get("p50_ms") is None):
+                continue
+            if(slowest[0] is None or s["p50_ms"] > slowest[1]["p50_ms"]):
+                slowest = (stage, s)
+        return slowest
+
+    def _row(self, values):
+        return " ".join(str(v)[:w].rjust(w) if i > 1 else str(v)[:w].ljust(w)
+                        for i, (v, (_, w)) in enumerate(zip(values, self.COLUMNS)))
+
+    def render(self):
+        lines = [time.strftime("%Y-%m-%d %H:%M:%S")+"  "+str(len(self.views))+" workers on "+str(len(self.rSup))+" units"
+                 +" (refresh "+str(self.interval)+" s)", ""]
+        lines.append(self._row([c for c, _ in self.COLUMNS]))
+
+        for unit in self.rSup.keys():
+            if(unit in self.unreachable):
+                lines.append(self._row([unit, "unreachable"] + [""] * (len(self.COLUMNS) - 2)))
+                continue
+
+            views = sorted([v for v in self.views.values() if v.unit == unit], key = lambda v: v.name)
+            for v in views:
+                lines.append(self._row([unit, v.name, _fmt(v.fpsIn), _fmt(v.fpsOut), _fmt(v.mbps, 2), _fmt(v.inputQueue),
+                                        _fmt(v.outputQueue), _fmt(v.senderQueues), _fmt(v.loopP50), _fmt(v.loopP99),
+                                        _fmt(v.ackP99), _fmt(None if v.busy is None else v.busy * 100, 0), _fmt(v.drops)]))
+            if(len(views) > 1):
+                total = lambda attr: sum(getattr(v, attr) or 0 for v in views)
+                lines.append(self._row([unit, "(total)", _fmt(total("fpsIn")), _fmt(total("fpsOut")), _fmt(total("mbps"), 2),
+                                        _fmt(total("inputQueue")), _fmt(total("outputQueue")), _fmt(total("senderQueues")),
+                                        "", "", "", "", _fmt(total("drops"))]))
+
+        stages = sorted(self._stages().items(), key = lambda item: -(item[1].get("p50_ms") or 0))
+        if(len(stages) > 0):
+            lines += ["", "STAGE".ljust(40)+" COUNT".rjust(8)+" p50 ms".rjust(9)+" p99 ms".rjust(9)]
+            for stage, s in stages[:STAGES_SHOWN]:
+                lines.append(stage[:40].ljust(40)+_fmt(s["count"]).rjust(8)+_fmt(s["p50_ms"]).rjust(9)+_fmt(s["p99_ms"]).rjust(9))
+
+        worst, cause, stage, stageStats = self.bottleneck()
+        lines.append("")
+        if(worst is not None):
+            lines.append("Bottleneck: "+worst.name+" ("+worst.unit+"), "+cause)
+        if(stage is not None):
+            lines.append("Slowest stage: "+stage+" (p50 "+_fmt(stageStats["p50_ms"])+" ms, p99 "+_fmt(stageStats["p99_ms"])+" ms)")
+        if(worst is None and stage is None):
+            lines.append("Bottleneck: waiting for a second poll (enable tracing for the stage latencies)")
+
+        return "\n".join(lines)+"\n"
+
+    def run(self):
+        while(True):
+            self.poll()
+            screen = self.render()
+            self.out.write((CLEAR if self.out.isatty() else "\n") + screen)
+            self.out.flush()
+            time.sleep(self.interval)
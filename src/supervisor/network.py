@@ -6,16 +6,99 @@ Created on 28 nov. 2017
 
 import hashlib
 import json
+import lzma
+import os
+import socket
 import struct
+import tempfile
+import zlib
 
 from utils.custom_logging import _DEBUG_LEVEL
 from utils.custom_logging import debug
 import numpy as np
+import PIL.Image as Image
 import time
 import io
+from threading import Condition, Lock
+
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError: #python < 3.8, links over the sockets only
+    resource_tracker = None
+    shared_memory = None
 
 OK = "ok"
 
+#ack channel, from an input to its sender
+ACK = b'a' #a packet has been processed, one credit back
+CREDITS = b'c' #followed by the number of credits granted (2 bytes)
+
+SENDMSG_MAX_BUFFERS = 1024 #IOV_MAX on linux
+
+def sendBuffers(sock, buffers):
+    '''
+    Sends the buffers as they are over the socket, with scatter/gather (sendmsg) when available
+    '''
+    views = [memoryview(b).cast('B') for b in buffers if len(b) > 0]
+    
+    if(not hasattr(sock, "sendmsg")):
+        for v in views:
+            sock.sendall(v)
+        return
+    
+    i = 0 #first view not fully sent
+    while(i < len(views)):
+        n = sock.sendmsg(views[i:i + SENDMSG_MAX_BUFFERS])
+        #skips what has been sent
+        while(n > 0):
+            if(n >= len(views[i])):
+                n -= len(views[i])
+                i += 1
+            else:
+                views[i] = views[i][n:]
+                n = 0
+
+def writeBuffers(binChan, buffers):
+    '''
+    Writes the buffers one after the other in a binary file object, without joining them
+    (a buffered writer passes the large ones through to the raw stream)
+    '''
+    for b in buffers:
+        v = memoryview(b).cast('B')
+        while(len(v) > 0):
+            v = v[binChan.write(v):] #a raw stream can write part of it
+    binChan.flush()
+
+LOCAL_SOCKET_PREFIX = "unix:"
+
+def localSocketPath(port):
+    '''
+    Path of the unix socket a worker listens on along with its tcp port
+    '''
+    return os.path.join(tempfile.gettempdir(), "tidmarsh_worker_"+str(port)+".sock")
+
+def parseAddress(adr):
+    '''
+    Output address of the config: "host:port", "unix:port" or "unix:path", returns (host, port) or the path
+    "unix:port" is a worker of this host: plugged through its unix socket (in the temp directory of this host), else through tcp
+    '''
+    if(adr.startswith(LOCAL_SOCKET_PREFIX)):
+        local = adr[len(LOCAL_SOCKET_PREFIX):]
+        return ("127.0.0.1", int(local)) if local.isdigit() else local
+    
+    host, port = adr.rsplit(":", 1)
+    return (host, int(port))
+
+def isLocalHost(host):
+    '''
+    True if host resolves to an address of this host
+    '''
+    try:
+        ip = socket.gethostbyname(host)
+        return ip.startswith("127.") or ip in socket.gethostbyname_ex(socket.gethostname())[2]
+    except OSError:
+        return False
+
 def readString(fo):
     header = struct.Struct("i")
     l = header.unpack(fo.read(header.size))[0]
@@ -28,52 +111,1005 @@ def sendString(fo, string):
     fo.flush()
     
 
+IMAGE_KEYS = ["img", "image", "bin"]
+
+def _flatBuffer(npImg):
+    '''
+    Returns the (ndarray, memoryview) over the bytes of the image in memory order
+    Only non contiguous arrays are copied
+    '''
+    if(not npImg.flags.c_contiguous and not npImg.flags.f_contiguous):
+        npImg = np.ascontiguousarray(npImg)
+    
+    return npImg, memoryview(npImg.ravel(order = 'K')).cast('B')
+
+
+class Codec(object):
+    '''
+    Encodes an image (numpy.ndarray) to bytes for the network and back
+    The codec name is written in the packet header, the optional parameter
+    (compression level, quality...) is given after a ':' in the codec spec (eg "zlib:9")
+    '''
+    
+    name = None
+    lossy = False
+    stateful = False #encodes depending on the previous packets, one instance per link
+    headerKeys = [] #header values set by encode
+    
+    def __init__(self, param = None):
+        self.param = param
+    
+    def encode(self, p, npImg):
+        """
+        Returns the bytes-like object to send, extra header values can be set on p
+        """
+        raise NotImplementedError("Encoding not implemented")
+    
+    def decode(self, p, buf):
+        """
+        Returns the numpy.ndarray from the received buffer
+        """
+        raise NotImplementedError("Decoding not implemented")
+    
+    def spec(self):
+        return self.name if self.param == None else self.name+":"+str(self.param)
+    
+    def reset(self, key = None):
+        """
+        Forgets the state of the stream key (of all the streams if None), its next frame is encoded on its own
+        """
+        pass
+    
+    def stats(self):
+        return None
+
+class NpzCodec(Codec):
+    '''
+    numpy compressed archive
+    '''
+    name = "npz"
+    
+    def encode(self, p, npImg):
+        stream = io.BytesIO()
+        np.savez_compressed(stream, npImg)
+        return stream.getbuffer()
+    
+    def decode(self, p, buf):
+        return np.load(io.BytesIO(buf))['arr_0'].reshape(p["shape"])
+
+class RawCodec(Codec):
+    '''
+    ndarray buffer sent as is, described by dtype/shape/strides
+    '''
+    name = "raw"
+    headerKeys = ["strides"]
+    
+    def encode(self, p, npImg):
+        npImg, buf = _flatBuffer(npImg)
+        p["strides"] = npImg.strides
+        return buf
+    
+    def decode(self, p, buf):
+        #no copy: the array is a view on the received buffer
+        return np.ndarray(shape = p["shape"], dtype = p["dtype"], buffer = buf, strides = p["strides"])
+
+class ZlibCodec(RawCodec):
+    '''
+    raw buffer compressed with zlib, param is the compression level (0-9)
+    '''
+    name = "zlib"
+    
+    def encode(self, p, npImg):
+        level = zlib.Z_DEFAULT_COMPRESSION if self.param == None else int(self.param)
+        return zlib.compress(RawCodec.encode(self, p, npImg), level)
+    
+    def decode(self, p, buf):
+        return RawCodec.decode(self, p, bytearray(zlib.decompress(buf)))
+
+class LzmaCodec(RawCodec):
+    '''
+    raw buffer compressed with lzma, param is the preset (0-9)
+    '''
+    name = "lzma"
+    
+    def encode(self, p, npImg):
+        preset = None if self.param == None else int(self.param)
+        return lzma.compress(RawCodec.encode(self, p, npImg), preset = preset)
+    
+    def decode(self, p, buf):
+        return RawCodec.decode(self, p, bytearray(lzma.decompress(buf)))
+
+class PilCodec(Codec):
+    '''
+    Image format handled by PIL, only for uint8 gray, RGB or RGBA images
+    '''
+    
+    pilFormat = None
+    
+    def _saveArgs(self):
+        return {}
+    
+    def encode(self, p, npImg):
+        if(npImg.dtype != np.uint8):
+            raise ValueError("Codec "+self.name+" requires uint8 images")
+        
+        stream = io.BytesIO()
+        Image.fromarray(npImg).save(stream, self.pilFormat, **self._saveArgs())
+        return stream.getbuffer()
+    
+    def decode(self, p, buf):
+        return np.array(Image.open(io.BytesIO(buf)))
+
+class PngCodec(PilCodec):
+    '''
+    lossless PNG, param is the compression level (0-9)
+    '''
+    name = "png"
+    pilFormat = "PNG"
+    
+    def _saveArgs(self):
+        return {} if self.param == None else {"compress_level": int(self.param)}
+
+class JpegCodec(PilCodec):
+    '''
+    lossy JPEG, param is the quality (1-95)
+    '''
+    name = "jpeg"
+    pilFormat = "JPEG"
+    lossy = True
+    
+    def _saveArgs(self):
+        return {} if self.param == None else {"quality": int(self.param)}
+
+class DeltaCodec(Codec):
+    '''
+    keyframe + changed blocks for fixed cameras, param is the keyframe interval
+    A reference frame is kept for each stream (the packet 'from' value) on both ends
+    so each output link needs its own instance and must receive all the packets of the stream
+    
+    keyframe: the raw image (C order)
+    delta:    the packed bit mask of the changed BLOCKxBLOCK blocks, then these blocks
+    '''
+    name = "delta"
+    stateful = True
+    headerKeys = ["keyframe", "seq", "refseq"]
+    
+    BLOCK = 16
+    DEFAULT_KEYFRAME_INTERVAL = 30
+    
+    def __init__(self, param = None):
+        Codec.__init__(self, param)
+        self.interval = self.DEFAULT_KEYFRAME_INTERVAL if param == None else max(1, int(param))
+        self.streams = {} #key: [seq, padded reference frame, shape]
+        self.streamStats = {} #key: stats dict
+    
+    def _padded(self, npImg):
+        B = self.BLOCK
+        h, w = npImg.shape[:2]
+        out = np.zeros((-(-h // B) * B, -(-w // B) * B) + npImg.shape[2:], dtype = npImg.dtype)
+        out[:h, :w] = npImg
+        return out
+    
+    def _blocks(self, padded):
+        #view (rows, cols, BLOCK, BLOCK, ...)
+        B = self.BLOCK
+        H, W = padded.shape[:2]
+        return padded.reshape((H // B, B, W // B, B) + padded.shape[2:]).swapaxes(1, 2)
+    
+    def encode(self, p, npImg):
+        if(npImg.ndim < 2):
+            raise ValueError("Codec delta requires images")
+        
+        key = p.streamKey
+        state = self.streams.get(key)
+        stats = self.streamStats.setdefault(key, {"frames": 0, "keyframes": 0, "raw_bytes": 0, "sent_bytes": 0, "saved": 0.0})
+        
+        if(state == None or state[2] != npImg.shape or state[1].dtype != npImg.dtype or (state[0] + 1) % self.interval == 0):
+            seq = 0 if state == None else state[0] + 1
+            self.streams[key] = [seq, self._padded(npImg), npImg.shape]
+            p["keyframe"] = True
+            p["seq"] = seq
+            p.data.pop("refseq", None)
+            buf = memoryview(np.ascontiguousarray(npImg).reshape(-1)).cast('B')
+            stats["keyframes"] += 1
+        else:
+            seq = state[0] + 1
+            ref = self._blocks(state[1])
+            cur = self._blocks(self._padded(npImg))
+            changed = (cur != ref).reshape(ref.shape[:2] + (-1,)).any(axis = 2)
+            blocks = cur[changed]
+            ref[changed] = blocks #what the receiver will have
+            state[0] = seq
+            
+            p["keyframe"] = False
+            p["seq"] = seq
+            p["refseq"] = seq - 1
+            buf = np.packbits(changed).tobytes() + blocks.tobytes()
+        
+        stats["frames"] += 1
+        stats["raw_bytes"] += npImg.nbytes
+        stats["sent_bytes"] += len(buf)
+        stats["saved"] = 1 - stats["sent_bytes"] / max(1, stats["raw_bytes"])
+        return buf
+    
+    def decode(self, p, buf):
+        key = p.streamKey
+        shape = tuple(p["shape"])
+        dtype = np.dtype(p["dtype"])
+        
+        if(p["keyframe"]):
+            img = np.frombuffer(buf, dtype = dtype).reshape(shape)
+            self.streams[key] = [p["seq"], self._padded(img), shape]
+            return img.copy() #the job may draw on it, the reference must stay untouched
+        
+        state = self.streams.get(key)
+        if(state == None or state[0] != p["refseq"] or state[2] != shape):
+            raise ValueError("Missing reference frame for stream "+str(key))
+        
+        ref = self._blocks(state[1])
+        n = ref.shape[0] * ref.shape[1]
+        maskLen = -(-n // 8)
+        changed = np.unpackbits(np.frombuffer(buf[:maskLen], dtype = np.uint8), count = n).reshape(ref.shape[:2]).astype(bool)
+        ref[changed] = np.frombuffer(buf[maskLen:], dtype = dtype).reshape((-1,) + ref.shape[2:])
+        state[0] = p["seq"]
+        
+        return state[1][:shape[0], :shape[1]].copy()
+    
+    def reset(self, key = None):
+        if(key == None):
+            self.streams.clear()
+        else:
+            self.streams.pop(key, None)
+    
+    def stats(self):
+        return self.streamStats
+
+#codec registry, name: Codec class
+CODECS = {}
+
+def registerCodec(codecClass):
+    CODECS[codecClass.name] = codecClass
+
+for _c in [NpzCodec, RawCodec, ZlibCodec, LzmaCodec, PngCodec, JpegCodec, DeltaCodec]:
+    registerCodec(_c)
+
+CODEC_NPZ = NpzCodec.name #default
+CODEC_RAW = RawCodec.name
+
+def getCodec(spec, cache = None):
+    '''
+    Returns the Codec for the given spec "name" or "name:param"
+    cache (name: Codec) keeps the instances of a link, needed by the stateful codecs
+    '''
+    if(isinstance(spec, Codec)):
+        return spec
+    
+    a = str(spec).split(":", 1)
+    if(not a[0] in CODECS):
+        raise ValueError("Unknown codec: "+str(a[0]))
+    
+    if(cache != None and spec in cache):
+        return cache[spec]
+    
+    codec = CODECS[a[0]](a[1] if len(a) == 2 else None)
+    if(cache != None):
+        cache[spec] = codec
+    return codec
+
+#Integrity checks of the binary payload, name: function(bytes) -> str
+INTEGRITY_CHECKS = {
+        "none": None,
+        "crc32": lambda b: format(zlib.crc32(b), "08x"),
+        "adler32": lambda b: format(zlib.adler32(b), "08x"),
+        "sha1": lambda b: hashlib.sha1(b).hexdigest()
+    }
+
+INTEGRITY_DEFAULT = "sha1"
+
+class IntegrityCheck(object):
+    '''
+    Signs and verifies the binary payload of the packets
+    Built from a spec "name" or "name:N" to only sign every Nth packet (sampling)
+    Keeps track of the number of packets checked and of the time spent doing so
+    '''
+    
+    def __init__(self, spec = INTEGRITY_DEFAULT):
+        a = str(spec).split(":", 1)
+        if(not a[0] in INTEGRITY_CHECKS):
+            raise ValueError("Unknown integrity check: "+str(a[0]))
+        
+        self.name = a[0]
+        self.interval = max(1, int(a[1])) if len(a) == 2 else 1
+        self.count = 0
+        
+        self.checked = 0
+        self.failed = 0
+        self.time = 0.0
+    
+    def spec(self):
+        return self.name if self.interval == 1 else self.name+":"+str(self.interval)
+    
+    def sign(self, p):
+        """
+        Sets the checksum of p and of its attachments, or removes them if this packet is not sampled
+        """
+        self.count += 1
+        sampled = INTEGRITY_CHECKS[self.name] != None and (self.count - 1) % self.interval == 0
+        for q in p.parts():
+            self._sign(q, sampled)
+    
+    def _sign(self, p, sampled):
+        if(not sampled or p.binObj is None):
+            p.data.pop("integrity", None)
+            p.data.pop("checksum", None)
+            return
+        
+        st = time.time() #always over the bytes sent: a forwarded payload may have been modified in place
+        p["integrity"] = self.name
+        p["checksum"] = INTEGRITY_CHECKS[self.name](p.binObj)
+        self.time += time.time() - st
+        self.checked += 1
+    
+    def verify(self, p):
+        """
+        Checks the payload of p and of its attachments against their checksum, raises ValueError on mismatch
+        Packets without checksum are not verified
+        """
+        for q in p.parts():
+            self._verify(q)
+    
+    def _verify(self, p):
+        if(p["checksum"] == None):
+            return
+        
+        name = p["integrity"] or INTEGRITY_DEFAULT
+        if(not name in INTEGRITY_CHECKS or INTEGRITY_CHECKS[name] == None):
+            raise ValueError("Unknown integrity check: "+str(name))
+        
+        st = time.time()
+        chk = INTEGRITY_CHECKS[name](p.binObj)
+        self.time += time.time() - st
+        self.checked += 1
+        
+        if(_DEBUG_LEVEL == 3):
+            print("Check = "+str(chk))
+        
+        if(chk != p["checksum"]):
+            self.failed += 1
+            raise ValueError("Error in transmission: checksums do not match")
+        if(_DEBUG_LEVEL == 3):
+            print("Checksum pass")
+    
+    def stats(self):
+        return {"check": self.spec(), "checked": self.checked, "failed": self.failed, "time": self.time}
+
 '''
 Create a Packet holding the image provided as numpy.ndarray
 '''
-def createImagePacket(p, npImg):
+def createImagePacket(p, npImg, codec = CODEC_NPZ):
+    codec = getCodec(codec)
+    
     p["isImage"]   = True
     p["shape"] = npImg.shape
     p["dtype"] = npImg.dtype.name
-    p["checksum"] = hashlib.sha1(npImg).hexdigest()
-    
-    #compression
-    stream = io.BytesIO()
-    np.savez_compressed(stream, npImg)
-    stream.seek(0)
+    p["codec"] = codec.name
+    for c in CODECS.values():
+        for k in c.headerKeys:
+            p.data.pop(k, None)
+    p.data.pop("integrity", None)
+    p.data.pop("checksum", None)
     
-    p.binObj = stream.read()
+    p.binObj = codec.encode(p, npImg)
+    #signed later (IntegrityCheck.sign), on the sent bytes so it holds for lossy codecs
     
     return p
     
 '''
-Read the given packet and returns the 
+Read the given packet and sets the decoded images in pck.img and in its attachments
 '''
-def readImagePacket(pck):
-    if(not pck["isImage"]):
-        return None
+def readImagePacket(pck, integrity = None, codecs = None):
+    (integrity or IntegrityCheck()).verify(pck)
+    
+    pck.setStreamKeys()
+    for q in pck.parts():
+        if(q["isImage"]):
+            codec = getCodec(q["codec"] or CODEC_NPZ, codecs)
+            q.img = codec.decode(q, q.binObj)
+
+
+#Packet header formats
+HEADER_JSON = "json" #8 bytes length + json, also the fallback
+HEADER_BINARY = "binary"
+HEADER_FORMATS = [HEADER_JSON, HEADER_BINARY]
+
+class BinaryHeader:
+    '''
+    Versioned binary encoding of the Packet header (the data dict)
+    
+    prefix: MAGIC (2 bytes), version (1 byte), unused (1 byte), body length (uint32)
+            the json header starts with its 8 bytes length whose first byte is always 0 
+    body:   binLen (uint64), flags (1 byte), then the fixed image fields (if FLAG_IMAGE):
+                codec, dtype, ndim (1 byte), shape (uint32 each), strides (int64 each, if FLAG_STRIDES)
+            then the integrity fields (if FLAG_CHECKSUM): integrity, checksum (raw bytes if FLAG_HEX_CHECKSUM)
+            then the free form keys: count (uint16), [key, typed value]...
+    keys and fixed strings are stored with a 1 byte length
+    typed values are a 1 byte type tag followed by the value (see _packValue)
+    '''
     
-    #img = np.frombuffer(pck.binObj, dtype=pck["dtype"])
-    inBytes = io.BytesIO()
-    inBytes.write(pck.binObj)
-    inBytes.seek(0)
+    MAGIC = b"\xb1\x4e"
+    VERSION = 1
     
-    img = np.load(inBytes)['arr_0']
+    PREFIX = struct.Struct(">2sBxI")
+    FIXED = struct.Struct(">QB")
+    
+    FLAG_IMAGE = 1
+    FLAG_STRIDES = 2
+    FLAG_CHECKSUM = 4
+    FLAG_HEX_CHECKSUM = 8
+    
+    NO_FIELDS = ["binLen"] #Packet.BINARY_DATA_LENGTH_TAG, in the fixed fields
+    IMAGE_FIELDS = NO_FIELDS + ["isImage", "codec", "dtype", "shape", "strides"]
+    CHECKSUM_FIELDS = ["integrity", "checksum"]
+    
+    _U16 = struct.Struct(">H")
+    _U32 = struct.Struct(">I")
+    _I64 = struct.Struct(">q")
+    _F64 = struct.Struct(">d")
+    _TAG_I64 = struct.Struct(">cq")
+    _TAG_F64 = struct.Struct(">cd")
+    _TAG_U32 = struct.Struct(">cI")
+    
+    @classmethod
+    def isBinary(cls, prefix):
+        return prefix[:2] == cls.MAGIC
+    
+    @staticmethod
+    def _packShort(out, s):
+        b = s.encode(encoding = "utf-8")
+        if(len(b) > 255):
+            raise ValueError("String too long for the binary header")
+        out.append(len(b))
+        out += b
+    
+    @staticmethod
+    def _readShort(buf, pos):
+        l = buf[pos]
+        pos += 1
+        return str(buf[pos:pos + l], encoding = "utf-8"), pos + l
+    
+    @classmethod
+    def _packValue(cls, out, v):
+        """
+        n: None, t/f: bool, i: int64, d: float64, s: str (uint32 length)
+        l: list/tuple, m: dict with str keys (uint32 count)
+        I, D: list/tuple of int64 or float64 only (uint32 count), packed at once
+        """
+        t = type(v)
+        if(t is str):
+            b = v.encode(encoding = "utf-8")
+            out += cls._TAG_U32.pack(b"s", len(b))
+            out += b
+        elif(t is float):
+            out += cls._TAG_F64.pack(b"d", v)
+        elif(t is bool):
+            out += b"t" if v else b"f"
+        elif(t is int):
+            out += cls._TAG_I64.pack(b"i", v)
+        elif(v is None):
+            out += b"n"
+        elif(t is list or t is tuple):
+            n = len(v)
+            if(n > 0 and all(type(e) is float for e in v)):
+                out += cls._TAG_U32.pack(b"D", n)
+                out += struct.pack(">"+str(n)+"d", *v)
+            elif(n > 0 and all(type(e) is int for e in v)):
+                out += cls._TAG_U32.pack(b"I", n)
+                out += struct.pack(">"+str(n)+"q", *v)
+            else:
+                out += cls._TAG_U32.pack(b"l", n)
+                for e in v:
+                    cls._packValue(out, e)
+        elif(t is dict):
+            out += cls._TAG_U32.pack(b"m", len(v))
+            for k, e in v.items():
+                if(type(k) is not str):
+                    raise TypeError("Only str keys are supported in the binary header")
+                cls._packShort(out, k)
+                cls._packValue(out, e)
+        else:
+            raise TypeError("Unsupported type in the binary header: "+str(t))
+    
+    @classmethod
+    def _readValue(cls, buf, pos):
+        t = buf[pos]
+        pos += 1
+        if(t == 0x73): #s
+            l = cls._U32.unpack_from(buf, pos)[0]
+            pos += 4
+            return str(buf[pos:pos + l], encoding = "utf-8"), pos + l
+        if(t == 0x64): #d
+            return cls._F64.unpack_from(buf, pos)[0], pos + 8
+        if(t == 0x69): #i
+            return cls._I64.unpack_from(buf, pos)[0], pos + 8
+        if(t == 0x74): #t
+            return True, pos
+        if(t == 0x66): #f
+            return False, pos
+        if(t == 0x6e): #n
+            return None, pos
+        
+        n = cls._U32.unpack_from(buf, pos)[0]
+        pos += 4
+        if(t == 0x44): #D
+            return list(struct.unpack_from(">"+str(n)+"d", buf, pos)), pos + 8 * n
+        if(t == 0x49): #I
+            return list(struct.unpack_from(">"+str(n)+"q", buf, pos)), pos + 8 * n
+        if(t == 0x6c): #l
+            l = []
+            for _ in range(n):
+                v, pos = cls._readValue(buf, pos)
+                l.append(v)
+            return l, pos
+        if(t == 0x6d): #m
+            d = {}
+            for _ in range(n):
+                k, pos = cls._readShort(buf, pos)
+                d[k], pos = cls._readValue(buf, pos)
+            return d, pos
+        
+        raise ValueError("Unknown type in the binary header: "+repr(chr(t)))
+    
+    @classmethod
+    def _packImageFields(cls, out, data):
+        """
+        Packs the fixed image fields, returns the flags or 0 if data does not hold them
+        """
+        if(data.get("isImage") is not True):
+            return 0
+        codec, dtype, shape = data.get("codec"), data.get("dtype"), data.get("shape")
+        if(type(codec) is not str or type(dtype) is not str or type(shape) not in (list, tuple) or len(shape) > 255):
+            return 0
+        
+        ndim = str(len(shape))
+        try:
+            shapeBytes = struct.pack(">"+ndim+"I", *shape) #rejects negative and non int dims
+        except struct.error:
+            return 0
+        
+        flags = cls.FLAG_IMAGE
+        cls._packShort(out, codec)
+        cls._packShort(out, dtype)
+        out.append(len(shape))
+        out += shapeBytes
+        
+        strides = data.get("strides")
+        if(type(strides) in (list, tuple) and len(strides) == len(shape)):
+            try:
+                out += struct.pack(">"+ndim+"q", *strides)
+                flags |= cls.FLAG_STRIDES
+            except struct.error:
+                pass
+        
+        return flags
+    
+    @classmethod
+    def pack(cls, data, binLen):
+        """
+        Returns the bytes of the header (prefix included)
+        Raises TypeError, ValueError or struct.error if a value cannot be encoded, 
+        the json header must be used instead
+        """
+        out = bytearray(cls.PREFIX.size + cls.FIXED.size)
+        flags = cls._packImageFields(out, data)
+        skip = cls.IMAGE_FIELDS if flags & cls.FLAG_STRIDES else cls.IMAGE_FIELDS[:-1] if flags else cls.NO_FIELDS
+        
+        integrity, checksum = data.get("integrity"), data.get("checksum")
+        if(type(integrity) is str and type(checksum) is str):
+            flags |= cls.FLAG_CHECKSUM
+            skip = skip + cls.CHECKSUM_FIELDS
+            cls._packShort(out, integrity)
+            try:
+                raw = bytes.fromhex(checksum)
+                if(raw.hex() != checksum): #not lower case hex, kept as is
+                    raise ValueError()
+                flags |= cls.FLAG_HEX_CHECKSUM
+                out.append(len(raw))
+                out += raw
+            except ValueError:
+                cls._packShort(out, checksum)
+        
+        keys = [k for k in data if not k in skip]
+        out += cls._U16.pack(len(keys))
+        for k in keys:
+            cls._packShort(out, k)
+            cls._packValue(out, data[k])
+        
+        cls.PREFIX.pack_into(out, 0, cls.MAGIC, cls.VERSION, len(out) - cls.PREFIX.size)
+        cls.FIXED.pack_into(out, cls.PREFIX.size, binLen, flags)
+        return out
+    
+    @classmethod
+    def unpack(cls, prefix, binChan):
+        """
+        Reads the header body following the given prefix, returns the data dict
+        """
+        return cls.unpackBody(binChan.read(cls.bodyLength(prefix)))
+    
+    @classmethod
+    def bodyLength(cls, prefix):
+        magic, version, l = cls.PREFIX.unpack(prefix)
+        if(version != cls.VERSION):
+            raise ValueError("Unsupported binary header version: "+str(version))
+        return l
+    
+    @classmethod
+    def unpackBody(cls, buf):
+        binLen, flags = cls.FIXED.unpack_from(buf, 0)
+        pos = cls.FIXED.size
+        data = {Packet.BINARY_DATA_LENGTH_TAG: binLen}
+        
+        if(flags & cls.FLAG_IMAGE):
+            data["isImage"] = True
+            data["codec"], pos = cls._readShort(buf, pos)
+            data["dtype"], pos = cls._readShort(buf, pos)
+            ndim = buf[pos]
+            pos += 1
+            data["shape"] = list(struct.unpack_from(">"+str(ndim)+"I", buf, pos))
+            pos += 4 * ndim
+            if(flags & cls.FLAG_STRIDES):
+                data["strides"] = list(struct.unpack_from(">"+str(ndim)+"q", buf, pos))
+                pos += 8 * ndim
+        
+        if(flags & cls.FLAG_CHECKSUM):
+            data["integrity"], pos = cls._readShort(buf, pos)
+            if(flags & cls.FLAG_HEX_CHECKSUM):
+                l = buf[pos]
+                data["checksum"] = buf[pos + 1:pos + 1 + l].hex()
+                pos += 1 + l
+            else:
+                data["checksum"], pos = cls._readShort(buf, pos)
+        
+        n = cls._U16.unpack_from(buf, pos)[0]
+        pos += 2
+        for _ in range(n):
+            k, pos = cls._readShort(buf, pos)
+            data[k], pos = cls._readValue(buf, pos)
+        
+        return data
+
 
-    #print(hashlib.sha1(img).hexdigest()+" "+pck["checksum"])
-    chk = hashlib.sha1(img).hexdigest()
-    if(_DEBUG_LEVEL == 3):
-        print("Check = "+str(chk))
+def readPrefix(binChan):
+    '''
+    Reads the 8 bytes starting a frame: a packet header or a batch
+    '''
+    prefix = binChan.read(8)
+    if(len(prefix) < 8):
+        raise EOFError("Connection closed while reading header")
+    return prefix
+
+def headerLength(prefix):
+    '''
+    Length of the header following the 8 bytes prefix of a packet
+    '''
+    if(BinaryHeader.isBinary(prefix)):
+        return BinaryHeader.bodyLength(prefix)
+    return int.from_bytes(prefix, 'big') #moins lourd qu'un struct
+
+def parseHeader(prefix, buf):
+    '''
+    Returns the data dict of the header buf following prefix
+    '''
+    if(BinaryHeader.isBinary(prefix)):
+        return BinaryHeader.unpackBody(buf)
+    return json.loads(bytes(buf).decode(encoding = 'utf-8'))
+
+def readPackets(binChan, integrity = None, pool = None, codecs = None, shared = None):
+    '''
+    Reads the next frame from binChan, returns the list of the Packets it holds (one unless batched)
+    shared is the SharedMemoryReader of the connection
+    '''
+    prefix = readPrefix(binChan)
+    count = 1
+    if(PacketBatch.isBatch(prefix)):
+        count = PacketBatch.readCount(prefix)
+        prefix = None
+    
+    packets = []
+    for _ in range(count):
+        p = Packet()
+        p.read(binChan, integrity, pool, prefix, codecs, shared)
+        packets.append(p)
+    
+    return packets
+
+
+class PacketBatch:
+    '''
+    Coalesces several packets of an output link in one frame, sent at once
+    Built from a spec "size" or "size:delay": the frame is sent once it holds size bytes
+    or when its oldest packet waited delay milliseconds (default DEFAULT_DELAY)
+    
+    frame: MAGIC (2 bytes), version (1 byte), unused (1 byte), packet count (uint32), then the packets
+    '''
+    
+    MAGIC = b"\xb1\x42"
+    VERSION = 1
+    PREFIX = struct.Struct(">2sBxI")
+    
+    DEFAULT_DELAY = 5
+    
+    def __init__(self, spec):
+        a = str(spec).split(":", 1)
+        self.maxSize = int(a[0])
+        self.delay = (float(a[1]) if len(a) == 2 else self.DEFAULT_DELAY) / 1000
+        if(self.maxSize <= 0 or self.delay < 0):
+            raise ValueError("Invalid batch spec: "+str(spec))
+        
+        self.packets = []
+        self.buffers = []
+        self.size = 0
+        self.deadline = None
+        self.frames = 0 #sent
+    
+    def spec(self):
+        return str(self.maxSize)+":"+str(self.delay * 1000)
+    
+    @classmethod
+    def isBatch(cls, prefix):
+        return prefix[:2] == cls.MAGIC
+    
+    @classmethod
+    def readCount(cls, prefix):
+        magic, version, count = cls.PREFIX.unpack(prefix)
+        if(version != cls.VERSION):
+            raise ValueError("Unsupported batch version: "+str(version))
+        return count
+    
+    def add(self, p, headerFormat = HEADER_JSON, shared = None, buffers = None):
+        """
+        Adds p (or its buffers, if already serialized) to the frame, returns True if the frame is full and must be flushed
+        """
+        if(buffers is None):
+            buffers = p.buffers(headerFormat, shared)
+        p.retain() #until flushed
+        
+        if(len(self.packets) == 0):
+            self.deadline = time.time() + self.delay
+        self.packets.append(p)
+        self.buffers += buffers
+        self.size += sum(len(b) for b in buffers)
         
-    if(chk != pck["checksum"]):
-        raise ValueError("Error in transmission: checksums do not match")
-    if(_DEBUG_LEVEL == 3):
-        print("Checksum pass")
+        return self.size >= self.maxSize
     
-    img = img.reshape(pck["shape"])
+    def isEmpty(self):
+        return len(self.packets) == 0
     
-    pck.img = img
+    def timeLeft(self):
+        """
+        Seconds until the frame must be flushed, None if it is empty
+        """
+        if(self.isEmpty()):
+            return None
+        return max(0, self.deadline - time.time())
+    
+    def flush(self, sock):
+        """
+        Sends the pending packets as one frame
+        """
+        if(self.isEmpty()):
+            return
+        
+        buffers, packets = self.take()
+        try:
+            sendBuffers(sock, buffers)
+        finally:
+            for p in packets:
+                p.release()
+    
+    def take(self):
+        """
+        Empties the batch, returns the buffers of its frame and its packets (to release once sent)
+        """
+        buffers = self.buffers
+        if(len(self.packets) > 1): #else no need for a batch frame
+            buffers = [self.PREFIX.pack(self.MAGIC, self.VERSION, len(self.packets))] + buffers
+        packets = self.packets
+        
+        self.frames += 1
+        self.packets = []
+        self.buffers = []
+        self.size = 0
+        self.deadline = None
+        return buffers, packets
+
 
+class BufferPool:
+    '''
+    Receive buffers of one connection
+    A buffer goes back to the pool once its Packet has been processed (Packet.release)
+    New buffers are sized to the recent frame size so that they can be reused for the next frames
+    '''
+    
+    MAX_FREE = 8
+    SIZE_DECAY = 0.9
+    
+    def __init__(self):
+        self.free = []
+        self.frameSize = 0 #decaying max of the requested sizes
+        self.allocated = 0
+        self.lock = Lock()
+    
+    def get(self, size):
+        """
+        Returns a bytearray of at least size bytes
+        """
+        with self.lock:
+            self.frameSize = max(size, int(self.frameSize * self.SIZE_DECAY))
+            while(len(self.free) > 0):
+                buf = self.free.pop()
+                if(len(buf) >= size and len(buf) <= 2 * self.frameSize):
+                    return buf
+                #out of date size, dropped
+            
+            self.allocated += 1
+            return bytearray(self.frameSize)
+    
+    def release(self, buf):
+        with self.lock:
+            if(len(self.free) < self.MAX_FREE):
+                self.free.append(buf)
+
+
+class SharedMemoryRing:
+    '''
+    Sender side of a link to a worker of the same host
+    The payloads of a packet are written once in a slot (shared memory segment), only the
+    header with the slot reference crosses the socket, the receiver reads the payloads in place
+    A slot is reused when the receiver released its packet (RELEASE message on the ack channel)
+    '''
+    
+    SLOTS = 16
+    GROWTH = 1.25 #headroom when a slot is resized
+    
+    def __init__(self, slots = SLOTS):
+        self.segments = [None] * slots
+        self.free = list(range(slots))
+        self.closed = False
+        self.written = 0 #packets
+        self.waits = 0 #no free slot
+        self.cond = Condition()
+    
+    def write(self, payloads):
+        """
+        Copies the payloads one after the other in a free slot, blocks until one is available
+        Returns the slot reference put in the header [segment name, slot index]
+        """
+        size = sum(len(b) for b in payloads)
+        with self.cond:
+            if(len(self.free) == 0):
+                self.waits += 1
+            while(len(self.free) == 0 and not self.closed):
+                self.cond.wait(1)
+            if(self.closed):
+                raise EOFError("Shared memory link closed")
+            index = self.free.pop()
+        
+        seg = self.segments[index]
+        if(seg == None or seg.size < size):
+            if(seg != None):
+                seg.close()
+                seg.unlink()
+            seg = shared_memory.SharedMemory(create = True, size = max(1, int(size * self.GROWTH)))
+            self.segments[index] = seg
+        
+        off = 0
+        for b in payloads:
+            v = memoryview(b).cast('B')
+            seg.buf[off:off + len(v)] = v
+            off += len(v)
+        
+        self.written += 1
+        return [seg.name, index]
+    
+    def releaseSlot(self, index):
+        with self.cond:
+            self.free.append(index)
+            self.cond.notify()
+    
+    def shutdown(self):
+        """
+        Wakes up the writers waiting for a slot, the link is lost
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+    
+    def close(self):
+        """
+        Frees the segments, the receiver keeps its mapping of them until it is done
+        """
+        self.shutdown()
+        for seg in self.segments:
+            if(seg != None):
+                seg.close()
+                seg.unlink()
+        self.segments = [None] * len(self.segments)
+    
+    def stats(self):
+        return {"slots": len(self.segments), "written": self.written, "waits": self.waits,
+                "bytes": sum(seg.size for seg in self.segments if seg != None)}
+    
+    @staticmethod
+    def available():
+        return shared_memory != None
+    
+    @staticmethod
+    def isLocal(sock):
+        """
+        True if the connected socket goes to this host
+        """
+        if(sock.family == getattr(socket, "AF_UNIX", None)):
+            return True
+        try:
+            return sock.getsockname()[0] == sock.getpeername()[0]
+        except OSError:
+            return False
+
+
+class SharedMemoryReader:
+    '''
+    Receiver side of the shared memory links of one connection: maps the slots of the sender
+    and gives them back (Packet.release) with a RELEASE message on the ack channel
+    '''
+    
+    RELEASE = b'r' #followed by the slot index (2 bytes)
+    
+    def __init__(self, ackChan):
+        self.ackChan = ackChan
+        self.segments = {} #slot index: SharedMemory
+    
+    def open(self, ref):
+        """
+        Returns a view on the slot designated by ref [segment name, slot index]
+        """
+        name, index = ref
+        seg = self.segments.get(index)
+        if(seg == None or seg.name != name):
+            if(seg != None):
+                self._close(seg)
+            seg = self._attach(name)
+            self.segments[index] = seg
+        
+        return seg.buf
+    
+    def _attach(self, name):
+        try:
+            return shared_memory.SharedMemory(name = name, track = False)
+        except TypeError: #before python 3.13: the sender owns the segment, not our resource tracker
+            seg = shared_memory.SharedMemory(name = name)
+            resource_tracker.unregister(seg._name, "shared_memory")
+            return seg
+    
+    def _close(self, seg):
+        try:
+            seg.close()
+        except BufferError:
+            pass #an image is still viewing it, unmapped with it
+    
+    def release(self, index):
+        try:
+            self.ackChan.write(self.RELEASE + index.to_bytes(2, 'big')) #one write, the acks can be sent concurrently
+            self.ackChan.flush()
+        except (OSError, ValueError):
+            pass #connection lost, the sender frees its slots
+    
+    def close(self):
+        for seg in self.segments.values():
+            self._close(seg)
+        self.segments = {}
+
+
+_refsLock = Lock()
 
 class Packet:
     '''
@@ -86,17 +1122,31 @@ class Packet:
     BIN_RECV_FULL = True
 
     BINARY_DATA_LENGTH_TAG = "binLen"
+    ATTACHMENTS_TAG = "attachments"
+    SHARED_MEMORY_TAG = "shm" #slot holding the payloads
 
-    RESERVED_NAMES = [BINARY_DATA_LENGTH_TAG]
+    RESERVED_NAMES = [BINARY_DATA_LENGTH_TAG, ATTACHMENTS_TAG, SHARED_MEMORY_TAG]
 
     def __init__(self):
         self.data = { self.BINARY_DATA_LENGTH_TAG: 0}
         self.binObj = None
+        self.img = None
+        self.attachments = {} #name: Packet holding the attached ndarray (img) or bytes (binObj)
+        self._pool = None #BufferPool (or SharedMemoryReader) of binObj, if any
+        self._buffer = None
+        self._refs = 1 #holders of the receive buffers, see retain
+        self.streamKey = None #set by setStreamKeys
+        self.source = None #ack channel of the input connection it came from
+        self.received = None #time it was read from this connection
+        self._origin = None #packet copied, held until this copy is released
 
     def __str__(self):
-        return json.dumps(self.data) + " binHash = "+ ("0" if self.binObj == None else str(hash(self.binObj)))
+        return json.dumps(self.data) + " binLen = "+ ("0" if self.binObj is None else str(len(self.binObj))) + \
+            ("" if len(self.attachments) == 0 else " attachments = "+str(list(self.attachments.keys())))
 
     def __getitem__(self, key):
+        if(key in self.attachments):
+            return self.getAttachment(key)
         if(not key in self.data):
             return None
         return self.data[key]
@@ -107,64 +1157,259 @@ class Packet:
 
         #TODO check types
 
-        if(key in ["img", "image", "bin"]):
-            createImagePacket(self, value)
+        if(key in IMAGE_KEYS):
+            #encoded when sent, with the codec of the output link
+            self.img = value
+            self.binObj = None
+            return
+
+        if(isinstance(value, (np.ndarray, bytes, bytearray, memoryview))):
+            self.attach(key, value)
             return
 
         self.data[key] = value
 
+    def attach(self, name, value):
+        """
+        Attach a numpy.ndarray (encoded with the output codec) or a bytes-like object
+        sent in its own buffer along with the packet
+        """
+        if(name in self.RESERVED_NAMES):
+            raise KeyError("Key name is reserved")
+        
+        sub = Packet()
+        if(isinstance(value, np.ndarray)):
+            sub.img = value
+        else:
+            sub.binObj = value
+        
+        self.data.pop(name, None)
+        self.attachments[name] = sub
+
+    def getAttachment(self, name):
+        sub = self.attachments[name]
+        return sub.binObj if sub.img is None else sub.img
+
+    def parts(self):
+        """
+        This packet and its attachments, each with its own data and binObj
+        """
+        return [self] + list(self.attachments.values())
 
-    def read(self, binChan):
-        l = int.from_bytes(binChan.read(8), 'big') #moins lourd qu'un struct
-        j = binChan.read(l).decode(encoding = 'utf-8')        
+    def setStreamKeys(self):
+        """
+        Names the image stream of each part for the stateful codecs: 'from' value (/attachment name)
+        """
+        self.streamKey = str(self["from"])
+        for name, sub in self.attachments.items():
+            sub.streamKey = self.streamKey+"/"+name
+
+    def encode(self, codec = CODEC_NPZ, integrity = None):
+        """
+        Encode the held images with the given codec and signs them with the IntegrityCheck
+        An image is not encoded again if its binary object is already encoded this way
+        """
+        codec = getCodec(codec)
+        self.setStreamKeys()
+        for q in self.parts():
+            if(q.img is not None and (codec.stateful or q.binObj is None or q["codec"] != codec.name)):
+                createImagePacket(q, q.img, codec)
         
-        self.data = json.loads(j)
+        (integrity or IntegrityCheck()).sign(self)
+
 
-        binSize = int(self.data[self.BINARY_DATA_LENGTH_TAG])
-        if(binSize > 0):
-            self._readBinObject(binChan, binSize)
+    def copy(self):
+        """
+        A packet with the same values, images and payloads, to be encoded differently (eg for an output with another codec)
+        The copy holds the receive buffers of this packet until it is released
+        """
+        q = self._copyPart()
+        for name, sub in self.attachments.items():
+            q.attachments[name] = sub._copyPart()
+        q.source = self.source
+        q.received = self.received
+        self.retain()
+        q._origin = self
+        return q
+
+    def _copyPart(self):
+        q = Packet()
+        q.data = dict(self.data)
+        q.img = self.img
+        q.binObj = self.binObj
+        return q
+
+    def retain(self):
+        """
+        Keeps the receive buffers for one more holder (eg a pending batch), each holder calls release
+        """
+        with _refsLock:
+            self._refs += 1
+
+    def release(self):
+        """
+        Gives the receive buffers back to their pool once all the holders released them
+        binObj and img (when decoded in place) are no longer usable afterwards
+        """
+        with _refsLock:
+            self._refs -= 1
+            if(self._refs > 0):
+                return
+        
+        for q in self.parts():
+            if(q._pool == None):
+                continue
+            
+            q._pool.release(q._buffer)
+            q._pool = None
+            q._buffer = None
+            q.binObj = None
+            q.img = None
+        
+        if(self._origin != None):
+            origin = self._origin
+            self._origin = None
+            origin.release()
+
+    def read(self, binChan, integrity = None, pool = None, prefix = None, codecs = None, shared = None):
+        """
+        Reads the packet from binChan, prefix is the first 8 bytes of the packet if already read
+        codecs (name: Codec) are the decoders of the link, shared its SharedMemoryReader
+        """
+        if(prefix is None):
+            prefix = readPrefix(binChan)
+        
+        self.data = parseHeader(prefix, binChan.read(headerLength(prefix)))
+        for q in self._bodyParts(shared):
+            q._readBinObject(binChan, pool)
+        
+        readImagePacket(self, integrity, codecs)
+    
+    def _bodyParts(self, shared = None):
+        """
+        Sets the attachments described by the header just read
+        Returns the parts whose payload follows on the connection (in order), none if it is in shared memory
+        """
+        attachments = self.data.pop(self.ATTACHMENTS_TAG, {})
+        slot = self.data.pop(self.SHARED_MEMORY_TAG, None)
+        if(slot != None):
+            if(shared == None):
+                raise ValueError("Shared memory packet on a socket only link")
+            view = shared.open(slot)
+            self._pool = shared #one release for all the parts
+            self._buffer = slot[1]
+        
+        #one buffer per attachment, in the header order
+        parts = [self]
+        for name, d in attachments.items():
+            sub = Packet()
+            sub.data = d
+            self.attachments[name] = sub
+            parts.append(sub)
+        
+        if(slot == None):
+            return parts
         
-        readImagePacket(self)
+        off = 0
+        for q in parts:
+            n = q.binLength()
+            if(n > 0):
+                q.binObj = view[off:off + n] #read in place
+            off += n
+        return []
+    
+    def binLength(self):
+        """
+        Length of the payload announced by the header
+        """
+        return int(self.data[self.BINARY_DATA_LENGTH_TAG])
+    
+    def _setBinObject(self, b, pool = None, buf = None):
+        self.binObj = b
+        if(pool != None):
+            self._pool = pool
+            self._buffer = buf
             
-    def _readBinObject(self, binChan, binSize):
-        b = b'' 
+    def _readBinObject(self, binChan, pool = None):
+        binSize = self.binLength()
+        if(binSize <= 0):
+            return
+        
+        #writable, raw images are views on it
+        buf = bytearray(binSize) if pool == None else pool.get(binSize)
+        b = memoryview(buf)[:binSize]
         r = 0
         
         debug("[NETWORK] Reading bin object of "+str(binSize)+" bytes", 3)
         bufSize = binSize if self.BIN_RECV_FULL else self.BIN_READ_MAX
         st = time.time()
         while(r < binSize):
-            if(len(b) + bufSize > binSize):
-                bufSize = binSize - len(b)
+            n = binChan.readinto(b[r:min(r + bufSize, binSize)])
+            if(not n):
+                if(pool != None):
+                    pool.release(buf)
+                raise EOFError("Connection closed while reading bin object")
             
-            a = binChan.read(bufSize)
-
-            b += a
-            r += len(a)
-        debug("READ "+str(len(b)) +" in "+str(time.time()-st), 3)
-        self.binObj = b
+            r += n
+        debug("READ "+str(r) +" in "+str(time.time()-st), 3)
+        self._setBinObject(b, pool, buf)
         
 
-    def send(self, binChan):
-        if(not self.binObj is None and not isinstance(self.binObj, bytes)):
-            raise ValueError("Bin obj must be bytes")
+    def _headerBytes(self, headerFormat, data = None):
+        data = self.data if data is None else data
+        if(headerFormat == HEADER_BINARY):
+            try:
+                return BinaryHeader.pack(data, data[self.BINARY_DATA_LENGTH_TAG])
+            except (TypeError, ValueError, struct.error):
+                debug("Header cannot be binary encoded, using json", 3)
+        
+        msgb = (json.dumps(data)+"\n").encode(encoding = 'utf-8')
+        return len(msgb).to_bytes(8, 'big') + msgb
 
-        if(self.binObj != None):
-            self.data[self.BINARY_DATA_LENGTH_TAG] = len(self.binObj)
+    def buffers(self, headerFormat = HEADER_JSON, shared = None):
+        """
+        Returns the list of buffers to send: header then the payloads
+        With a SharedMemoryRing the payloads are written in one of its slots, only the header is returned
+        Once encoded, the packet can be serialized for several outputs at once (the header is built on a copy)
+        """
+        buffers = [None] #header
+        for q in self.parts():
+            if(q.binObj is None and q.img is not None):
+                self.encode()
             
-        debug("[DEBUG] OUT: "+str(self), 3)
+            if(not q.binObj is None and not isinstance(q.binObj, (bytes, bytearray, memoryview))):
+                raise ValueError("Bin obj must be bytes")
             
-        s = json.dumps(self.data)+"\n"
-        
-        #SENDING
-        b = b'' #message buffer
-        msgb = s.encode(encoding = 'utf-8')
-        b += len(msgb).to_bytes(8, 'big')
-        b += msgb
-        if(self.binObj != None):
-            b += self.binObj
-            
-        debug("[DEBUG] Total packet size is "+str(len(b))+" bytes", 3)
-        binChan.write(b)
-        binChan.flush()
-    
\ No newline at end of file
+            if(q.binObj is not None):
+                q.data[self.BINARY_DATA_LENGTH_TAG] = len(q.binObj)
+                buffers.append(q.binObj)
+            else:
+                q.data[self.BINARY_DATA_LENGTH_TAG] = 0
+        
+        data = dict(self.data)
+        if(len(self.attachments) > 0):
+            data[self.ATTACHMENTS_TAG] = {name: sub.data for name, sub in self.attachments.items()}
+        
+        if(shared != None):
+            data[self.SHARED_MEMORY_TAG] = shared.write(buffers[1:])
+            buffers = buffers[:1]
+        
+        debug("[DEBUG] OUT: "+str(self), 3)
+        
+        buffers[0] = self._headerBytes(headerFormat, data)
+        return buffers
+
+    def send(self, binChan, headerFormat = HEADER_JSON, shared = None):
+        """
+        Sends the packet over binChan, a socket (scatter/gather send) or a binary file object
+        shared is the SharedMemoryRing of the link to a worker of this host
+        """
+        buffers = self.buffers(headerFormat, shared)
+        
+        #SENDING: header and payloads as separate buffers, never joined
+        debug("[DEBUG] Total packet size is "+str(sum(len(b) for b in buffers))+" bytes", 3)
+        if(isinstance(binChan, socket.socket)):
+            sendBuffers(binChan, buffers)
+        else:
+            writeBuffers(binChan, buffers)
+    
\ No newline at end of file
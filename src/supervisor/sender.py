@@ -0,0 +1,175 @@
+'''
+Sender of an output of the Worker
+Each output has its own queue and thread: the packets are handed by reference (serialized once by the dispatcher)
+and a slow output only delays or drops its own packets
+
+The queues are set with a spec "size[:overflow]" (see parseQueueSpec) and are served by priority lanes (see lanes.py)
+
+@author: WIN32GG
+'''
+
+from threading import Condition, Thread
+import time
+import traceback
+
+import lanes
+from utils.custom_logging import _DEBUG_LEVEL
+from utils.custom_logging import debug
+
+
+OVERFLOW_BLOCK = "block" #the dispatcher waits for room, no packet lost
+OVERFLOW_DROP_NEW = "dropnew" #the packet that does not fit is dropped (unless a lighter lane has packets)
+OVERFLOW_DROP_OLDEST = "dropoldest" #the oldest packet of the lightest lane is dropped, for live streams
+OVERFLOWS = [OVERFLOW_BLOCK, OVERFLOW_DROP_NEW, OVERFLOW_DROP_OLDEST]
+
+QUEUE_SPEC_DEFAULT = "8:"+OVERFLOW_BLOCK
+
+def parseQueueSpec(spec):
+    '''
+    Returns (size, overflow) of a "size[:overflow]" spec
+    '''
+    size, _, overflow = str(spec).partition(":")
+    size = int(size)
+    overflow = overflow or OVERFLOW_BLOCK
+    if(size < 1):
+        raise ValueError("Output queue size must be at least 1")
+    if(not overflow in OVERFLOWS):
+        raise ValueError("Unknown overflow policy: "+overflow+" (known: "+", ".join(OVERFLOWS)+")")
+    return size, overflow
+
+
+class OutputSender:
+    '''
+    Queue and thread sending the packets of an output once it has credits
+    The items are (packet, buffers), buffers being None when the sender serializes the packet itself
+    (shared memory, or stateful codec: the packet is then encoded here, once it can no longer be dropped)
+    '''
+
+    IDLE_TIMEOUT = 1 #seconds, when no batch is pending
+
+    def __init__(self, worker, sock, spec = QUEUE_SPEC_DEFAULT, weights = None):
+        self.worker = worker
+        self.sock = sock
+        self.maxSize, self.overflow = parseQueueSpec(spec)
+        self.items = lanes.Lanes(weights)
+        self.cond = Condition()
+        self.closing = False
+        self.sent = 0
+        self.dropped = 0
+        self.thread = Thread(target = self._senderTarget, daemon = True)
+        self.thread.start()
+
+    def spec(self):
+        return str(self.maxSize)+":"+self.overflow
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, p, buffers = None):
+        """
+        Queues p for this output, applying the overflow policy if the queue is full
+        The packet is retained until sent or dropped
+        """
+        p.retain()
+        with self.cond:
+            while(not self.closing and len(self.items) >= self.maxSize and self.overflow == OVERFLOW_BLOCK):
+                self.cond.wait()
+
+            if(self.closing):
+                p.release()
+                return
+
+            lane = self.items.laneOf(p)
+            if(len(self.items) >= self.maxSize):
+                if(self.overflow == OVERFLOW_DROP_NEW and not self._lighterQueued(lane)):
+                    self._drop(p)
+                    return
+                self._drop(self.items.popLowest()[0])
+
+            self.items.append((p, buffers), lane)
+            self.cond.notify_all()
+
+    def setWeights(self, weights):
+        with self.cond:
+            self.items.setWeights(weights)
+
+    def _lighterQueued(self, lane):
+        i = self.items.order.index(lane)
+        return any(len(self.items.queues[l]) > 0 for l in self.items.order[i + 1:])
+
+    def _drop(self, p):
+        self.worker.drops.add(p, "output_overflow")
+        p.release()
+        self.dropped += 1
+        self.worker.outputLoads[self.sock].dropped()
+        debug("Output queue of "+str(self.worker.outputNames.get(self.sock))+" overflow", 2)
+
+    def close(self, timeout = None):
+        """
+        Sends the queued packets (unless the output is lost) then stops the thread
+        """
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+
+    def _next(self):
+        """
+        Returns the next item, None on batch timeout or once closed and empty
+        """
+        batch = self.worker.outputBatches.get(self.sock)
+        with self.cond:
+            if(len(self.items) == 0 and not self.closing):
+                timeout = None if batch == None else batch.timeLeft()
+                self.cond.wait(self.IDLE_TIMEOUT if timeout == None else timeout)
+
+            if(len(self.items) == 0):
+                return None
+
+            item = self.items.popleft()
+            self.cond.notify_all() #room for the dispatcher
+            return item
+
+    def _senderTarget(self):
+        w = self.worker
+        try:
+            while(not self.sock in w.brokenOutputs):
+                item = self._next()
+                if(item == None):
+                    if(self.closing and len(self.items) == 0):
+                        break
+                    w._flushBatch(self.sock, False)
+                    continue
+
+                p, buffers = item
+                try:
+                    if(buffers == None and w.outputCodecs[self.sock].stateful and not w._encodeFor(self.sock, p)):
+                        continue #could not be encoded, dropped
+                    st = time.time()
+                    w.outputWorkerLocks[self.sock].wait() #credits (set as well when the output is lost)
+                    w.metrics.time("credit_wait/"+str(w.outputNames.get(self.sock)), time.time() - st)
+                    w._sendTo(self.sock, p, buffers)
+                    self.sent += 1
+                finally:
+                    p.release()
+
+            if(not self.sock in w.brokenOutputs):
+                w._flushBatch(self.sock)
+        except:
+            if(_DEBUG_LEVEL == 3):
+                traceback.print_exc()
+            w._outputLost(self.sock)
+        finally:
+            with self.cond:
+                self.closing = True
+                while(len(self.items) > 0): #output lost
+                    self.items.popleft()[0].release()
+                self.cond.notify_all()
+
+    def stats(self):
+        return {
+                "queue": self.spec(),
+                "queued": self.items.stats(),
+                "sent": self.sent,
+                "dropped": self.dropped
+            }
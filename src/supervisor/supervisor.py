@@ -6,7 +6,7 @@ import json
 import os
 import signal
 import socket
-from threading import Thread
+from threading import Thread, Lock, Event
 import traceback
 import struct
 
@@ -19,6 +19,8 @@ import sys
 import time
 import subprocess as sp
 
+STATS_TIMEOUT = 5 #seconds for a worker to answer the stats action
+
 def suicide():
     os.kill(os.getpid(), signal.SIGTERM)        
         
@@ -35,6 +37,11 @@ class Supervisor():
         self.running = True
         self.stopping = False
         self.workerConfig = {}
+        self.workerStats = {} #name: last stats line of the worker
+        self.statsEvents = {} #name: Event set when the stats line is read
+        self.statsQueries = {} #name: number of the stats query waited for, echoed in the stats line
+        self.statsQuery = 0
+        self.statsLock = Lock() #one stats query at a time
         
         self.startSupervisorServer()
         
@@ -90,6 +97,42 @@ class Supervisor():
     def action_status(self):
         return json.dumps(list(self.workerConfig.values()))
     
+    def action_stats(self, name = None):
+        """
+        Stats of a worker, or {name: stats} of all the workers
+        """
+        if(name != None):
+            if(not name in self.workers):
+                return "Worker not found: "+str(name)
+            stats = self._queryWorkerStats([name])[name]
+            return "Worker "+str(name)+" did not answer" if stats == None else json.dumps(stats)
+        
+        return json.dumps(self._queryWorkerStats(list(self.workers.keys())))
+    
+    def _queryWorkerStats(self, names, timeout = STATS_TIMEOUT):
+        """
+        {name: stats} of the workers (None if no answer), all queried at once then waited for until the same deadline
+        """
+        with self.statsLock:
+            self.statsQuery += 1 #a late answer to a previous query is ignored
+            events = {}
+            for name in names:
+                event = self.statsEvents.get(name)
+                if(event == None):
+                    continue
+                self.statsQueries[name] = self.statsQuery
+                event.clear()
+                try:
+                    self._sendToWorker(name, json.dumps({"workername": name, "action": "stats", "query": self.statsQuery}))
+                    events[name] = event
+                except:
+                    debug("Could not query the stats of "+str(name), 1, True)
+            
+            deadline = time.time() + timeout
+            for event in events.values():
+                event.wait(max(0, deadline - time.time()))
+            return {name: self.workerStats.get(name) if name in events and events[name].is_set() else None for name in names}
+    
     def _detectSpecialAction(self, cmd):
         try:
             cmd = json.loads(cmd)
@@ -97,6 +140,8 @@ class Supervisor():
                 return None
             
             if("workername" in cmd.keys()): #action is for a worker
+                if(cmd['action'] == "stats"): #answered by the worker
+                    return self.action_stats(cmd['workername'])
                 return None
                       
             actionName = "action_"+cmd['action']
@@ -174,9 +219,12 @@ class Supervisor():
         
     def _workerManagementThreadTarget(self, workerConfig, name):
         debug("[WORKER-MGM] Starting worker process...")        
-        proc = sp.Popen([config.PYTHON_CMD, "worker.py"], stdin=sp.PIPE, universal_newlines=True)
+        env = dict(os.environ, PYTHONUNBUFFERED="1") #the output is relayed line by line
+        proc = sp.Popen([config.PYTHON_CMD, "worker.py"], stdin=sp.PIPE, stdout=sp.PIPE, universal_newlines=True, env=env)
         self.workers[name] = proc
         self.workerConfig[name] = workerConfig
+        self.statsEvents[name] = Event()
+        Thread(target=self._workerOutputTarget, args=(name, proc), daemon=True).start()
         debug("[WORKER-MGM] Worker "+name+" started with pid "+str(proc.pid))
         self._sendToWorker(name, workerConfig)
         
@@ -184,6 +232,33 @@ class Supervisor():
         debug("[WORKER-MGM] Worker "+name+" ("+str(proc.pid)+") exited with errcode "+str(proc.poll()))
         del self.workers[name]   
         del self.workerConfig[name]
+        self.statsEvents.pop(name, None)
+        self.statsQueries.pop(name, None)
+        self.workerStats.pop(name, None)
+        
+    def _workerOutputTarget(self, name, proc):
+        """
+        Relays the output of the worker, keeps its stats lines (not relayed)
+        """
+        for line in proc.stdout:
+            i = line.find(worker.STATS_TAG)
+            if(i < 0):
+                sys.__stdout__.write(line)
+                sys.__stdout__.flush()
+                continue
+            
+            try:
+                stats = json.loads(line[i+len(worker.STATS_TAG):])
+            except:
+                debug("Unreadable stats from "+name, 1, True)
+                continue
+            if(stats.pop("query", None) != self.statsQueries.get(name)):
+                debug("Late stats from "+name+", ignored", 1)
+                continue
+            self.workerStats[name] = stats
+            event = self.statsEvents.get(name)
+            if(event != None):
+                event.set()
            
     def _sendToWorker(self, wname, config):
         debug("[SUPERVISOR] Sending config to worker")
@@ -224,4 +299,4 @@ if __name__ == '__main__':
             
         
                     
-    
\ No newline at end of file
+    
\ No newline at end of file
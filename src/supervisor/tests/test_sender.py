@@ -0,0 +1,132 @@
+'''
+OutputSender with a stateful codec (delta): every frame the output receives must decode,
+whatever the queue dropped or failed to encode
+
+Run from src/supervisor: python3 -m unittest discover tests
+
+@author: WIN32GG
+'''
+
+import os
+import sys
+from threading import Event
+import time
+import unittest
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import distribution
+import dropping
+import metrics
+import network
+import sender
+import worker
+
+
+SOCK = "output"
+
+class FakeWorker(object):
+    '''
+    What an OutputSender uses of its Worker, the sent packets are kept as (header, payload)
+    '''
+
+    _encodeFor = worker.Worker._encodeFor
+    _encodeFailed = worker.Worker._encodeFailed
+
+    def __init__(self, codec):
+        self.drops = dropping.DropStats()
+        self.metrics = metrics.MetricsRegistry()
+        self.outputNames = {SOCK: "output"}
+        self.outputLoads = {SOCK: distribution.OutputLoad()}
+        self.outputWorkerLocks = {SOCK: Event()}
+        self.outputCodecs = {SOCK: network.getCodec(codec)}
+        self.outputIntegrities = {SOCK: network.IntegrityCheck()}
+        self.outputBatches = {}
+        self.brokenOutputs = []
+        self.sent = []
+
+    def _sendTo(self, sock, p, buffers = None):
+        self.sent.append((dict(p.data), bytes(p.binObj)))
+
+    def _flushBatch(self, sock, force = True):
+        pass
+
+    def _outputLost(self, sock):
+        self.brokenOutputs.append(sock)
+
+
+def frame(i):
+    img = np.zeros((64, 64, 3), dtype = np.uint8)
+    img[16:32, (i % 4) * 16:(i % 4 + 1) * 16] = i #a block moving over a fixed background
+    return img
+
+def packet(img):
+    p = network.Packet()
+    p["from"] = "camera"
+    p.img = img
+    return p
+
+def received(sent):
+    """
+    Decodes the sent frames like the receiving worker
+    """
+    codecs = {}
+    images = []
+    for header, payload in sent:
+        p = network.Packet()
+        p.data = header
+        p.binObj = payload
+        network.readImagePacket(p, network.IntegrityCheck(), codecs)
+        images.append(p.img)
+    return images
+
+
+class TestStatefulSender(unittest.TestCase):
+
+    def _waitSent(self, w, count):
+        deadline = time.time() + 5
+        while(len(w.sent) < count and time.time() < deadline):
+            time.sleep(0.01)
+
+    def test_dropoldest(self):
+        w = FakeWorker("delta")
+        s = sender.OutputSender(w, SOCK, "1:"+sender.OVERFLOW_DROP_OLDEST)
+        frames = [frame(i) for i in range(10)]
+        for img in frames: #no credits: the sender holds the first frame, the queue keeps the last one
+            s.put(packet(img))
+            time.sleep(0.02)
+
+        w.outputWorkerLocks[SOCK].set()
+        s.close(5)
+
+        self.assertEqual(s.dropped, 8)
+        self.assertEqual(len(w.sent), 2)
+        images = received(w.sent)
+        np.testing.assert_array_equal(images[0], frames[0])
+        np.testing.assert_array_equal(images[1], frames[-1])
+        self.assertFalse(w.sent[1][0]["keyframe"]) #the dropped frames were never encoded: a delta against the first one
+        self.assertEqual(w.drops.stats()["by_reason"], {"output_overflow": 8})
+
+    def test_encode_error(self):
+        w = FakeWorker("delta")
+        w.outputWorkerLocks[SOCK].set()
+        s = sender.OutputSender(w, SOCK, "4:"+sender.OVERFLOW_BLOCK)
+
+        s.put(packet(frame(0)))
+        bad = packet(frame(1))
+        bad.attach("mask", np.zeros(10, dtype = np.uint8)) #not an image: the main image is encoded, then the attachment fails
+        s.put(bad)
+        s.put(packet(frame(2)))
+        s.close(5)
+
+        self.assertEqual(len(w.sent), 2)
+        images = received(w.sent)
+        np.testing.assert_array_equal(images[1], frame(2))
+        self.assertEqual(w.drops.stats()["by_reason"], {"encode_error": 1})
+        self.assertNotIn(SOCK, w.brokenOutputs)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+'''
+Hop traces of the packets, to see where the time goes along a pipeline
+A sampled packet carries a "trace": {"id": ..., "hops": [[worker, receive, dequeue, loop start, loop end, send], ...]}
+(seconds since the epoch, None when the step does not apply eg receive at the source),
+each worker appends its hop to the packets it produces from a traced input
+
+The workers receiving traced packets keep per stage latency histograms and can export the traces
+to a Chrome trace-event JSON file (chrome://tracing, Perfetto)
+
+@author: WIN32GG
+'''
+
+from collections import deque
+import json
+from threading import Lock
+import time
+
+
+TRACE_TAG = "trace"
+
+RECEIVE, DEQUEUE, LOOP_START, LOOP_END, SEND = range(1, 6) #index of the times in a hop
+
+
+class LatencyHistogram(object):
+    '''
+    Counts of the latencies in logarithmic buckets (milliseconds)
+    The percentiles are interpolated linearly inside their bucket, whose bounds are clamped to the min and max seen
+    '''
+
+    BOUNDS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1) #last one is over the highest bound
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def add(self, seconds):
+        ms = max(0, seconds * 1000)
+        i = 0
+        while(i < len(self.BOUNDS) and ms > self.BOUNDS[i]):
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        self.min = ms if self.min == None else min(self.min, ms)
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        if(self.count == 0):
+            return None
+        rank = q * self.count
+        n = 0
+        for i, c in enumerate(self.counts):
+            if(c > 0 and n + c >= rank):
+                low = max(self.min, 0 if i == 0 else self.BOUNDS[i - 1])
+                high = min(self.max, self.BOUNDS[i]) if i < len(self.BOUNDS) else self.max
+                return round(low + (high - low) * max(0, rank - n) / c, 3)
+            n += c
+
+    def stats(self):
+        return {
+                "count": self.count,
+                "mean_ms": None if self.count == 0 else round(self.total / self.count, 3),
+                "p50_ms": self.percentile(0.5),
+                "p99_ms": self.percentile(0.99),
+                "max_ms": round(self.max, 3),
+                "buckets": {("<=" + str(b)) if i < len(self.BOUNDS) else (">" + str(self.BOUNDS[-1])): c
+                            for i, (b, c) in enumerate(zip(self.BOUNDS + [None], self.counts)) if c > 0}
+            }
+
+
+def hop(worker, received = None, dequeued = None, loopStart = None, loopEnd = None):
+    return [worker, received, dequeued, loopStart, loopEnd, None]
+
+def stages(trace):
+    '''
+    Returns the (stage, seconds) of a trace: queue, loop and output of each worker, network between two workers, and total
+    '''
+    hops = trace["hops"]
+    result = []
+    for i, h in enumerate(hops):
+        name = h[0]
+        for stage, a, b in [("queue", RECEIVE, DEQUEUE), ("loop", LOOP_START, LOOP_END), ("output", LOOP_END, SEND)]:
+            if(h[a] is not None and h[b] is not None):
+                result.append((name+":"+stage, h[b] - h[a]))
+        if(i + 1 < len(hops) and h[SEND] is not None and hops[i + 1][RECEIVE] is not None):
+            result.append((name+"->"+hops[i + 1][0]+":network", hops[i + 1][RECEIVE] - h[SEND]))
+
+    times = [t for h in hops for t in h[1:] if t is not None]
+    if(len(times) > 1):
+        result.append(("total", max(times) - min(times)))
+    return result
+
+
+class Tracer(object):
+    '''
+    Samples the traces started by a worker, records the received ones and exports them
+    '''
+
+    EXPORT_MAX = 1000 #traces kept for the export
+    EXPORT_EVERY = 100 #traces recorded between two exports
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.sample = 0 #1 packet out of sample is traced, 0 for none
+        self.exportPath = None
+        self.produced = 0
+        self.recorded = 0
+        self.histograms = {} #stage: LatencyHistogram
+        self.exported = deque(maxlen = self.EXPORT_MAX)
+        self.lock = Lock()
+
+    def trace(self, p, data, received, dequeued, loopStart, loopEnd):
+        """
+        Adds the hop of this worker to p (produced from data), if data is traced or p is sampled
+        Returns the trace of data up to this worker, None if it is not traced
+        """
+        name = str(self.worker.name)
+        inTrace = None if data is None else data[TRACE_TAG]
+        if(inTrace is not None):
+            inTrace = {"id": inTrace["id"], "hops": inTrace["hops"] + [hop(name, received, dequeued, loopStart, loopEnd)]}
+
+        if(p is not None):
+            self.produced += 1
+            if(inTrace is not None):
+                p[TRACE_TAG] = {"id": inTrace["id"], "hops": [list(h) for h in inTrace["hops"]]}
+            elif(p[TRACE_TAG] is None and self.sample > 0 and self.produced % self.sample == 0):
+                p[TRACE_TAG] = {"id": name+"-"+str(self.produced), "hops": [hop(name, received, dequeued, loopStart, loopEnd)]}
+        return inTrace
+
+    @staticmethod
+    def stampSend(p):
+        """
+        Send time of the last hop, when p is handed to the outputs
+        """
+        trace = p[TRACE_TAG]
+        if(trace is not None):
+            trace["hops"][-1][SEND] = time.time()
+
+    def record(self, trace):
+        with self.lock:
+            for stage, seconds in stages(trace):
+                if(not stage in self.histograms):
+                    self.histograms[stage] = LatencyHistogram()
+                self.histograms[stage].add(seconds)
+            self.exported.append(trace)
+            self.recorded += 1
+            export = self.exportPath != None and self.recorded % self.EXPORT_EVERY == 0
+
+        if(export):
+            self.export()
+
+    def export(self, path = None):
+        """
+        Writes the kept traces as Chrome trace events: a process per worker, a thread per stage
+        """
+        path = path or self.exportPath
+        if(path == None):
+            return
+
+        with self.lock:
+            traces = list(self.exported)
+
+        events = []
+        pids = {}
+        tids = {"queue": 1, "loop": 2, "output": 3, "network": 4}
+        def pid(name):
+            if(not name in pids):
+                pids[name] = len(pids) + 1
+                events.append({"ph": "M", "name": "process_name", "pid": pids[name], "args": {"name": name}})
+                for stage, tid in tids.items():
+                    events.append({"ph": "M", "name": "thread_name", "pid": pids[name], "tid": tid, "args": {"name": stage}})
+            return pids[name]
+
+        for trace in traces:
+            hops = trace["hops"]
+            for i, h in enumerate(hops):
+                spans = [("queue", h[RECEIVE], h[DEQUEUE]), ("loop", h[LOOP_START], h[LOOP_END]), ("output", h[LOOP_END], h[SEND])]
+                if(i + 1 < len(hops)):
+                    spans.append(("network", h[SEND], hops[i + 1][RECEIVE]))
+                for stage, start, end in spans:
+                    if(start is None or end is None):
+                        continue
+                    events.append({"ph": "X", "name": stage, "cat": "tidmarsh", "pid": pid(h[0]), "tid": tids[stage],
+                                   "ts": start * 1e6, "dur": max(0, end - start) * 1e6,
+                                   "args": {"trace": trace["id"], "path": ">".join(h[0] for h in hops)}}) #one copy per path with duplicate
+
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def stats(self):
+        with self.lock:
+            return {
+                    "sample": self.sample,
+                    "recorded": self.recorded,
+                    "stages": {stage: h.stats() for stage, h in self.histograms.items()}
+                }
@@ -12,7 +12,7 @@ def checkMasterConfigSanity(cfg):
     return checkConfigSanity(cfg, ["units"], ["workers","action","refreshinterval", "supervisorport"])
 
 def checkWorkerConfigSanity(cfg):
-    return checkConfigSanity(cfg,  ["port", "jobname", "workername"], ["jobreplacemethod", "outputmethod", "debuglevel", "output", "jobdata", "action"])
+    return checkConfigSanity(cfg,  ["port", "jobname", "workername"], ["jobreplacemethod", "outputmethod", "distributepolicy", "outputqueue", "lanes", "droppolicy", "tracing", "traceexport", "outputcodec", "outputintegrity", "outputheader", "outputbatch", "outputsharedmemory", "networkengine", "inputwindow", "jobbatch", "concurrency", "reorder", "debuglevel", "output", "jobdata", "action", "query"])
 
 def checkConfigSanity(cfg, MANDATORY, OPTIONAL):
         TOTAL = MANDATORY + OPTIONAL
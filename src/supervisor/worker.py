@@ -12,10 +12,22 @@ import importlib
 import sys
 import os
 import json
+import time
 import operator
+from functools import partial
 import numpy as np
 from threading import Event
+from threading import Lock
 from network import Packet
+import network
+import asyncnetwork
+import distribution
+import sender
+import lanes
+import dropping
+import tracing
+import metrics
+import concurrency
 
 from utils.custom_logging import debug
 from utils.custom_logging import _DEBUG_LEVEL
@@ -24,6 +36,27 @@ import signal
 from multiprocessing.queues import Empty
 from datetime import datetime
 
+def payloadBytes(p):
+    """
+    Bytes of the payloads of p and its attachments, through shared memory as well
+    """
+    return sum(0 if q.binObj is None else len(q.binObj) for q in p.parts())
+
+JOB_BATCH_DELAY_DEFAULT = 20 #ms
+
+def parseJobBatch(spec):
+    """
+    Returns (packets, delay in seconds) of a "size[:delay ms]" job batch spec
+    """
+    a = str(spec).split(":", 1)
+    size = int(a[0])
+    delay = float(a[1]) if len(a) == 2 else JOB_BATCH_DELAY_DEFAULT
+    if(size < 1 or delay < 0):
+        raise ValueError("Invalid job batch: "+str(spec))
+    return size, delay / 1000
+
+STATS_TAG = "[STATS] " #line of the stats action, picked up by the supervisor
+
 class SupervisedProcessStream():
     def __init__(self, old_std, name):
         self.old_std=old_std
@@ -51,7 +84,10 @@ class Worker(object):
         opt: plug to redirect the output of the job to the given address
     '''
 
-    def __init__(self, port, inputQueue):
+    DEFAULT_INPUT_WINDOW = 4 #packets in flight per input connection, 1 is stop-and-wait
+    SENDER_DRAIN_TIMEOUT = 10 #seconds for an output sender to send its queue when stopping
+
+    def __init__(self, port, inputQueue, engine = asyncnetwork.ENGINE_THREADS):
         self.job = None # a worker has initially no job
         self.jobSetup = False
         self.jobRunning = Value('b')
@@ -60,19 +96,65 @@ class Worker(object):
         self.workerShutdown.value = False
         self.port = port
         self.outputmethod = self._duplicateOverNetwork
+        #per output settings, output name (or "default"): spec
+        self.outputCodecSpecs = {"default": network.CODEC_NPZ}
+        self.outputIntegritySpecs = {"default": network.INTEGRITY_DEFAULT}
+        self.outputBatchSpecs = {"default": None} #no batching
+        self.inputIntegrity = network.IntegrityCheck() #verifies what the senders signed
+        self.outputHeader = network.HEADER_JSON
+        self.outputBatches = {} #sock: PacketBatch
+        self.jobBatch = (1, 0) #packets per call of Job.loop_batch, seconds to wait for them
+        self.concurrency = (1, concurrency.MODE_DEFAULT) #job replicas, threads or processes
+        self.reorder = False #outputs of the replicas in the order of their inputs
+        self.reorderer = None
+        self.jobs = [] #job replicas, self.job or JobProcess
+        self.replicasRunning = 0
+        self.replicaLock = Lock()
+        self.ackLock = Lock()
+        self.outputSenders = {} #sock: OutputSender
+        self.outputQueueSpecs = {"default": sender.QUEUE_SPEC_DEFAULT} #output name (or "default"): queue spec
+        self.outputSharedMemory = network.SharedMemoryRing.available() #for the outputs on this host
+        self.sharedRings = {} #sock: SharedMemoryRing
+        self.batchedInputs = {} #chan: size of the last batch received
+        self.pendingAcks = {} #chan: count
         self.inputConnections = {} #sock: chan
-        self.inputQueue = Queue(50)
-        self.outputQueue = Queue(50)
+        #thread queues: the Packets (and their receive buffers) are passed by reference
+        #served by priority lanes (the "priority" of the packets), see lanes.py
+        self.inputQueue = lanes.LaneQueue(50)
+        self.outputQueue = lanes.LaneQueue(50)
+        self.laneWeights = lanes.WEIGHTS_DEFAULT
+        self.dropPolicies = dropping.getPolicies(dropping.POLICY_DEFAULT) #when the job allows drops
+        self.drops = dropping.DropStats()
+        self.tracer = tracing.Tracer(self)
+        self.metrics = metrics.MetricsRegistry()
+        self.inputNames = {} #chan: "host:port" of the sender
+        self.metrics.gauge("input_queue", self.inputQueue.qsize)
+        self.metrics.gauge("output_queue", self.outputQueue.qsize)
+        self.metrics.gauge("queue_size", lambda: self.inputQueue.maxsize)
+        self.metrics.gauge("sender_queues", lambda: {self.outputNames.get(sock): len(s) for sock, s in list(self.outputSenders.items())})
         
-        self.outputWorkerLocks = {} #sock: Event
+        self.outputWorkerLocks = {} #sock: Event, set while the output has credits
         self.globalOutputLock = Event()
+        self.outputCredits = {} #sock: packets that can be sent before the next ack
+        self.outputWindows = {} #sock: credits granted by the output
+        self.outputLoads = {} #sock: OutputLoad
+        self.distributePolicy = distribution.getPolicy(distribution.POLICY_DEFAULT)
+        self.outputRing = distribution.HashRing()
+        self.hashField = "from"
+        self.creditLock = Lock()
+        self.inputWindow = self.DEFAULT_INPUT_WINDOW
         self.outputs = {} #sock: chan
+        self.outputNames = {} #sock: "host:port"
+        self.outputCodecs = {} #sock: Codec of the output
+        self.outputIntegrities = {} #sock: IntegrityCheck of the output
         
         self.server = None
-        self.jobThread = None
+        self.localServer = None #unix socket, for the workers of this host
+        self.jobThreads = []
         
         self._inputQueue = inputQueue #stdin input 
         self._exitCode = None
+        self.aio = asyncnetwork.AsyncNetwork(self) if engine == asyncnetwork.ENGINE_ASYNCIO else None
         self._startNetwork()
 
     def stop(self, code=1):
@@ -83,26 +165,56 @@ class Worker(object):
         if(self.server != None):
             debug("[STOP] Closing listener")
             self._closeSock(self.server)
+            self._closeLocalServer()
 
+        self.tracer.export()
         debug("[STOP] Waiting for output queue to empty...")
         self.netOutThread.join()
+        if(self.aio != None):
+            self.aio.flush()
         debug("[STOP] Closing output connections (if any)")
         for sock in self.outputs.keys():
             try:
                 self._closeSock(sock)
             except:
                 traceback.print_exc()
+        for ring in list(self.sharedRings.values()):
+            ring.close()
+        if(self.aio != None):
+            self.aio.stop()
 
+        debug("[STOP] Stats: "+json.dumps(self.getStats()), 2)
         debug("[STOP] Exiting with code "+str(code), 0)
         self._exitCode = code
         self._inputQueue.close() #triggers exception in main thread causing a check of exitCode
 
+    def getStats(self):
+        return {
+                "integrity_in": self.inputIntegrity.stats(),
+                "integrity_out": {self.outputNames.get(sock): check.stats() for sock, check in list(self.outputIntegrities.items())},
+                "codecs": {self.outputNames.get(sock): codec.stats() for sock, codec in list(self.outputCodecs.items()) if codec.stateful},
+                "shared_memory": {self.outputNames.get(sock): ring.stats() for sock, ring in list(self.sharedRings.items())},
+                "transports": {self.outputNames.get(sock): self._transport(sock) for sock in list(self.outputLoads.keys())},
+                "outputs": {self.outputNames.get(sock): load.stats() for sock, load in list(self.outputLoads.items())},
+                "distribute_policy": self.distributePolicy.spec(),
+                "output_queues": {self.outputNames.get(sock): s.stats() for sock, s in list(self.outputSenders.items())},
+                "lanes": {"weights": self.laneWeights, "input": self.inputQueue.stats(), "output": self.outputQueue.stats()},
+                "drops": dict(self.drops.stats(), policies = [policy.spec() for policy in self.dropPolicies]),
+                "tracing": self.tracer.stats(),
+                "metrics": self.metrics.snapshot(),
+                "input_window": self.inputWindow,
+                "concurrency": {"replicas": len(self.jobs), "mode": self.concurrency[1], "running": self.replicasRunning,
+                                "reorder": None if self.reorderer == None else self.reorderer.stats()},
+                "output_windows": {self.outputNames.get(sock): {"window": w, "credits": self.outputCredits.get(sock)} 
+                                   for sock, w in list(self.outputWindows.items())}
+            }
+
     def checkAction(self, config):
         try:
             if("action" in config.keys()):
                 debug("Handling action: "+config['action'])
                 action = getattr(self, "action_"+config['action'])
-                action()
+                action(*([config['query']] if "query" in config else [])) #stats query number of the supervisor
                 return True
         except:
             pass
@@ -115,6 +227,17 @@ class Worker(object):
     def action_stop(self):
         self.stop()
 
+    def action_stats(self, query = None):
+        """
+        Writes the stats on a single line, the supervisor relays it
+        The query number of the supervisor is given back, to tell the answer from a late one
+        """
+        stats = self.getStats()
+        if(query != None):
+            stats["query"] = query
+        sys.stdout.write(STATS_TAG+json.dumps(stats)+"\n")
+        sys.stdout.flush()
+
     def loadJob(self, jobName):
         try:
             self.jobName = str(jobName)
@@ -154,6 +277,7 @@ class Worker(object):
             debug("Updating worker port to "+str(p))
             self.port = p
             self._closeSock(self.server)
+            self._closeLocalServer()
             self._startListener()
         
         #update job
@@ -161,12 +285,13 @@ class Worker(object):
             debug("Replacing job")
             if("jobreplacemethod" in config):
                 if(config['jobreplacemethod'] == "kill"):
-                    self.job.shouldStop = True
+                    for job in self.jobs:
+                        job.shouldStop = True
                     debug("Asked for Job stop")
             
             debug("Waiting for job shutdown...")
-            if(self.jobThread != None):
-                self.jobThread.join()
+            for t in self.jobThreads:
+                t.join()
             
             debug("Installing new job...")
             jobName = config["jobname"]
@@ -180,12 +305,147 @@ class Worker(object):
             
     def setNetworkMethod(self, config):
         if("outputmethod" in config):
-            if(config['outputmethod'] == "distribute"):
+            method, _, field = str(config['outputmethod']).partition(":")
+            if(method == "distribute"):
                 debug("Output method is set to distribution")
                 self.outputmethod = self._distributeOverNetwork
+            elif(method == "hash"):
+                self.hashField = field if field != "" else "from"
+                debug("Output method is set to hashing of "+self.hashField)
+                self.outputmethod = self._hashOverNetwork
             else:
                 debug("Output method is set to duplication")
                 self.outputmethod = self._duplicateOverNetwork 
+        
+        if("distributepolicy" in config):
+            try:
+                self.distributePolicy = distribution.getPolicy(config['distributepolicy'])
+                debug("Distribution policy is set to "+self.distributePolicy.spec())
+            except ValueError as e:
+                debug(str(e)+", keeping "+self.distributePolicy.spec(), 0, True)
+        
+        if("outputcodec" in config):
+            self._setOutputSpecs(config['outputcodec'], self.outputCodecSpecs, network.getCodec, "Output codec")
+        
+        if("outputintegrity" in config):
+            self._setOutputSpecs(config['outputintegrity'], self.outputIntegritySpecs, network.IntegrityCheck, "Output integrity check")
+        
+        for sock in list(self.outputs):
+            self._resolveOutput(sock)
+        
+        if("outputheader" in config):
+            if(config['outputheader'] in network.HEADER_FORMATS):
+                self.outputHeader = config['outputheader']
+                debug("Output header format is set to "+self.outputHeader)
+            else:
+                debug("Unknown header format: "+str(config['outputheader'])+", keeping "+self.outputHeader, 0, True)
+        
+        if("outputbatch" in config):
+            self._setOutputSpecs(config['outputbatch'], self.outputBatchSpecs, lambda spec: spec == None or network.PacketBatch(spec),
+                                 "Output batching", " (for the outputs plugged from now on)")
+        
+        if("outputqueue" in config):
+            self._setOutputSpecs(config['outputqueue'], self.outputQueueSpecs, sender.parseQueueSpec,
+                                 "Output queue", " (for the outputs plugged from now on)")
+        
+        if("lanes" in config):
+            try:
+                weights = lanes.checkWeights(config['lanes'])
+                self.inputQueue.setWeights(weights)
+                self.outputQueue.setWeights(weights)
+                for s in list(self.outputSenders.values()):
+                    s.setWeights(weights)
+                self.laneWeights = weights
+                debug("Lane weights are set to "+json.dumps(weights))
+            except (ValueError, TypeError) as e:
+                debug("Invalid lane weights: "+str(e)+", keeping "+json.dumps(self.laneWeights), 0, True)
+        
+        if("droppolicy" in config):
+            try:
+                self.dropPolicies = dropping.getPolicies(config['droppolicy'])
+                debug("Drop policy is set to "+", ".join(policy.spec() for policy in self.dropPolicies))
+            except ValueError as e:
+                debug(str(e)+", keeping "+", ".join(policy.spec() for policy in self.dropPolicies), 0, True)
+        
+        if("tracing" in config):
+            try:
+                sample = int(config['tracing'])
+                if(sample < 0):
+                    raise ValueError("must be at least 0")
+                self.tracer.sample = sample
+                debug("Tracing 1 packet out of "+str(sample) if sample > 0 else "Tracing is off (traced inputs are still followed)")
+            except (ValueError, TypeError) as e:
+                debug("Invalid tracing sample: "+str(e), 0, True)
+        
+        if("traceexport" in config):
+            self.tracer.exportPath = config['traceexport']
+            debug("Traces are exported to "+str(self.tracer.exportPath))
+        
+        if("jobbatch" in config):
+            try:
+                self.jobBatch = (1, 0) if config['jobbatch'] == None else parseJobBatch(config['jobbatch'])
+                debug("Job batches are set to "+str(self.jobBatch[0])+" packets within "+str(self.jobBatch[1] * 1000)+" ms")
+            except ValueError as e:
+                debug(str(e)+", keeping "+str(self.jobBatch[0])+" packets", 0, True)
+        
+        if("concurrency" in config):
+            try:
+                self.concurrency = concurrency.parseConcurrency(config['concurrency'])
+                debug("Job concurrency is set to "+str(self.concurrency[0])+" "+self.concurrency[1]+" (for the job launched from now on)")
+            except ValueError as e:
+                debug(str(e)+", keeping "+str(self.concurrency[0])+" "+self.concurrency[1], 0, True)
+        
+        if("reorder" in config):
+            self.reorder = bool(config['reorder'])
+            debug("Outputs of the job replicas are "+("kept in the order of their inputs" if self.reorder else "sent as soon as done"))
+        
+        if("inputwindow" in config):
+            try:
+                window = int(config['inputwindow'])
+                if(window < 1 or window > self.inputQueue.maxsize):
+                    raise ValueError("Input window must be between 1 and "+str(self.inputQueue.maxsize))
+                self.inputWindow = window
+                debug("Input window is set to "+str(window)+" (for the inputs connected from now on)")
+            except ValueError as e:
+                debug("Invalid input window: "+str(e)+", keeping "+str(self.inputWindow), 0, True)
+        
+        if("outputsharedmemory" in config):
+            if(config['outputsharedmemory'] and not network.SharedMemoryRing.available()):
+                debug("Shared memory is not available (python 3.8+), the outputs use the sockets", 0, True)
+            else:
+                self.outputSharedMemory = bool(config['outputsharedmemory'])
+                debug("Shared memory for the local outputs is set to "+str(self.outputSharedMemory)+" (for the outputs plugged from now on)")
+
+    def _setOutputSpecs(self, value, specs, check, label, note = ""):
+        """
+        Sets the specs (output name: spec) from a config value: a spec for all the outputs or {"host:port": spec, "default": spec}
+        check(spec) raises ValueError if the spec is invalid
+        """
+        if(not isinstance(value, dict)):
+            value = {"default": value}
+        for name, spec in value.items():
+            try:
+                check(spec)
+                specs[name] = spec
+                debug(label+" of "+name+" is set to "+str(spec)+note)
+            except ValueError as e:
+                debug("Invalid "+label.lower()+" for "+name+": "+str(e)+", keeping "+str(specs.get(name, specs["default"])), 0, True)
+
+    def _outputSpec(self, specs, sock):
+        return specs.get(self.outputNames.get(sock), specs["default"])
+
+    def _resolveOutput(self, sock):
+        """
+        Sets the codec and the integrity check of an output from the specs of its name, or the default ones
+        The instances are kept while their spec is unchanged (state of the stateful codecs, stats)
+        """
+        codec = network.getCodec(self._outputSpec(self.outputCodecSpecs, sock))
+        if(not sock in self.outputCodecs or self.outputCodecs[sock].spec() != codec.spec()):
+            self.outputCodecs[sock] = codec
+        
+        integrity = network.IntegrityCheck(self._outputSpec(self.outputIntegritySpecs, sock))
+        if(not sock in self.outputIntegrities or self.outputIntegrities[sock].spec() != integrity.spec()):
+            self.outputIntegrities[sock] = integrity
 
     def setupJobAndLaunch(self, data):
         self.setupJob(data)
@@ -195,21 +455,36 @@ class Worker(object):
         if(self.job == None):
             raise ValueError("This worker has no job")
 
-        self.job.setup(data)
+        self.jobs = self._jobReplicas()
+        for job in self.jobs:
+            job.setup(data)
+            job.shouldStop = False
         self.jobSetup = True
-        self.job.shouldStop = False
         debug("Pushing data", 1)
 
+    def _jobReplicas(self):
+        """
+        The job instances run by the job threads: the loaded job and its copies, or the job processes
+        """
+        count, mode = self.concurrency
+        if(mode == concurrency.MODE_PROCESSES):
+            return [concurrency.JobProcess(self.jobName, self.job) for i in range(count)]
+        return [self.job] + [type(self.job)() for i in range(count - 1)]
+
     def _startListener(self):
+        if(self.aio != None):
+            self._listenTarget() #accepts in the event loop
+            return
+        
         self.listeningThread = Thread(target=self._listenTarget, daemon = True)
         self.listeningThread.start()
 
     def _startNetwork(self):    
         self.brokenOutputs = []
-        self._startListener()
-        
         self.netOutThread = Thread(target=self._clientOutTarget, daemon = True)
         self.netOutThread.start()
+        
+        self._startListener()
        
         
     def launchJob(self):
@@ -220,11 +495,16 @@ class Worker(object):
             raise AssertionError("Process already running")
 
         self.jobRunning.value = True
+        self.reorderer = concurrency.Reorderer(2 * len(self.jobs)) if self.reorder and len(self.jobs) > 1 else None
+        self.replicasRunning = len(self.jobs)
         
-        self.jobThread = Thread(target=self._launchTarget, daemon = True)
-        self.jobThread.start()
+        self.jobThreads = []
+        for job in self.jobs:
+            t = Thread(target=self._launchTarget, args=(job,), daemon = True)
+            t.start()
+            self.jobThreads.append(t)
 
-        debug("Job is running", 1)
+        debug("Job is running ("+str(len(self.jobs))+" "+self.concurrency[1]+")", 1)
 
     def _listenTarget(self):
         try:
@@ -239,16 +519,61 @@ class Worker(object):
             return
 
         self.server = server
+        self._listenLocal()
+        self._serve(server)
+    
+    def _serve(self, server):
+        if(self.aio != None):
+            self.aio.listen(server)
+        else:
+            self._acceptTarget(server)
+    
+    def _listenLocal(self):
+        """
+        Also listens on a unix socket named after the port, used by the workers of this host (see plug)
+        """
+        if(not hasattr(socket, "AF_UNIX")):
+            return
+        
+        path = network.localSocketPath(self.port)
+        try:
+            if(os.path.exists(path)):
+                os.unlink(path) #left by a previous worker on this port
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(4)
+            debug("Listening on "+path)
+        except:
+            traceback.print_exc()
+            debug("Could not listen on "+path+", the local workers will use tcp", 0, True)
+            return
+        
+        self.localServer = server
+        Thread(target=self._serve, args=(server,), daemon = True).start()
+    
+    def _closeLocalServer(self):
+        if(self.localServer == None):
+            return
+        
+        path = self.localServer.getsockname()
+        self._closeSock(self.localServer)
+        self.localServer = None
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    
+    def _acceptTarget(self, server):
         try:
             while(not self.workerShutdown.value):
                 client, addr = server.accept()
                 if(client != None):
-                    debug("Input from: "+str(addr), 1)
+                    debug("Input from: "+str(addr or server.getsockname()), 1)
                     Thread(target=self._clientInTarget, args=(client,), daemon = True).start()
                    
 
         except:
-            if(self.workerShutdown.value):
+            if(self.workerShutdown.value or server._closed):
                 return
             
             traceback.print_exc()
@@ -258,12 +583,16 @@ class Worker(object):
 
     def _clientInTarget(self, sock):
         binChan = sock.makefile("wrb") #w for sending back ack
-        self.inputConnections[sock]  = binChan
+        pool, codecs, shared = self._openInput(sock, binChan)
         try:
             while(not self.workerShutdown.value):
-                p = Packet()
-                p.read(binChan)
-                self.inputQueue.put(p) #hold for next packet if Queue is full
+                packets = network.readPackets(binChan, self.inputIntegrity, pool, codecs, shared)
+                if(len(packets) > 1):
+                    self.batchedInputs[binChan] = len(packets)
+                    
+                for p in packets:
+                    self._packetReceived(p, binChan)
+                    self.inputQueue.put(p) #hold for next packet if Queue is full
 
         except:
             if(_DEBUG_LEVEL == 3):
@@ -271,9 +600,45 @@ class Worker(object):
             debug("Incoming Connection was lost", 0, True)
         finally:
             self._closeSock(sock)
-            del self.inputConnections[sock]
+            self._closeInput(sock, binChan, shared)
+
+    def _openInput(self, sock, binChan):
+        """
+        Registers an input connection, binChan is where the acks are written
+        Returns its BufferPool, its decoders and its SharedMemoryReader
+        """
+        self.inputConnections[sock]  = binChan
+        peer = sock.getpeername()
+        self.inputNames[binChan] = str(peer[0])+":"+str(peer[1]) if isinstance(peer, tuple) else "unix:"+str(sock.fileno())
+        grant = min(self.inputWindow, self.inputQueue.maxsize - self.inputQueue.qsize()) - 1 #the sender starts with one
+        if(grant > 0):
+            binChan.write(network.CREDITS + grant.to_bytes(2, 'big'))
+            binChan.flush()
+        pool = network.BufferPool()
+        codecs = {} #decoders of this connection
+        shared = network.SharedMemoryReader(binChan) if network.SharedMemoryRing.available() else None
+        return pool, codecs, shared
+
+    def _packetReceived(self, p, binChan):
+        p.source = binChan
+        p.received = time.time()
+        nbytes = payloadBytes(p)
+        self.metrics.meter("packets_in").mark(1, nbytes)
+        self.metrics.meter("link_in/"+self.inputNames.get(binChan, "?")).mark(1, nbytes)
+    
+    def _closeInput(self, sock, binChan, shared):
+        del self.inputConnections[sock]
+        self.inputNames.pop(binChan, None)
+        self.batchedInputs.pop(binChan, None)
+        self.pendingAcks.pop(binChan, None)
+        if(shared != None):
+            shared.close()
 
     def _closeSock(self, sock):
+        if(self.aio != None):
+            self.aio.shutdown(sock) #closed by the event loop
+            return
+        
         if(not sock._closed):
             try:
                 sock.shutdown(socket.SHUT_RDWR)
@@ -291,27 +656,73 @@ class Worker(object):
             try:
                 p = self.outputQueue.get(timeout = 1)
             except Empty:
+                self._outputsClean()
                 continue
                       
             if(len(self.outputs) == 0):
                 debug("Got output data but nothing is plugged", 1)
                 print(str(p)) #FIXME
+                p.release()
                 continue
 
+            tracing.Tracer.stampSend(p)
+            self.metrics.meter("packets_out").mark()
             self.outputmethod(p)
+            p.release()
             self._outputsClean()
+        
+        for s in list(self.outputSenders.values()): #sends what is queued
+            s.close(self.SENDER_DRAIN_TIMEOUT)
             
-    def _outputsClean(self):
-        for sock in self.brokenOutputs:
-            del self.outputs[sock]
-            del self.outputWorkerLocks[sock]
-            
-        self.brokenOutputs.clear()
+    def _encodeFailed(self, p, e):
+        """
+        The packet could not be encoded (eg a float image with jpeg): dropped, the other packets still go out
+        """
+        self.drops.add(p, "encode_error")
+        debug("Could not encode a packet, dropped: "+repr(e), 0, True)
 
-    def _sendJobCompletionAck(self):
-        for chan in self.inputConnections.values():
-            chan.write(b'a') #whatever
-            chan.flush()
+    def _outputsClean(self):
+        for sock in list(self.brokenOutputs):
+            s = self.outputSenders.pop(sock, None)
+            if(s != None):
+                s.close(self.SENDER_DRAIN_TIMEOUT) #its packets are dropped
+            self.outputs.pop(sock, None)
+            self.outputWorkerLocks.pop(sock, None)
+            self.outputRing.remove(sock) #its keys move to the next outputs of the ring
+            self.outputCredits.pop(sock, None)
+            self.outputWindows.pop(sock, None)
+            self.outputBatches.pop(sock, None)
+            self.outputCodecs.pop(sock, None)
+            self.outputIntegrities.pop(sock, None)
+            ring = self.sharedRings.pop(sock, None)
+            if(ring != None):
+                ring.close()
+            self.brokenOutputs.remove(sock)
+
+    def _sendJobCompletionAck(self, data):
+        """
+        Gives the credit of the processed data back to its sender
+        """
+        chan = None if data is None else data.source
+        if(chan == None or not chan in self.inputConnections.values()):
+            return #produced here or the connection was lost
+        
+        try:
+            with self.ackLock: #from each job replica
+                if(chan in self.batchedInputs):
+                    #coalesced: one write for the batch, or before waiting for more input
+                    n = self.pendingAcks.get(chan, 0) + 1
+                    if(n < self.batchedInputs[chan] and not self.inputQueue.empty()):
+                        self.pendingAcks[chan] = n
+                        return
+                    
+                    self.pendingAcks[chan] = 0
+                    chan.write(network.ACK * n)
+                else:
+                    chan.write(network.ACK)
+                chan.flush()
+        except (OSError, ValueError):
+            pass #the input task handles the loss
     
     def _childWorkerAckTarget(self, sock):
         """
@@ -321,35 +732,75 @@ class Worker(object):
         debug("Started ChildWorkerNetworkACK", 3)
         binChan = sock.makefile("rb")
         try:
-            while(not self.workerShutdown.value):
-                if(binChan.read(1) != b'a'): #magic value
+            while(True): #until the output is closed: when stopping, the queued packets still need their acks
+                b = binChan.read(1)
+                if(b == b'' and self.workerShutdown.value):
+                    return #closed by stop
+                if(b == network.SharedMemoryReader.RELEASE):
+                    self.sharedRings[sock].releaseSlot(int.from_bytes(binChan.read(2), 'big'))
+                    continue
+                if(b == network.CREDITS):
+                    self._ackReceived(sock, int.from_bytes(binChan.read(2), 'big'), True)
+                    continue
+                if(b != network.ACK): #magic value
                     raise ValueError("Wrong ack value")
                 
-                self.outputWorkerLocks[sock].set()
-                debug("Ack from "+str(sock.getpeername()), 3)
-                #Let the unblock if it is a distribute network bahaviour
-                self.globalOutputLock.set()
-                
+                self._ackReceived(sock)
         
         except:
-            if(_DEBUG_LEVEL == 3):
-                traceback.print_exc()
-            debug("Output network callback error", 0, True)
-            self._closeSock(sock)
+            if(not self.workerShutdown.value):
+                if(_DEBUG_LEVEL == 3):
+                    traceback.print_exc()
+                debug("Output network callback error", 0, True)
+            self._ackLost(sock)
             return
+    
+    def _ackReceived(self, sock, credits = 1, grant = False):
+        """
+        The output processed a packet (or granted more credits)
+        """
+        with self.creditLock:
+            self.outputCredits[sock] += credits
+            if(grant):
+                self.outputWindows[sock] += credits
+            else:
+                self.outputLoads[sock].acked(credits)
+            if(self.outputCredits[sock] > 0): #under the lock, else a sender may have spent them and cleared the events
+                self.outputWorkerLocks[sock].set()
+                #Let the unblock if it is a distribute network bahaviour
+                self.globalOutputLock.set()
+        debug("Ack from "+str(self.outputNames.get(sock)), 3)
+    
+    def _takeCredit(self, sock):
+        """
+        Before sending a packet to sock, returns the credits left
+        """
+        with self.creditLock:
+            self.outputCredits[sock] -= 1
+            left = self.outputCredits[sock]
+            if(left <= 0):
+                self.outputWorkerLocks[sock].clear()
+                self.globalOutputLock.clear()
+        return left
+    
+    def _ackLost(self, sock):
+        self._closeSock(sock)
+        if(sock in self.sharedRings):
+            self.sharedRings[sock].shutdown() #the sender may be waiting for a slot
+        evt = self.outputWorkerLocks.get(sock)
+        if(evt != None):
+            evt.set() #its sender may be waiting for credits, the send fails
         
         
     ## Network strategies: 
     #duplicate: send to all the plugged workers regardless of the availability (the output/input queue grows)
     #distribute: send to an available worker only suspending the job if none os found at the moment 
+    #hash: send to the worker owning the key of the packet, waiting for it if needed
 
     def _checkNetworkOutputStatus(self):        
         if(self.outputmethod == self._duplicateOverNetwork):
-            #duplicate: wait for all
-            for evt in self.outputWorkerLocks.values():
-                debug("Entering Network Wait...",3)
-                evt.wait()
-                debug("Exiting Network Wait...",3)
+            #duplicate: each output waits in its own sender, the job is held back by the full (blocking) sender queues
+            return
         else:
             #distributed wait for one
             flag = True
@@ -366,49 +817,179 @@ class Worker(object):
         #debug("Done waiting for network synchronization", 3)
 
     def _duplicateOverNetwork(self, p):
-        for sock in self.outputs:
-            self._sendTo(sock, p)
+        self._enqueue(list(self.outputs), p)
     
     def _distributeOverNetwork(self, p):
-        for sock in self.outputs:
-            if(self.outputWorkerLocks[sock].is_set()):
-                self._sendTo(sock, p)
-                break
+        available = [sock for sock in self.outputs if self.outputWorkerLocks[sock].is_set()]
+        if(len(available) > 0):
+            self._enqueue([self.distributePolicy.choose(available, self.outputLoads)], p)
+    
+    def _hashOverNetwork(self, p):
+        key = p[self.hashField]
+        if(key is None): #no affinity
+            self._distributeOverNetwork(p)
+            return
+        
+        sock = self.outputRing.lookup(key)
+        if(sock != None):
+            self._enqueue([sock], p) #its sender waits for the credits
+    
+    def _enqueue(self, socks, p):
+        """
+        Hands p to the senders of socks, encoded once per codec and integrity check of the outputs
+        and serialized once per encoding for the outputs without shared memory
+        The outputs with a stateful codec get their own copy, encoded by their sender once it is not dropped (see _encodeFor)
+        """
+        encodings = {} #(codec, integrity) specs: [packet, buffers], None if it could not be encoded
+        copies = [] #encoded differently from p
+        pEncoded = False
+        for sock in socks:
+            codec, integrity = self.outputCodecs[sock], self.outputIntegrities[sock]
+            key = (codec.spec(), integrity.spec())
+            if(codec.stateful):
+                q = p.copy()
+                copies.append(q)
+                encoded = [q, None] #serialized by the sender
+            elif(not key in encodings):
+                q = p
+                if(pEncoded):
+                    q = p.copy()
+                    copies.append(q)
+                    for part in q.parts():
+                        if(part.img is not None):
+                            part.binObj = None #encoded again, eg same codec with another parameter
+                pEncoded = True
+                try:
+                    q.encode(codec, integrity)
+                    encoded = encodings[key] = [q, None]
+                except Exception as e:
+                    self._encodeFailed(q, e)
+                    encoded = encodings[key] = None
+            else:
+                encoded = encodings[key]
+            
+            if(encoded == None):
+                continue
+            
+            try:
+                q, buffers = encoded
+                if(sock in self.sharedRings or codec.stateful):
+                    linkBuffers = None #serialized by the sender (written in the ring with shared memory)
+                else:
+                    if(buffers == None):
+                        encoded[1] = buffers = q.buffers(self.outputHeader)
+                    linkBuffers = buffers
+                
+                self.outputLoads[sock].sent()
+                self.outputSenders[sock].put(q, linkBuffers)
+            except:
+                self._outputLost(sock)
         
-    def _sendTo(self, sock, p):
-        binChan = self.outputs[sock]
+        for q in copies:
+            q.release() #held by the senders
+    
+    def _encodeFor(self, sock, p):
+        """
+        Encodes p with the stateful codec of sock, called by its sender once p is sure to be sent:
+        the codec reference then always is the last frame the output received
+        Returns False if p could not be encoded (dropped, the other packets still go out)
+        """
+        codec = self.outputCodecs[sock]
+        try:
+            p.encode(codec, self.outputIntegrities[sock])
+            return True
+        except Exception as e:
+            for part in p.parts():
+                codec.reset(part.streamKey) #the parts encoded before the error were not sent
+            self._encodeFailed(p, e)
+            return False
+        
+    def _sendTo(self, sock, p, buffers = None):
+        """
+        Sends p (or its buffers) to sock, called by the sender of sock
+        """
         try:
-            p.send(binChan)
+            batch = self.outputBatches.get(sock)
+            if(buffers == None):
+                buffers = p.buffers(self.outputHeader, self.sharedRings.get(sock))
+            #Network lock management, before sending: a local worker can ack before send returns
+            left = self._takeCredit(sock)
+            self.metrics.meter("link_out/"+str(self.outputNames.get(sock))).mark(1, payloadBytes(p))
+            if(batch != None and not batch.add(p, buffers = buffers) and left > 0):
+                return #the batch is sent once full, late or when the credits run out
             
-            #Network lock management
-            self.outputWorkerLocks[sock].clear()
-            self.globalOutputLock.clear()
+            if(batch == None and self.aio == None):
+                network.sendBuffers(sock, buffers) #scatter/gather on the socket itself
+            elif(batch == None):
+                p.retain() #until sent by the event loop
+                self.aio.send(sock, buffers, [p])
+            else:
+                self._flushBatch(sock)
         except:
-            if(_DEBUG_LEVEL == 3):
-                traceback.print_exc()
+            self._outputLost(sock)
+    
+    def _flushBatch(self, sock, force = True):
+        """
+        Sends the pending batch of sock, if its delay expired unless forced
+        """
+        batch = self.outputBatches.get(sock)
+        if(batch == None or batch.isEmpty() or (not force and batch.timeLeft() > 0)):
+            return
+        
+        if(self.aio == None):
+            batch.flush(sock)
+            return
+        
+        buffers, packets = batch.take()
+        self.aio.send(sock, buffers, packets)
+    
+    def _outputLost(self, sock):
+        if(_DEBUG_LEVEL == 3):
+            traceback.print_exc()
 
-            debug("Output Connection was lost", 0, True)
+        debug("Output Connection was lost", 0, True)
 
-            self._closeSock(sock)
+        self._closeSock(sock)
+        if(not sock in self.brokenOutputs):
             self.brokenOutputs.append(sock)
 
 
-    def plug(self, addr): #addr is (hostname, port)
+    def plug(self, addr): #addr is (hostname, port) or the path of a unix socket
         """
         Connect the output of this Worker to the input of another one
+        A worker of this host is reached through its unix socket
         """
 
         debug("Plugging to "+str(addr))
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(addr)
+            sock = self._connectLocal(addr)
+            if(sock == None):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect(addr)
 
             binChan = sock.makefile("wb")
             self.outputs[sock] = binChan
+            self.outputNames[sock] = addr if isinstance(addr, str) else str(addr[0])+":"+str(addr[1])
             self.outputWorkerLocks[sock] = Event()
             self.outputWorkerLocks[sock].set()
+            self.outputCredits[sock] = 1 #until the output grants its window
+            self.outputLoads[sock] = distribution.OutputLoad()
+            self.outputWindows[sock] = 1
+            self.outputRing.add(sock, self.outputNames[sock])
+            self.outputSenders[sock] = sender.OutputSender(self, sock, 
+                            self.outputQueueSpecs.get(self.outputNames[sock], self.outputQueueSpecs["default"]), self.laneWeights)
+            self._resolveOutput(sock)
+            batchSpec = self._outputSpec(self.outputBatchSpecs, sock)
+            if(batchSpec != None):
+                self.outputBatches[sock] = network.PacketBatch(batchSpec)
+            if(self.outputSharedMemory and network.SharedMemoryRing.isLocal(sock)):
+                self.sharedRings[sock] = network.SharedMemoryRing()
+                debug("Payloads to "+str(addr)+" go through shared memory")
             self.globalOutputLock.set()
-            Thread(target=self._childWorkerAckTarget, args=(sock,), daemon = True).start()
+            if(self.aio != None):
+                self.aio.addOutput(sock)
+            else:
+                Thread(target=self._childWorkerAckTarget, args=(sock,), daemon = True).start()
             debug("Plugged to "+str(addr))
         except:
             if(_DEBUG_LEVEL == 3):
@@ -416,37 +997,132 @@ class Worker(object):
 
             debug("Could not connect to "+str(addr), 0, True)
 
-    def _clearInputQueue(self):
+    def _transport(self, sock):
+        """
+        How the packets go to the output: "shared_memory" (only the headers through the socket), "unix" or "tcp"
+        """
+        if(sock in self.sharedRings):
+            return "shared_memory"
+        return "unix" if sock.family == getattr(socket, "AF_UNIX", None) else "tcp"
+
+    def _connectLocal(self, addr):
+        """
+        Returns a socket connected to the unix socket of the target, None if it is not on this host
+        """
+        if(isinstance(addr, str)):
+            path = addr
+        elif(hasattr(socket, "AF_UNIX") and network.isLocalHost(addr[0])):
+            path = network.localSocketPath(addr[1])
+            if(not os.path.exists(path)):
+                return None
+        else:
+            return None
+        
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
         try:
-            while(True):
-                self.inputQueue.get_nowait()
-        except Empty:
-            return
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            if(isinstance(addr, str)):
+                raise
+            debug("Could not connect to "+path+", using tcp", 1)
+            return None
+        
+        debug("Using the unix socket "+path)
+        return sock
+
+    def _dropInputs(self):
+        """
+        Applies the drop policies to the input queue
+        """
+        maxsize = self.inputQueue.maxsize
+        for policy in self.dropPolicies:
+            dropped = self.inputQueue.drop(lambda queued: policy.select(queued, maxsize))
+            for p in dropped:
+                self.drops.add(p, policy.name)
+                p.release()
+                self._sendJobCompletionAck(p) #dropped, the sender gets its credit back
+            
+            if(len(dropped) > 0):
+                debug("Dropped "+str(len(dropped))+" input packets ("+policy.spec()+")", 2)
+    
+    def _takeInputs(self, job):
+        """
+        Returns the input packets of the next loop: one, or with a job batch up to its size
+        arriving within its delay after the first one
+        """
+        if(not job.requireData()):
+            return [None]
+        
+        if(job.allowDrop()):
+            self._dropInputs()
+        
+        inputs = [self.inputQueue.get()]
+        size, delay = self.jobBatch
+        limit = time.time() + delay
+        while(len(inputs) < size):
+            try:
+                left = limit - time.time()
+                inputs.append(self.inputQueue.get(timeout = left) if left > 0 else self.inputQueue.get_nowait())
+            except Empty:
+                break
+        return inputs
     
-    def _doJob(self):
+    def _doJob(self, job):
         '''
-        Runs the job with input and output
+        Runs the job (one of the replicas) with input and output
         '''
 
-        while(not self.job.shouldStop and self.jobRunning.value):
-            data = None
-            if(self.job.requireData()):
-                
-                #FIXME: new network archi
-                if(self.job.allowDrop() and self.inputQueue.full()):
-                    self._clearInputQueue()
-                    debug("Input queue overflow", 0, True)
-                    
-                data = self.inputQueue.get()
+        while(not job.shouldStop and self.jobRunning.value):
+            seq = None
+            if(self.reorderer != None):
+                seq, inputs = self.reorderer.take(lambda: self._takeInputs(job))
+            else:
+                inputs = self._takeInputs(job)
+            dequeued = None if inputs[0] is None else time.time()
+
+            loopStart = time.time()
+            if(self.jobBatch[0] > 1 and inputs[0] is not None):
+                outs = job.loop_batch(inputs)
+                if(outs is None or len(outs) != len(inputs)):
+                    raise ValueError("loop_batch must return one output (or None) per packet")
+                self.metrics.meter("loop_batch").mark(len(inputs))
+            else:
+                outs = [job.loop(inputs[0])]
+            loopEnd = time.time()
+            self.metrics.time("loop", loopEnd - loopStart)
+            for data, out in zip(inputs, outs):
+                if(data is not None and out is not data):
+                    data.release() #else released once sent
+
+                self._sendJobCompletionAck(data)
+            self._checkNetworkOutputStatus() #FIXME parameter 
+            self.metrics.time("ack_wait", time.time() - loopEnd)
 
-            out = self.job.loop(data)
+            if(seq != None): #once the previous inputs are output
+                self.reorderer.done(seq, partial(self._jobOutputs, inputs, outs, dequeued, loopStart, loopEnd))
+            else:
+                self._jobOutputs(inputs, outs, dequeued, loopStart, loopEnd)
+                
 
-            self._sendJobCompletionAck()
-            self._checkNetworkOutputStatus() #FIXME parameter 
+        job.destroy()
+        with self.replicaLock:
+            self.replicasRunning -= 1
+            if(self.replicasRunning > 0):
+                debug("Job replica stopped, "+str(self.replicasRunning)+" still running", 1)
+                return
+        #self.jobRunning.value = False
+        debug("Reached end of Launch target")
+        self.stop(0)
 
+    def _jobOutputs(self, inputs, outs, dequeued, loopStart, loopEnd):
+        """
+        Queues the outputs of the job for the input packets (None for a source job)
+        """
+        for data, out in zip(inputs, outs):
+            p = None
             if(type(out) != type(None)):
-                p = None
-                   
+               
                 if(isinstance(out, Packet)):
                     p = out
                 else:    
@@ -459,18 +1135,23 @@ class Worker(object):
                                 p[key] = out[key]
                         else:
                             raise TypeError('Can only handle a Packet, npArray & np array dict')
-                    
+            
+                for tag in [lanes.PRIORITY_TAG, dropping.CAPTURE_TIME_TAG]: #stays in the lane of its input, with its age
+                    if(data is not None and p[tag] is None and data[tag] is not None):
+                        p[tag] = data[tag]
+                if(p[dropping.CAPTURE_TIME_TAG] is None):
+                    p[dropping.CAPTURE_TIME_TAG] = time.time() #captured here
+        
+            trace = self.tracer.trace(p, data, None if data is None else data.received, dequeued, loopStart, loopEnd)
+            if(trace is not None):
+                self.tracer.record(trace) #up to this worker
+        
+            if(p is not None):
                 self.outputQueue.put(p) #Packets to be sent
-                
-
-        self.job.destroy()
-        #self.jobRunning.value = False
-        debug("Reached end of Launch target")
-        self.stop(0)
 
-    def _launchTarget(self):
+    def _launchTarget(self, job):
         try:
-            self._doJob()
+            self._doJob(job)
         except:
             debug("Error from job thread", 0, True)
             traceback.print_exc()
@@ -493,10 +1174,21 @@ class Job(object):
         Called when the job has to run, the job can return data
         Either: np.ndarray
                 network.Packet
-                dictionnary with an optional np array in the 'img' key
+                dictionnary with an optional np array in the 'img' key,
+                    other np arrays or bytes values are sent as attachments
+        The buffer of the data Packet is reused once loop returns (unless data is returned)
+        copy data.img to keep it longer
         """
         raise NotImplementedError("Main loop not implemented")
 
+    def loop_batch(self, packets):
+        """
+        Called instead of loop with several packets when the worker has a job batch ("jobbatch"),
+        returns one output (or None) per packet, in order
+        Override it to amortize the cost of a call over the packets (eg one inference for several cameras)
+        """
+        return [self.loop(p) for p in packets]
+
     def destroy(self):
         """
         Stop job, close ressources
@@ -537,8 +1229,13 @@ def setupWithJsonConfig(config, inputQueue):
 
         debug("Debug level is "+str(debuglevel)+" ("+str(custom_logging._DEBUG_DICT[debuglevel])+")", 0)
 
+    engine = config.get("networkengine", asyncnetwork.ENGINE_THREADS)
+    if(not engine in asyncnetwork.ENGINES):
+        raise ValueError("Unknown network engine: "+str(engine))
+    debug("Worker network engine is "+engine)
+
     #Worker startup
-    worker = Worker(port, inputQueue)
+    worker = Worker(port, inputQueue, engine)
     worker.name = name
     worker.loadJob(jobName)
     
@@ -546,8 +1243,7 @@ def setupWithJsonConfig(config, inputQueue):
 
     if("output" in config):
         for adr in config["output"]:
-            host, port = adr.split(":")
-            worker.plug((host, int(port)))
+            worker.plug(network.parseAddress(adr))
 
     data = None
     if("jobdata" in config):
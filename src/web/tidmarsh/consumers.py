@@ -34,21 +34,29 @@ from PIL import Image
 import numpy as np
 import io
 import json
-import hashlib
+import os
+import sys
 
-def get_image(pck, binary):
-	inBytes = io.BytesIO()
-	inBytes.write(binary)
-	inBytes.seek(0)
+#the packets are decoded by the codecs of the supervisor (tidmarsh/src/supervisor)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "supervisor"))
+import network
+
+codecs = {} #decoders of the pushed stream, kept for the stateful codecs (delta)
 
-	img = np.load(inBytes)['arr_0']
+def packet(pck, binary):
+	p = network.Packet()
+	p.data = pck
+	p.binObj = binary
+	return p
 
-	#print(hashlib.sha1(img).hexdigest()+" "+pck["checksum"])
-	chk = hashlib.sha1(img).hexdigest()
-	if(chk != pck["checksum"]):
-	    raise ValueError("Error in transmission: checksums do not match")
+def verify(pck, binary):
+	#the checksum is computed on the sent bytes, only the sampled packets have one
+	network.IntegrityCheck().verify(packet(pck, binary))
 
-	return img.reshape(pck["shape"])
+def get_image(pck, binary):
+	p = packet(pck, binary)
+	network.readImagePacket(p, network.IntegrityCheck(), codecs)
+	return p.img
 
 def raw_to_encoded(img, format = "JPEG"):
 	pil_raw = Image.fromarray(img)
@@ -88,11 +96,15 @@ def ws_message(message):
 			#tag_len = int.from_bytes(rawmessage[:HEADER_LEN], byteorder='little')
 			#tags =
 			#print(str(raw_message[:20])) #log
-			img = get_image(pck, raw_message)
-			encoded = raw_to_encoded(img)
+			if(pck.get("codec") == "jpeg"):
+				#already encoded for the browser
+				verify(pck, raw_message)
+				encoded = raw_message
+			else:
+				img = get_image(pck, raw_message)
+				encoded = raw_to_encoded(img)
 			print("encoded is "+str(len(encoded))+" bytes")
 
-			print(str(check(raw_message)))
 			Group('all-cameras').send({
 				"bytes": encoded
 			})